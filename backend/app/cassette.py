@@ -0,0 +1,180 @@
+"""
+Record/replay cassettes for upstream completions
+
+In record mode every successful upstream completion is appended to a JSONL
+cassette file, one interaction per line:
+
+    {"key": payload hash, "model": ..., "stream": bool, "response": text,
+     "usage": {...}, "duration_ms": ..., "ttft_ms": ..., "deltas": [[offset_ms, text], ...],
+     "messages": [...]}
+
+In replay mode the ZaiClient never touches the network: each request is
+answered from the cassette entry with the same payload hash (see
+response_cache.payload_key), so a recorded debate replays deterministically
+as long as the orchestrator builds the same prompts. Identical requests
+recorded several times are served in recorded order, the last one repeating.
+
+Replay is instantaneous by default. A time_scale above 0 reproduces the
+recorded timing (time to first token, gaps between streamed deltas, total
+duration) multiplied by that factor, e.g. 1.0 for real time.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from app.response_cache import payload_key
+
+logger = logging.getLogger(__name__)
+
+MODES = ("off", "record", "replay")
+
+class CassetteMissError(Exception):
+    """Replay found no recorded interaction for a request (not retried)"""
+    
+    def __init__(self, key: str, model: str):
+        super().__init__(f"No cassette entry for {model} request {key[:12]}")
+        self.key = key
+
+class Cassette:
+    """A JSONL file of recorded upstream completions"""
+    
+    def __init__(self, mode: str, path: Path, time_scale: float = 0.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}' (expected one of {', '.join(MODES)})")
+        self.mode = mode
+        self.path = path
+        self.time_scale = max(0.0, time_scale)
+        self._entries: Optional[Dict[str, Deque[Dict[str, Any]]]] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._stats = {"recorded": 0, "replayed": 0, "misses": 0}
+    
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+    
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    
+    # =============== RECORD ===============
+    
+    def _append(self, line: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    
+    async def record(
+        self,
+        payload: Dict[str, Any],
+        text: str,
+        usage: Dict[str, Any],
+        duration_ns: int,
+        ttft_ms: Optional[int] = None,
+        deltas: Optional[List[Tuple[float, str]]] = None
+    ) -> None:
+        """
+        Append one successful interaction.
+        
+        Args:
+            payload: Request payload as sent upstream
+            text: Complete response text
+            usage: Usage block returned by the API
+            duration_ns: Measured attempt duration
+            ttft_ms: Time to first streamed token (streaming only)
+            deltas: (offset_ms, text) per streamed fragment (streaming only)
+        """
+        entry = {
+            "key": payload_key(payload),
+            "model": payload["model"],
+            "stream": deltas is not None,
+            "response": text,
+            "usage": usage,
+            "duration_ms": round(duration_ns / 1e6, 3),
+            "ttft_ms": ttft_ms,
+            "deltas": [[round(offset, 3), delta] for offset, delta in deltas or []],
+            "messages": payload.get("messages", []),
+        }
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            await asyncio.to_thread(self._append, line)
+        self._stats["recorded"] += 1
+    
+    # =============== REPLAY ===============
+    
+    def _read(self) -> Dict[str, Deque[Dict[str, Any]]]:
+        entries: Dict[str, Deque[Dict[str, Any]]] = {}
+        with open(self.path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed cassette line {number} in {self.path}")
+                    continue
+                entries.setdefault(entry["key"], deque()).append(entry)
+        return entries
+    
+    async def _lookup(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if self._entries is None:
+            self._entries = await asyncio.to_thread(self._read)
+            logger.info(
+                f"Cassette loaded from {self.path} "
+                f"({sum(len(e) for e in self._entries.values())} interactions)"
+            )
+        key = payload_key(payload)
+        recorded = self._entries.get(key)
+        if not recorded:
+            self._stats["misses"] += 1
+            raise CassetteMissError(key, payload["model"])
+        self._stats["replayed"] += 1
+        return recorded.popleft() if len(recorded) > 1 else recorded[0]
+    
+    async def _sleep_until(self, started: float, offset_ms: float) -> None:
+        """Sleep until offset_ms (scaled) after started; no-op at time_scale 0"""
+        if not self.time_scale:
+            return
+        delay = started + offset_ms * self.time_scale / 1000 - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    async def replay_completion(self, payload: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Recorded (text, usage) for a non-streaming request.
+        
+        Raises:
+            CassetteMissError: Nothing recorded for this payload
+        """
+        started = time.monotonic()
+        entry = await self._lookup(payload)
+        await self._sleep_until(started, entry["duration_ms"])
+        return entry["response"], entry["usage"]
+    
+    async def replay_stream(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Recorded deltas for a streaming request, then {"usage": {...}}.
+        
+        Entries recorded without streaming replay as a single delta at their
+        recorded duration.
+        
+        Raises:
+            CassetteMissError: Nothing recorded for this payload
+        """
+        started = time.monotonic()
+        entry = await self._lookup(payload)
+        deltas = entry["deltas"] or [[entry["duration_ms"], entry["response"]]]
+        for offset_ms, delta in deltas:
+            await self._sleep_until(started, offset_ms)
+            yield {"content": delta}
+        await self._sleep_until(started, entry["duration_ms"])
+        yield {"usage": entry["usage"]}
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "path": str(self.path), "time_scale": self.time_scale, **self._stats}
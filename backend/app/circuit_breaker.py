@@ -0,0 +1,251 @@
+"""
+Per-model circuit breakers for upstream calls
+
+Every session calling a model shares that model's breaker, so during a
+provider outage the failures of a few sessions stop the others from spending
+their whole retry budget against it.
+
+    closed     calls go through; the breaker opens once
+               breaker_consecutive_failures attempts in a row fail, or the
+               failure share of the last breaker_window_seconds reaches
+               breaker_error_rate (after at least breaker_min_calls attempts)
+    open       calls fail fast with CircuitOpenError (ZaiClient reroutes them
+               to another model of the same tier when one is available) for a
+               jittered backoff: breaker_open_seconds, doubling on every reopen
+               up to breaker_max_open_seconds, and never shorter than a
+               Retry-After the provider sent
+    half_open  once the backoff has passed, breaker_half_open_calls probe
+               attempts are let through: if all succeed the breaker closes,
+               if one fails it opens again
+
+Timeouts, connection errors, 429s and 5xx responses count as failures; other
+4xx responses and cancelled attempts count as neither.
+"""
+
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.metrics import CIRCUIT_REJECTIONS, CIRCUIT_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(RuntimeError):
+    """A call refused because the model's circuit is open (not retried against that model)"""
+    
+    def __init__(self, model: str, retry_in: float):
+        super().__init__(f"Circuit open for {model} (retry in {retry_in:.1f}s)")
+        self.model = model
+        self.retry_in = retry_in
+
+def jittered(seconds: float) -> float:
+    """Between half and all of a backoff, so callers that failed together do not retry together"""
+    return seconds / 2 + random.uniform(0, seconds / 2)
+
+class CircuitBreaker:
+    """Closed/open/half-open state of one model"""
+    
+    def __init__(self, model: str, breakers: "CircuitBreakers"):
+        self.model = model
+        self.config = breakers
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.last_error: Optional[str] = None
+        # (finished_at, succeeded) of attempts while closed
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._consecutive_failures = 0
+        self._opens = 0  # reopens since the breaker last closed (backoff exponent)
+        self._probes = 0  # half-open attempts in flight
+        self._probe_successes = 0
+    
+    def _transition(self, state: str) -> None:
+        self.state = state
+        CIRCUIT_TRANSITIONS.inc(model=self.model, state=state)
+    
+    def _refresh(self) -> None:
+        if self.state == OPEN and time.monotonic() >= self.open_until:
+            self._transition(HALF_OPEN)
+            self._probes = 0
+            self._probe_successes = 0
+            logger.info(f"Circuit for {self.model} half-open: probing")
+    
+    @property
+    def retry_in(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+    
+    def available(self) -> bool:
+        """Whether a call would be let through right now"""
+        self._refresh()
+        return self.state == CLOSED or (self.state == HALF_OPEN and self._probes < self.config.half_open_calls)
+    
+    def acquire(self) -> bool:
+        """
+        Let one attempt through.
+        
+        Returns:
+            Whether the attempt is a half-open probe
+        
+        Raises:
+            CircuitOpenError: The circuit is open (or its probes are all in flight)
+        """
+        if not self.available():
+            CIRCUIT_REJECTIONS.inc(model=self.model)
+            raise CircuitOpenError(self.model, self.retry_in)
+        if self.state == HALF_OPEN:
+            self._probes += 1
+            return True
+        return False
+    
+    def record(self, succeeded: Optional[bool], probe: bool, retry_after: Optional[float] = None, error: str = "") -> None:
+        """
+        Record the outcome of an attempt let through by acquire().
+        
+        Args:
+            succeeded: True, False, or None for outcomes that say nothing
+                about the model's health (cancelled, 4xx)
+            probe: What acquire() returned for the attempt
+            retry_after: Retry-After the provider sent with a failure
+            error: Failure description (kept for the health report)
+        """
+        if probe:
+            self._probes = max(0, self._probes - 1)
+        if succeeded is None:
+            return
+        now = time.monotonic()
+        if succeeded:
+            self._consecutive_failures = 0
+            if probe and self.state == HALF_OPEN:
+                self._probe_successes += 1
+                if self._probe_successes >= self.config.half_open_calls:
+                    self._close()
+            elif self.state == CLOSED:
+                self._outcomes.append((now, True))
+            return
+        
+        self.last_error = error or self.last_error
+        self._consecutive_failures += 1
+        if probe and self.state == HALF_OPEN:
+            self._open(retry_after)
+        elif self.state == CLOSED:
+            self._outcomes.append((now, False))
+            if self._tripped(now):
+                self._open(retry_after)
+        elif self.state == OPEN and retry_after:
+            # Late failures of attempts started while closed only extend to a Retry-After
+            self.open_until = max(self.open_until, now + retry_after)
+    
+    def _tripped(self, now: float) -> bool:
+        cutoff = now - self.config.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+        if self._consecutive_failures >= self.config.consecutive_failures:
+            return True
+        if len(self._outcomes) < self.config.min_calls:
+            return False
+        failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+        return failures / len(self._outcomes) >= self.config.error_rate
+    
+    def _open(self, retry_after: Optional[float]) -> None:
+        self._opens += 1
+        backoff = min(self.config.max_open_seconds, self.config.open_seconds * 2 ** (self._opens - 1))
+        duration = max(jittered(backoff), retry_after or 0.0)
+        self.open_until = time.monotonic() + duration
+        self._outcomes.clear()
+        self._transition(OPEN)
+        logger.warning(f"Circuit for {self.model} opened for {duration:.1f}s (last error: {self.last_error})")
+    
+    def _close(self) -> None:
+        self._opens = 0
+        self._consecutive_failures = 0
+        self._outcomes.clear()
+        self._transition(CLOSED)
+        logger.info(f"Circuit for {self.model} closed")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        self._refresh()
+        failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+        return {
+            "state": self.state,
+            "retry_in_s": round(self.retry_in, 1) if self.state == OPEN else None,
+            "recent_calls": len(self._outcomes),
+            "recent_failures": failures,
+            "consecutive_failures": self._consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+class CircuitBreakers:
+    """Model -> CircuitBreaker, with the shared thresholds"""
+    
+    def __init__(
+        self,
+        enabled: bool,
+        error_rate: float,
+        min_calls: int,
+        consecutive_failures: int,
+        window_seconds: float,
+        open_seconds: float,
+        max_open_seconds: float,
+        half_open_calls: int
+    ):
+        self.enabled = enabled
+        self.error_rate = error_rate
+        self.min_calls = max(1, min_calls)
+        self.consecutive_failures = max(1, consecutive_failures)
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+    
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model, self)
+            self._breakers[model] = breaker
+        return breaker
+    
+    def available(self, model: str) -> bool:
+        return not self.enabled or self.get(model).available()
+    
+    def acquire(self, model: str) -> bool:
+        """Let one attempt to a model through (see CircuitBreaker.acquire)"""
+        if not self.enabled:
+            return False
+        return self.get(model).acquire()
+    
+    def record(
+        self,
+        model: str,
+        succeeded: Optional[bool],
+        probe: bool,
+        retry_after: Optional[float] = None,
+        error: str = ""
+    ) -> None:
+        if self.enabled:
+            self.get(model).record(succeeded, probe, retry_after, error)
+    
+    def open_models(self) -> List[str]:
+        return [model for model, breaker in self._breakers.items() if breaker.snapshot()["state"] == OPEN]
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: breaker.snapshot() for model, breaker in self._breakers.items()}
+
+# Singleton instance
+circuit_breakers = CircuitBreakers(
+    enabled=settings.enable_circuit_breaker,
+    error_rate=settings.breaker_error_rate,
+    min_calls=settings.breaker_min_calls,
+    consecutive_failures=settings.breaker_consecutive_failures,
+    window_seconds=settings.breaker_window_seconds,
+    open_seconds=settings.breaker_open_seconds,
+    max_open_seconds=settings.breaker_max_open_seconds,
+    half_open_calls=settings.breaker_half_open_calls
+)
@@ -1,3 +1,4 @@
+from typing import Dict, List
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -11,14 +12,97 @@ class Settings(BaseSettings):
     
     # System
     max_rounds: int = 3
+    # Debate round agent graph: agent -> agents of the same round it waits for.
+    # Agents with no path between them run concurrently, e.g. {"EXPANSION": [], "COMPRESSION": []}
+    round_graph: Dict[str, List[str]] = {
+        "EXPANSION": [],
+        "COMPRESSION": ["EXPANSION"]
+    }
     session_storage_path: str
     log_level: str = "INFO"
     
+    # Session store (in-process write-behind cache)
+    session_write_behind: bool = True
+    session_flush_delay: float = 1.0
+    session_cache_max_entries: int = 256
+    session_cache_max_bytes: int = 64 * 1024 * 1024
+    session_backend: str = "file"  # "file" | "sqlite"
+    session_sqlite_path: str = ""  # defaults to <session_storage_path>/sessions.db
+    session_storage_mode: str = "snapshot"  # file backend: "snapshot" | "journal"
+    session_journal_commit_delay: float = 0.002
+    
+    # Background session processing (bounded worker pool)
+    session_workers: int = 8
+    session_queue_max_depth: int = 100
+    session_job_estimate_seconds: float = 60.0  # initial Retry-After basis until jobs are timed
+    
+    # Startup crash recovery of in-flight sessions
+    enable_session_recovery: bool = True
+    recovery_rate_per_second: float = 2.0
+    recovery_queue_share: float = 0.5  # max share of the session queue used by recovered sessions
+    recovery_max_age_hours: float = 24.0
+    recovery_max_attempts: int = 3
+    
     # Performance
     ollama_timeout: int = 120
     ollama_max_retries: int = 3
     ollama_retry_delay: int = 2
     
+    # Upstream connection pool
+    zai_http2: bool = True
+    zai_max_connections: int = 100
+    zai_max_keepalive_connections: int = 20
+    zai_keepalive_expiry: float = 30.0
+    zai_connect_timeout: float = 10.0
+    zai_prewarm_connections: int = 2
+    
+    # Upstream scheduler (per-model limits live in TASK_MODEL_MAPPING)
+    enable_upstream_scheduler: bool = True
+    upstream_default_max_concurrency: int = 8
+    upstream_default_rpm: int = 0  # 0 = no requests-per-minute limit
+    
+    # Per-model circuit breakers (shared by every session; an open circuit fails fast or reroutes)
+    enable_circuit_breaker: bool = True
+    breaker_error_rate: float = 0.5  # failure share of recent attempts that opens the circuit
+    breaker_min_calls: int = 10  # attempts in the window before the error rate counts
+    breaker_consecutive_failures: int = 5  # failures in a row that open the circuit regardless
+    breaker_window_seconds: float = 60.0
+    breaker_open_seconds: float = 5.0  # first open period (jittered, doubles on each reopen)
+    breaker_max_open_seconds: float = 120.0
+    breaker_half_open_calls: int = 2  # probe attempts; all must succeed to close
+    
+    # Adaptive model routing (TASK_MODEL_MAPPING gives each task's default model)
+    enable_model_router: bool = True
+    router_tiers: Dict[str, List[str]] = {}  # TaskType -> allowed ModelTiers; default: the default model's tier
+    router_latency_slo: Dict[str, float] = {  # TaskType -> p95 upstream attempt latency target (seconds, scheduler queueing excluded)
+        "CLARIFICATION": 20.0,
+        "DEBATE": 30.0,
+        "SYNTHESIS": 60.0,
+        "SUMMARIZATION": 20.0
+    }
+    router_default_slo: float = 45.0
+    router_max_error_rate: float = 0.2
+    router_window: int = 50  # calls per model
+    router_window_seconds: float = 300.0
+    router_min_samples: int = 5
+    router_excluded_models: List[str] = ["glm-4.6v", "glm-4.6v-flashx", "glm-4.6v-flash", "glm-4.5v"]  # vision models
+    session_cost_ceiling: float = 0.0  # USD per session the router keeps to; 0 = no ceiling
+    
+    # Hedged requests (a duplicate for calls slower than the learned latency percentile)
+    enable_hedging: bool = True
+    hedge_percentiles: Dict[str, float] = {  # TaskType -> first-response latency percentile; unlisted tasks are never hedged
+        "CLARIFICATION": 95.0,
+        "DEBATE": 95.0,
+        "SYNTHESIS": 95.0
+    }
+    hedge_fallback_tasks: List[str] = ["CLARIFICATION", "DEBATE"]  # hedge to another model of the same tier
+    hedge_min_delay: float = 1.0  # seconds
+    hedge_min_samples: int = 20
+    hedge_window: int = 200  # first-response latencies kept per model
+    hedge_max_share: float = 0.1  # at most this share of calls is hedged
+    hedge_spend_ratio: float = 0.05  # hedge spend may reach this share of upstream spend
+    hedge_max_credit: float = 0.05  # USD of unused hedge budget that can accumulate
+    
     # Model parameters
     temperature: float = 0.7
     top_p: float = 0.9
@@ -26,6 +110,75 @@ class Settings(BaseSettings):
     max_tokens: int = 2048
     context_window: int = 8192
     
+    # Pre-flight request sizing (local token estimates against each model's context window)
+    agent_max_tokens: Dict[str, int] = {  # AgentType (or "SUMMARY") -> max_tokens; other calls use max_tokens
+        "CLARIFICATION": 768,
+        "EXPANSION": 2048,
+        "COMPRESSION": 1536,
+        "SYNTHESIS": 2048,
+        "SUMMARY": 800  # ~2 tokens per word of history_summary_max_words
+    }
+    oversized_prompt_policy: str = "trim"  # "trim" | "reject" prompts that do not fit the context window
+    min_output_tokens: int = 256  # max_tokens is never lowered below this to fit a prompt
+    token_estimate_bytes_per_token: float = 4.0  # starting ratio for every model family (calibrated from usage)
+    token_estimate_safety_margin: float = 0.05  # share of the context window kept free for estimate error
+    
+    # History budgeting (fit debate history into a share of context_window)
+    enable_history_budget: bool = True
+    history_verbatim_rounds: int = 1
+    history_budget_default_ratio: float = 0.5
+    history_budget_ratios: Dict[str, float] = {
+        "DEBATE": 0.5,
+        "SYNTHESIS": 0.6
+    }
+    history_summary_max_words: int = 400
+    
+    # Per-session span tracing (GET /api/chat/{id}/timeline)
+    enable_tracing: bool = True
+    trace_max_spans_per_run: int = 1000
+    trace_max_spans_per_session: int = 5000
+    trace_export_path: str = ""  # append OTLP/JSON trace requests to this file (one per line)
+    trace_service_name: str = "perspective-backend"
+    
+    # Streaming (token deltas forwarded to WebSocket clients)
+    enable_streaming: bool = True
+    
+    # WebSocket fan-out (per-subscriber send queues)
+    ws_send_queue_size: int = 256
+    ws_slow_consumer_policy: str = "coalesce"  # "coalesce" | "drop"
+    ws_send_timeout: float = 10.0
+    
+    # Resumable WebSocket streams (?since=<seq> replays from a per-session ring buffer)
+    ws_replay_buffer_size: int = 1000  # events kept per session
+    ws_replay_max_sessions: int = 1000
+    
+    # Cross-process event bus ("unix" for uvicorn --workers N on one host)
+    event_bus_backend: str = "local"  # "local" | "unix"
+    event_bus_path: str = ""  # defaults to <session_storage_path>/bus
+    event_bus_refresh_interval: float = 1.0
+    event_bus_max_buffer_bytes: int = 8 * 1024 * 1024
+    event_bus_ack_timeout: float = 2.0  # seconds to wait for the owner to accept forwarded work
+    
+    # Response cache (opt-in; keyed by a hash of the full request payload)
+    enable_response_cache: bool = False
+    response_cache_max_entries: int = 1024
+    response_cache_disk: bool = True
+    response_cache_path: str = ""  # defaults to <session_storage_path>/response_cache
+    response_cache_default_ttl: int = 3600
+    response_cache_ttls: Dict[str, int] = {
+        "CLARIFICATION": 86400,
+        "DEBATE": 3600,
+        "SYNTHESIS": 3600,
+        "CODE": 3600,
+        "CREATIVE": 0,
+        "GENERAL": 600
+    }
+    
+    # Upstream record/replay (offline benchmarks and regression runs)
+    zai_cassette_mode: str = "off"  # "off" | "record" | "replay"
+    zai_cassette_path: str = ""  # defaults to <session_storage_path>/cassettes/zai.jsonl
+    zai_cassette_time_scale: float = 0.0  # replay timing: 0 = instant, 1.0 = as recorded
+    
     # Cost Tracking
     enable_cost_tracking: bool = True
     cost_tracking_log_level: str = "INFO"
@@ -0,0 +1,500 @@
+"""
+Cross-process event bus for WebSocket delivery and session work routing
+
+broadcast_to_session publishes through an EventBus so WebSocket events reach
+clients connected to any worker process, and init/clarify hand sessions to
+the bus instead of the local worker pool. Backends are selected with
+settings.event_bus_backend:
+
+    "local": single process (default); events go straight to the local
+             WebSocket hub and sessions to the local worker pool
+    "unix":  several worker processes on one host (uvicorn --workers N),
+             connected over Unix domain sockets in settings.event_bus_path
+
+With the "unix" backend each session has an owner process, picked by
+rendezvous hashing of the session id over the live processes. Background
+processing of a session always runs on its owner, and only the owner caches
+it in the session store; other processes read and write it through to
+storage. Events are sent only to the processes that have a WebSocket
+subscribed to the session: processes announce interest when their first
+subscriber for a session connects and withdraw it when the last one leaves.
+
+Admission checks and submits for a session owned by another process are
+requests: the owner answers with an "ack" carrying the queue position, or the
+PoolFullError/PoolUnavailableError it raised, which the caller re-raises (so
+endpoints still answer 429/503). An owner that cannot be reached is treated
+as gone: the check runs against the local pool and the session is processed
+locally. A submit the owner refuses is processed locally as well, so a
+session whose state was already changed is never left unqueued.
+
+WebSocket clients may connect to any process. Only the owner assigns event
+seqs; another process keeps a session's replay log (app.event_log) only while
+it receives the session's events without gaps: the log is dropped when its
+last subscriber leaves, when the link to the owner drops, or when ownership
+moves. A snapshot sent by a non-owner takes its seq from a "checkpoint"
+request, which the owner answers after writing out the session's pending
+changes.
+
+Wire format: one JSON object per line.
+
+    {"op": "sync", "peer": id, "sessions": [...]}        sent first on each link
+    {"op": "interest", "peer": id, "sid": ..., "on": bool}
+    {"op": "event", "sid": ..., "msg": {...}}
+    {"op": "admit", "peer": id, "sid": ..., "id": n}       answered with an ack
+    {"op": "submit", "peer": id, "sid": ..., "id": n}      answered with an ack
+    {"op": "checkpoint", "peer": id, "sid": ..., "id": n}  answered with an ack carrying "seq"
+    {"op": "ack", "id": n, "position": int}                or "error": "full" | "unavailable", "retry_after": s
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from app.config import get_settings
+from app.event_log import event_log
+from app.session_store import session_store
+from app.session_workers import session_workers, PoolFullError, PoolUnavailableError
+from app.ws_hub import ws_hub
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Largest line accepted from a peer (a full synthesis fits comfortably)
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+def _refusal(error: Exception) -> Dict[str, Any]:
+    """Ack fields for a pool error"""
+    return {"error": "full" if isinstance(error, PoolFullError) else "unavailable", "retry_after": error.retry_after}
+
+def _pool_error(ack: Dict[str, Any]) -> Exception:
+    """Pool error an owner answered with"""
+    if ack["error"] == "full":
+        return PoolFullError(retry_after=ack["retry_after"])
+    return PoolUnavailableError(retry_after=ack["retry_after"])
+
+class EventBus:
+    """Single-process bus: events go to the local hub and sessions to the local pool"""
+    
+    name = "local"
+    
+    async def start(self) -> None:
+        pass
+    
+    async def stop(self) -> None:
+        pass
+    
+    def owns(self, session_id: UUID) -> bool:
+        """Whether this process processes (and caches) the session"""
+        return True
+    
+    async def publish(self, session_id: str, message: Dict[str, Any]) -> None:
+        """Deliver a WebSocket message to every subscriber of the session"""
+        ws_hub.publish(session_id, message)
+    
+    async def admit(self, session_id: UUID) -> None:
+        """
+        Raise if the session's owner would refuse new work for it.
+        
+        Raises:
+            PoolUnavailableError: The owner's pool is not running
+            PoolFullError: The owner's queue is at its depth limit
+        """
+        session_workers.check_admission()
+    
+    async def submit(self, session_id: UUID) -> Optional[int]:
+        """
+        Queue a session for background processing on its owner.
+        
+        Returns:
+            Queue position on the owner, or None when the owner did not
+            confirm in time
+        """
+        return await session_workers.submit(session_id)
+    
+    async def checkpoint(self, session_id: UUID) -> Optional[int]:
+        """
+        Seq a snapshot of the session loaded after this call is current to.
+        
+        Read on the session's owner before its pending changes are written out,
+        so every message up to it is in the stored session and every later one
+        reaches this process's subscribers.
+        
+        Returns:
+            The seq, or None when the owner could not be asked and this
+            process has no log for the session
+        """
+        return event_log.current_seq(str(session_id))
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+class UnixSocketEventBus(EventBus):
+    """Bus between the worker processes of one host over Unix domain sockets"""
+    
+    name = "unix"
+    
+    def __init__(self, directory: Path, refresh_interval: float, max_buffer_bytes: int):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self.peer_id = str(os.getpid())
+        self.socket_path = directory / f"worker-{self.peer_id}.sock"
+        self._peers: List[str] = [self.peer_id]
+        self._links: Dict[str, asyncio.StreamWriter] = {}
+        self._incoming: Set[asyncio.StreamWriter] = set()
+        self._connecting: Set[str] = set()
+        self._interest: Dict[str, Set[str]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Request id -> future resolved by the owner's ack
+        self._acks: Dict[int, asyncio.Future] = {}
+        self._next_request = 0
+        self._stats = {
+            "events_sent": 0, "events_received": 0, "submits_forwarded": 0, "submits_received": 0,
+            "submits_refused": 0, "acks_timed_out": 0, "links_dropped": 0,
+        }
+    
+    # =============== LIFECYCLE ===============
+    
+    async def start(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(self._handle, path=str(self.socket_path), limit=MAX_LINE_BYTES)
+        ws_hub.on_interest = self._announce_interest
+        session_store.owns = self.owns
+        await self._refresh()
+        self._refresh_task = asyncio.create_task(self._refresh_loop(), name="event-bus-refresh")
+        logger.info(f"Event bus listening on {self.socket_path} ({len(self._peers)} workers)")
+    
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        # Closing incoming links ends their handlers with EOF rather than cancellation
+        for writer in list(self._incoming):
+            writer.close()
+        for peer in list(self._links):
+            self._drop_link(peer)
+        self.socket_path.unlink(missing_ok=True)
+        ws_hub.on_interest = None
+        session_store.owns = lambda session_id: True
+    
+    # =============== PEERS ===============
+    
+    @staticmethod
+    def _alive(peer: str) -> bool:
+        try:
+            os.kill(int(peer), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+    
+    def _discover(self) -> List[str]:
+        peers = [self.peer_id]
+        for path in self.directory.glob("worker-*.sock"):
+            peer = path.stem[len("worker-"):]
+            if peer == self.peer_id:
+                continue
+            if not self._alive(peer):
+                # Left behind by a crashed worker
+                path.unlink(missing_ok=True)
+                continue
+            peers.append(peer)
+        return sorted(peers)
+    
+    async def _refresh(self) -> None:
+        """Reconcile links with the workers currently running"""
+        peers = await asyncio.to_thread(self._discover)
+        gone = set(self._peers) - set(peers)
+        moved = set(peers) != set(self._peers)
+        self._peers = peers
+        for peer in gone:
+            self._drop_link(peer)
+            for subscribers in self._interest.values():
+                subscribers.discard(peer)
+        self._interest = {sid: peers for sid, peers in self._interest.items() if peers}
+        if moved:
+            # Ownership moved: logs of sessions owned elsewhere may have missed events
+            self._forget_logs(lambda sid: not self.owns(UUID(sid)))
+        for peer in peers:
+            if peer != self.peer_id and peer not in self._links:
+                await self._connect(peer)
+    
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self._refresh()
+            except Exception as e:
+                logger.warning(f"Event bus peer refresh failed: {e}")
+    
+    async def _connect(self, peer: str) -> None:
+        if peer in self._connecting:
+            return
+        self._connecting.add(peer)
+        try:
+            _, writer = await asyncio.open_unix_connection(str(self.directory / f"worker-{peer}.sock"))
+        except OSError as e:
+            logger.debug(f"Event bus could not reach worker {peer}: {e}")
+            return
+        finally:
+            self._connecting.discard(peer)
+        self._links[peer] = writer
+        if peer not in self._peers:
+            self._peers = sorted(self._peers + [peer])
+            self._forget_logs(lambda sid: not self.owns(UUID(sid)))
+        # Tell the peer which sessions this process wants events for
+        self._send(peer, self._encode({"op": "sync", "peer": self.peer_id, "sessions": ws_hub.sessions()}))
+    
+    def _drop_link(self, peer: str) -> None:
+        writer = self._links.pop(peer, None)
+        if writer is not None:
+            writer.close()
+            # Events the peer publishes until the link is back are lost here
+            self._forget_logs(lambda sid: self.owner(sid) == peer)
+    
+    def _forget_logs(self, predicate) -> None:
+        """Drop the replay logs of sessions matching predicate(session_id)"""
+        for session_id in event_log.session_ids():
+            if predicate(session_id):
+                event_log.forget(session_id)
+    
+    # =============== WIRE ===============
+    
+    @staticmethod
+    def _encode(payload: Dict[str, Any]) -> bytes:
+        return (json.dumps(payload, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+    
+    def _send(self, peer: str, line: bytes) -> bool:
+        """Write a line to a peer without waiting; a peer that stops reading is disconnected"""
+        writer = self._links.get(peer)
+        if writer is None or writer.is_closing():
+            return False
+        writer.write(line)
+        if writer.transport.get_write_buffer_size() > self.max_buffer_bytes:
+            logger.warning(f"Event bus link to worker {peer} is backed up; reconnecting")
+            self._stats["links_dropped"] += 1
+            self._drop_link(peer)
+            return False
+        return True
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve one incoming link (messages from one peer)"""
+        peer = None
+        self._incoming.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message["op"]
+                if op == "event":
+                    self._stats["events_received"] += 1
+                    ws_hub.publish(message["sid"], message["msg"])
+                elif op == "interest":
+                    self._record_interest(message["peer"], message["sid"], message["on"])
+                elif op == "admit":
+                    self._accept_admit(message)
+                elif op == "submit":
+                    await self._accept_submit(message)
+                elif op == "checkpoint":
+                    await self._accept_checkpoint(message)
+                elif op == "ack":
+                    future = self._acks.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif op == "sync":
+                    peer = message["peer"]
+                    for subscribers in self._interest.values():
+                        subscribers.discard(peer)
+                    for sid in message["sessions"]:
+                        self._record_interest(peer, sid, True)
+                    if peer not in self._links:
+                        # A worker that just started: link back without waiting for the refresh
+                        asyncio.create_task(self._connect(peer))
+        except (asyncio.IncompleteReadError, ConnectionError, json.JSONDecodeError, KeyError, ValueError) as e:
+            logger.warning(f"Event bus link from worker {peer or '?'} failed: {e}")
+        finally:
+            self._incoming.discard(writer)
+            writer.close()
+    
+    # =============== ROUTING ===============
+    
+    def owner(self, session_id: str) -> str:
+        """Owning worker of a session (rendezvous hashing over live workers)"""
+        return max(
+            self._peers,
+            key=lambda peer: hashlib.blake2b(f"{peer}:{session_id}".encode(), digest_size=8).digest()
+        )
+    
+    def owns(self, session_id: UUID) -> bool:
+        return self.owner(str(session_id)) == self.peer_id
+    
+    def _record_interest(self, peer: str, session_id: str, on: bool) -> None:
+        if on:
+            self._interest.setdefault(session_id, set()).add(peer)
+            return
+        subscribers = self._interest.get(session_id)
+        if subscribers is not None:
+            subscribers.discard(peer)
+            if not subscribers:
+                del self._interest[session_id]
+    
+    def _announce_interest(self, session_id: str, on: bool) -> None:
+        line = self._encode({"op": "interest", "peer": self.peer_id, "sid": session_id, "on": on})
+        for peer in list(self._links):
+            self._send(peer, line)
+        if not on and self.owner(session_id) != self.peer_id:
+            # Events stop arriving here, so the log would have a gap
+            event_log.forget(session_id)
+    
+    async def publish(self, session_id: str, message: Dict[str, Any]) -> None:
+        ws_hub.publish(session_id, message)
+        peers = self._interest.get(session_id)
+        if not peers:
+            return
+        line = self._encode({"op": "event", "sid": session_id, "msg": message})
+        for peer in list(peers):
+            if self._send(peer, line):
+                self._stats["events_sent"] += 1
+    
+    async def _request(self, owner: str, op: str, session_id: UUID) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        Send a request to a session's owner and wait for its ack.
+        
+        Returns:
+            (sent, ack): sent is False when the owner is unreachable; ack is
+            None when it did not answer within event_bus_ack_timeout
+        """
+        self._next_request += 1
+        request_id = self._next_request
+        future = asyncio.get_running_loop().create_future()
+        self._acks[request_id] = future
+        try:
+            line = self._encode({"op": op, "peer": self.peer_id, "sid": str(session_id), "id": request_id})
+            if not self._send(owner, line):
+                return False, None
+            try:
+                return True, await asyncio.wait_for(future, settings.event_bus_ack_timeout)
+            except asyncio.TimeoutError:
+                self._stats["acks_timed_out"] += 1
+                return True, None
+        finally:
+            self._acks.pop(request_id, None)
+    
+    def _reply(self, message: Dict[str, Any], **fields: Any) -> None:
+        if not self._send(message["peer"], self._encode({"op": "ack", "id": message["id"], **fields})):
+            logger.warning(f"Event bus could not answer worker {message['peer']} ({message['op']} {message['sid']})")
+    
+    async def admit(self, session_id: UUID) -> None:
+        owner = self.owner(str(session_id))
+        if owner != self.peer_id:
+            sent, ack = await self._request(owner, "admit", session_id)
+            if ack is not None:
+                if "error" in ack:
+                    raise _pool_error(ack)
+                return
+            if sent and self._alive(owner):
+                # Busy owner: let the submit find out
+                return
+            logger.warning(f"[{session_id}] Owner worker {owner} unreachable; checking the local pool")
+        session_workers.check_admission()
+    
+    async def submit(self, session_id: UUID) -> Optional[int]:
+        owner = self.owner(str(session_id))
+        if owner != self.peer_id:
+            # The session was written through to storage; the owner reloads it
+            sent, ack = await self._request(owner, "submit", session_id)
+            if ack is not None and "error" not in ack:
+                self._stats["submits_forwarded"] += 1
+                return ack["position"]
+            if ack is not None:
+                self._stats["submits_refused"] += 1
+                logger.warning(f"[{session_id}] Owner worker {owner} refused the session ({ack['error']}); processing locally")
+            elif sent and self._alive(owner):
+                # It may well have been queued there; running it here too would process it twice
+                self._stats["submits_forwarded"] += 1
+                logger.warning(f"[{session_id}] Owner worker {owner} did not confirm the submit in time")
+                return None
+            else:
+                logger.warning(f"[{session_id}] Owner worker {owner} unreachable; processing locally")
+        return await session_workers.submit(session_id)
+    
+    async def checkpoint(self, session_id: UUID) -> Optional[int]:
+        owner = self.owner(str(session_id))
+        if owner != self.peer_id:
+            # Sent after this process's interest, so the owner forwards every later event
+            _, ack = await self._request(owner, "checkpoint", session_id)
+            if ack is not None:
+                return ack["seq"]
+            logger.warning(f"[{session_id}] Owner worker {owner} did not answer a checkpoint; using the local seq")
+            return event_log.last_seq(str(session_id))
+        return event_log.current_seq(str(session_id))
+    
+    def _accept_admit(self, message: Dict[str, Any]) -> None:
+        try:
+            session_workers.check_admission()
+        except (PoolFullError, PoolUnavailableError) as e:
+            self._reply(message, **_refusal(e))
+            return
+        self._reply(message, position=None)
+    
+    async def _accept_submit(self, message: Dict[str, Any]) -> None:
+        session_id = UUID(message["sid"])
+        self._stats["submits_received"] += 1
+        # Another worker changed the session since this one last cached it
+        session_store.invalidate(session_id)
+        try:
+            position = await session_workers.submit(session_id)
+        except (PoolFullError, PoolUnavailableError) as e:
+            # The sender processes it instead
+            logger.warning(f"[{session_id}] Forwarded session refused: {e}")
+            self._reply(message, **_refusal(e))
+            return
+        self._reply(message, position=position)
+    
+    async def _accept_checkpoint(self, message: Dict[str, Any]) -> None:
+        seq = event_log.current_seq(message["sid"])
+        try:
+            await session_store.flush(UUID(message["sid"]))
+        except Exception as e:
+            logger.warning(f"[{message['sid']}] Flush for a checkpoint failed: {e}")
+        self._reply(message, seq=seq)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "worker": self.peer_id,
+            "workers": len(self._peers),
+            "links": len(self._links),
+            "remote_interest": len(self._interest),
+            **self._stats,
+        }
+
+def create_event_bus(settings) -> EventBus:
+    """Instantiate the bus selected by settings.event_bus_backend"""
+    if settings.event_bus_backend == "unix":
+        directory = Path(settings.event_bus_path) if settings.event_bus_path else Path(settings.session_storage_path) / "bus"
+        return UnixSocketEventBus(
+            directory,
+            refresh_interval=settings.event_bus_refresh_interval,
+            max_buffer_bytes=settings.event_bus_max_buffer_bytes
+        )
+    if settings.event_bus_backend != "local":
+        raise ValueError(f"Unknown event bus backend: {settings.event_bus_backend}")
+    return EventBus()
+
+# Singleton instance
+event_bus = create_event_bus(settings)
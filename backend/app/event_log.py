@@ -0,0 +1,153 @@
+"""
+Per-session WebSocket event log for resumable streams
+
+Every message broadcast to a session gets the next sequence number of that
+session (WSMessage.seq) and is kept in a bounded ring buffer. A client that
+reconnects with ?since=<seq> is sent only the events after that number; when
+they are no longer buffered (evicted, restarted process, another worker's
+log) the endpoint falls back to a snapshot of the stored session instead.
+
+With several worker processes, seqs are assigned by the session's owner.
+Another worker only receives a session's events while it has subscribers,
+so the event bus drops its log when that stops (or ownership moves) rather
+than keep one with a silent gap, and a snapshot's seq is asked of the owner
+(see EventBus.checkpoint).
+
+Sequence numbers start from the wall clock in milliseconds when a session's
+log is created, so numbers handed out before a restart are always below the
+ones after it and a stale ?since= is detected rather than misread.
+
+Token deltas are buffered too, but once the complete agent_output/synthesis
+for an output is recorded its deltas are pruned: the full message replaces
+them on replay and they no longer take up buffer space.
+"""
+
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Complete outputs that make the token deltas of the same output redundant
+OUTPUT_TYPES = ("agent_output", "synthesis")
+
+class SessionLog:
+    """Ring buffer of one session's sequenced messages"""
+    
+    __slots__ = ("events", "first", "last", "max_events")
+    
+    def __init__(self, origin: int, max_events: int):
+        self.events: Deque[Dict[str, Any]] = deque()
+        # Contiguous window: every seq in [first, last] is buffered or pruned
+        self.first = origin + 1
+        self.last = origin
+        self.max_events = max(1, max_events)
+    
+    def append(self, message: Dict[str, Any]) -> None:
+        seq = message["seq"]
+        if seq != self.last + 1:
+            # Missed events (a worker that only receives while it has subscribers)
+            self.events.clear()
+            self.first = seq
+        self.last = seq
+        if message.get("type") in OUTPUT_TYPES:
+            self._prune_deltas(message)
+        self.events.append(message)
+        while len(self.events) > self.max_events:
+            self.first = self.events.popleft()["seq"] + 1
+    
+    def _prune_deltas(self, output: Dict[str, Any]) -> None:
+        agent, round_number = output.get("agent"), output.get("round")
+        self.events = deque(
+            event for event in self.events
+            if not (
+                event.get("type") == "agent_delta"
+                and event.get("agent") == agent
+                and (round_number is None or event.get("round") == round_number)
+            )
+        )
+    
+    def since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        if seq < self.first - 1 or seq > self.last:
+            return None
+        return [event for event in self.events if event["seq"] > seq]
+
+class EventLog:
+    """Session -> SessionLog, least recently used sessions evicted first"""
+    
+    def __init__(self, max_events: int, max_sessions: int):
+        self.max_events = max_events
+        self.max_sessions = max(1, max_sessions)
+        self._logs: "OrderedDict[str, SessionLog]" = OrderedDict()
+        self._stats = {"replays": 0, "replayed_events": 0, "misses": 0}
+    
+    def _get(self, session_id: str, origin: Optional[int] = None) -> SessionLog:
+        log = self._logs.get(session_id)
+        if log is None:
+            log = SessionLog(int(time.time() * 1000) if origin is None else origin, self.max_events)
+            self._logs[session_id] = log
+            while len(self._logs) > self.max_sessions:
+                self._logs.popitem(last=False)
+        else:
+            self._logs.move_to_end(session_id)
+        return log
+    
+    def next_seq(self, session_id: str) -> int:
+        """Sequence number for the next message broadcast to a session"""
+        return self._get(session_id).last + 1
+    
+    def record(self, session_id: str, message: Dict[str, Any]) -> None:
+        """Buffer a sequenced message (unsequenced ones are ignored)"""
+        seq = message.get("seq")
+        if seq is None:
+            return
+        self._get(session_id, origin=seq - 1).append(message)
+    
+    def last_seq(self, session_id: str) -> Optional[int]:
+        log = self._logs.get(session_id)
+        return log.last if log is not None else None
+    
+    def current_seq(self, session_id: str) -> int:
+        """Seq of the last message broadcast to a session (starting its log if needed, so there always is one)"""
+        return self._get(session_id).last
+    
+    def session_ids(self) -> List[str]:
+        return list(self._logs)
+    
+    def forget(self, session_id: str) -> None:
+        """Drop a session's buffer (when its events may stop arriving without gaps)"""
+        self._logs.pop(session_id, None)
+    
+    def replay(self, session_id: str, since: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Buffered messages after a sequence number.
+        
+        Returns:
+            Messages with seq > since in order, or None if some of them are no
+            longer buffered (or since is unknown here) and a snapshot is needed
+        """
+        log = self._logs.get(session_id)
+        events = log.since(since) if log is not None else None
+        if events is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["replays"] += 1
+        self._stats["replayed_events"] += len(events)
+        return events
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._logs),
+            "buffered_events": sum(len(log.events) for log in self._logs.values()),
+            **self._stats,
+        }
+
+# Singleton instance
+event_log = EventLog(
+    max_events=settings.ws_replay_buffer_size,
+    max_sessions=settings.ws_replay_max_sessions
+)
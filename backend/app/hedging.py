@@ -0,0 +1,336 @@
+"""
+Hedged upstream requests
+
+One slow completion holds up a whole session: ZaiClient waits up to
+ollama_timeout before it retries. For the tasks listed in
+settings.hedge_percentiles, an attempt that has not produced its first
+response (the first token of a stream, the whole completion otherwise) within
+that percentile of the model's recent first-response latencies gets a
+duplicate request. Tasks in hedge_fallback_tasks send the duplicate to another
+healthy model of the same tier, the others repeat it on the same model.
+Whichever attempt answers first is used and the other one is cancelled. A
+primary that lost the race still counts towards its model's latencies, with
+the time it had waited until it was cancelled.
+
+Hedges are budgeted two ways: at most hedge_max_share of calls are hedged,
+and the extra spend may reach hedge_spend_ratio of the upstream spend (unused
+budget accumulates up to hedge_max_credit USD). A cancelled request is still
+billed for what the provider processed, so the loser's cost is estimated (its
+prompt, plus for non-streamed calls the winner's output length) and reported
+on the result as hedge_cost.
+
+Race outcomes (hedger stats and the zai_hedges_total metric): "won" / "lost"
+(whether the hedge answered first), "hedge_failed" (the hedge errored and the
+primary answered), "all_failed" (every attempt errored) and "over_budget" (a
+hedge was due but not sent).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+from app.metrics import UPSTREAM_HEDGE_COST, UPSTREAM_HEDGES
+from app.model_config import TaskType, calculate_cost
+from app.model_router import ModelStats, model_router
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Marks the end of an attempt's events
+_END = object()
+
+class HedgeBudget:
+    """Token buckets for the share of hedged calls and their extra spend"""
+    
+    def __init__(self, max_share: float, spend_ratio: float, max_credit: float, burst: float):
+        self.max_share = max_share
+        self.spend_ratio = spend_ratio
+        self.max_credit = max_credit
+        self.burst = max(1.0, burst)
+        self.call_credit = self.burst
+        self.spend_credit = max_credit
+    
+    def on_call(self, cost: float) -> None:
+        """Earn hedge budget from a completed call"""
+        self.call_credit = min(self.burst, self.call_credit + self.max_share)
+        self.spend_credit = min(self.max_credit, self.spend_credit + self.spend_ratio * cost)
+    
+    def admit(self, expected_cost: float) -> bool:
+        """Take budget for one hedge, if there is enough"""
+        if self.call_credit < 1 or expected_cost > self.spend_credit:
+            return False
+        self.call_credit -= 1
+        self.spend_credit -= expected_cost
+        return True
+
+class _Racer:
+    """One attempt running in its own task, its events handed over through a queue"""
+    
+    def __init__(self, model: str, events: AsyncIterator[Dict[str, Any]]):
+        self.model = model
+        self.started = time.perf_counter()
+        self.first_at: Optional[float] = None
+        # Resolves to the first event (or the attempt's error)
+        self.first: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.rest: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._pump(events), name=f"zai-attempt-{model}")
+    
+    async def _pump(self, events: AsyncIterator[Dict[str, Any]]) -> None:
+        try:
+            async for event in events:
+                if not self.first.done():
+                    self.first_at = time.perf_counter()
+                    self.first.set_result(event)
+                else:
+                    self.rest.put_nowait(event)
+            self.rest.put_nowait(_END)
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_exception(e)
+            else:
+                self.rest.put_nowait(e)
+    
+    @property
+    def failed(self) -> bool:
+        return self.first.done() and self.first.exception() is not None
+    
+    async def events(self) -> AsyncIterator[Dict[str, Any]]:
+        """The attempt's events, re-raising its error"""
+        yield self.first.result()
+        while True:
+            item = await self.rest.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    async def cancel(self) -> None:
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        if self.first.done() and not self.first.cancelled():
+            # Retrieve it so an unused error is not logged as never retrieved
+            self.first.exception()
+
+class Hedger:
+    """Per-task hedging policy with learned per-model first-response latency"""
+    
+    def __init__(
+        self,
+        enabled: bool,
+        percentiles: Dict[str, float],
+        fallback_tasks: List[str],
+        min_delay: float,
+        min_samples: int,
+        window: int,
+        window_seconds: float,
+        budget: HedgeBudget
+    ):
+        self.enabled = enabled
+        self.percentiles = percentiles
+        self.fallback_tasks = set(fallback_tasks)
+        self.min_delay = min_delay
+        self.min_samples = max(1, min_samples)
+        self.window = window
+        self.window_seconds = window_seconds
+        self.budget = budget
+        # (model, streamed) -> first-response latencies
+        self._latency: Dict[Tuple[str, bool], ModelStats] = {}
+        self._stats = {
+            "hedged": 0, "won": 0, "lost": 0, "hedge_failed": 0, "all_failed": 0, "over_budget": 0, "extra_cost": 0.0
+        }
+    
+    # =============== POLICY ===============
+    
+    def _window(self, model: str, streamed: bool) -> ModelStats:
+        key = (model, streamed)
+        stats = self._latency.get(key)
+        if stats is None:
+            stats = ModelStats(model, self.window, self.window_seconds)
+            self._latency[key] = stats
+        return stats
+    
+    def delay_for(self, task_type: TaskType, model: str, streamed: bool) -> Optional[float]:
+        """Seconds to wait for a first response before hedging, or None to never hedge"""
+        percentile = self.percentiles.get(task_type.value)
+        if not self.enabled or percentile is None:
+            return None
+        stats = self._window(model, streamed)
+        if stats.count < self.min_samples:
+            return None
+        return max(self.min_delay, stats.latency_percentile(percentile))
+    
+    def hedge_model(self, task_type: TaskType, model: str, allow_fallback: bool) -> str:
+        if allow_fallback and task_type.value in self.fallback_tasks:
+            return model_router.fallback_for(task_type, model) or model
+        return model
+    
+    @staticmethod
+    def loser_cost(model: str, prompt_tokens: int, output_tokens: int) -> float:
+        """Estimated bill for a cancelled attempt"""
+        return calculate_cost(model, prompt_tokens, output_tokens)
+    
+    # =============== RACE ===============
+    
+    async def run(
+        self,
+        task_type: Optional[TaskType],
+        model: str,
+        streamed: bool,
+        start: Callable[[str, bool], AsyncIterator[Dict[str, Any]]],
+        prompt_tokens: int,
+        allow_fallback: bool = True
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Run one upstream attempt, hedged if it is slow to respond.
+        
+        Args:
+            task_type: Task being run (GENERAL when omitted)
+            model: Model of the primary attempt
+            streamed: Whether the attempt streams (first response = first token)
+            start: start(model, is_hedge) opens an attempt against a model,
+                yielding "delta" events and a final "done" event
+            prompt_tokens: Estimated prompt size, for the cost of a cancelled attempt
+            allow_fallback: Whether the hedge may go to another model
+        
+        Yields:
+            The winning attempt's events. Its "done" result carries "hedged"
+            (a duplicate was sent) and "hedge_cost" (estimated cost of the
+            cancelled one).
+        
+        Raises:
+            The primary attempt's error when no attempt succeeds
+        """
+        task_type = task_type or TaskType.GENERAL
+        primary = _Racer(model, start(model, False))
+        racers = [primary]
+        delay = self.delay_for(task_type, model, streamed)
+        try:
+            winner = await self._race(task_type, racers, delay, start, allow_fallback)
+            self._record_latency(primary, winner, streamed)
+            for racer in racers:
+                if racer is not winner:
+                    await racer.cancel()
+            
+            async for event in winner.events():
+                if event["type"] == "done":
+                    result = event["result"]
+                    result["hedged"] = len(racers) > 1
+                    result["hedge_cost"] = self._settle(task_type, racers, winner, result, streamed, prompt_tokens)
+                    self.budget.on_call(result["cost"])
+                yield event
+        finally:
+            for racer in racers:
+                if not racer.task.done():
+                    await racer.cancel()
+    
+    async def _race(
+        self,
+        task_type: TaskType,
+        racers: List[_Racer],
+        delay: Optional[float],
+        start: Callable[[str, bool], AsyncIterator[Dict[str, Any]]],
+        allow_fallback: bool
+    ) -> _Racer:
+        """Wait for the first attempt to respond, hedging the primary once it is overdue"""
+        primary = racers[0]
+        while True:
+            pending = [racer.first for racer in racers if not racer.first.done()]
+            timeout = None
+            if delay is not None and len(racers) == 1:
+                timeout = max(0.0, delay - (time.perf_counter() - primary.started))
+            if pending:
+                await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            
+            for racer in racers:
+                if racer.first.done() and not racer.failed:
+                    return racer
+            if all(racer.failed for racer in racers):
+                if len(racers) > 1:
+                    self._stats["all_failed"] += 1
+                    UPSTREAM_HEDGES.inc(task_type=task_type.value, outcome="all_failed")
+                raise primary.first.exception()
+            
+            if delay is not None and len(racers) == 1 and not primary.first.done():
+                hedge_model = self.hedge_model(task_type, primary.model, allow_fallback)
+                if self.budget.admit(model_router.expected_cost(hedge_model)):
+                    logger.info(
+                        f"Hedging {task_type.value} call to {primary.model} after {delay:.2f}s "
+                        f"with a request to {hedge_model}"
+                    )
+                    self._stats["hedged"] += 1
+                    racers.append(_Racer(hedge_model, start(hedge_model, True)))
+                else:
+                    self._stats["over_budget"] += 1
+                    UPSTREAM_HEDGES.inc(task_type=task_type.value, outcome="over_budget")
+                delay = None
+    
+    def _record_latency(self, primary: _Racer, winner: _Racer, streamed: bool) -> None:
+        """
+        Learn first-response latency from a race.
+        
+        The primary is recorded whoever won. If it had not answered yet, it is
+        recorded with the time it had been waiting when it lost. Otherwise
+        only the fast answers of the hedges that beat it would be kept, and
+        the learned percentile (and with it the hedge delay) would keep
+        shrinking.
+        """
+        if not primary.failed:
+            first_at = primary.first_at if primary.first_at is not None else time.perf_counter()
+            self._window(primary.model, streamed).record_success(first_at - primary.started, 0, 0.0)
+        if winner is not primary:
+            self._window(winner.model, streamed).record_success(winner.first_at - winner.started, 0, 0.0)
+    
+    def _settle(
+        self,
+        task_type: TaskType,
+        racers: List[_Racer],
+        winner: _Racer,
+        result: Dict[str, Any],
+        streamed: bool,
+        prompt_tokens: int
+    ) -> float:
+        """Record a hedged race's outcome and return the estimated cost of the cancelled attempt"""
+        if len(racers) == 1:
+            return 0.0
+        primary, hedge = racers
+        loser = hedge if winner is primary else primary
+        if hedge.failed:
+            outcome = "hedge_failed"
+        else:
+            outcome = "won" if winner is hedge else "lost"
+        extra_cost = 0.0
+        if not loser.failed:
+            extra_cost = self.loser_cost(loser.model, prompt_tokens, 0 if streamed else result["output_tokens"])
+        self._stats[outcome] += 1
+        self._stats["extra_cost"] += extra_cost
+        UPSTREAM_HEDGES.inc(task_type=task_type.value, outcome=outcome)
+        if extra_cost:
+            UPSTREAM_HEDGE_COST.inc(extra_cost, model=loser.model)
+        return extra_cost
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "percentiles": self.percentiles,
+            **{key: round(value, 6) if isinstance(value, float) else value for key, value in self._stats.items()},
+        }
+
+# Singleton instance
+hedger = Hedger(
+    enabled=settings.enable_hedging,
+    percentiles=settings.hedge_percentiles,
+    fallback_tasks=settings.hedge_fallback_tasks,
+    min_delay=settings.hedge_min_delay,
+    min_samples=settings.hedge_min_samples,
+    window=settings.hedge_window,
+    window_seconds=settings.router_window_seconds,
+    budget=HedgeBudget(
+        max_share=settings.hedge_max_share,
+        spend_ratio=settings.hedge_spend_ratio,
+        max_credit=settings.hedge_max_credit,
+        burst=settings.hedge_max_share * settings.hedge_window
+    )
+)
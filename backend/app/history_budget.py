@@ -0,0 +1,163 @@
+"""
+Context-window-aware history budgeting
+
+Before a debate or synthesis prompt is rendered, the debate history is fitted
+to a per-TaskType share of settings.context_window. When the full transcript
+is over budget, the latest rounds stay verbatim and every older round is
+replaced by a rolling summary produced by the free SUMMARIZATION tier.
+
+Summaries are cached on the session (history_summaries: round N -> summary of
+rounds 1..N) and built incrementally: the summary through round N folds the
+new rounds into the cached summary through an earlier round, so each round is
+summarized once per session.
+"""
+
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from app.config import get_settings
+from app.model_config import TaskType
+from app.model_router import model_router
+from app.models import AgentType, RoundOutput, SessionData
+from app.ollama_client import zai_client
+from app.prompts import PromptManager, TranscriptBuilder
+from app.token_estimator import token_estimator
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+class HistoryBudgeter:
+    """Fits debate history to a token budget using cached rolling summaries"""
+    
+    def __init__(self, prompts: PromptManager):
+        self.prompts = prompts
+        self._inflight: Dict[Tuple[UUID, int], asyncio.Task] = {}
+    
+    def budget_for(self, task_type: TaskType) -> int:
+        """History token budget for a task type"""
+        ratio = settings.history_budget_ratios.get(task_type.value, settings.history_budget_default_ratio)
+        return int(settings.context_window * ratio)
+    
+    async def fit(
+        self,
+        session: SessionData,
+        history: List[RoundOutput],
+        task_type: TaskType,
+        transcript: TranscriptBuilder,
+        on_result: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Fit history to the task's budget.
+        
+        Args:
+            session: Session owning the history (summaries are cached on it)
+            history: Outputs the prompt should cover
+            task_type: TaskType of the call being prepared
+            transcript: The session's transcript builder (full-length estimate)
+            on_result: Optional callback(result) for each summarization call,
+                used for cost tracking
+        
+        Returns:
+            {
+                "text": str or None (None = use the full transcript),
+                "full_tokens": int,
+                "budget_tokens": int,
+                "tokens_saved": int,
+                "summarized_through": int (last summarized round, 0 if none)
+            }
+        """
+        budget = self.budget_for(task_type)
+        unchanged = {"text": None, "full_tokens": 0, "budget_tokens": budget, "tokens_saved": 0, "summarized_through": 0}
+        if not settings.enable_history_budget or not history:
+            return unchanged
+        
+        transcript.sync(history)
+        full_tokens = transcript.token_estimate
+        unchanged["full_tokens"] = full_tokens
+        if full_tokens <= budget:
+            return unchanged
+        
+        rounds = sorted({o.round_number for o in history if o.agent != AgentType.SYNTHESIS})
+        verbatim = max(1, settings.history_verbatim_rounds)
+        if len(rounds) <= verbatim:
+            return unchanged
+        first_verbatim = rounds[-verbatim]
+        summarized_through = max(r for r in rounds if r < first_verbatim)
+        
+        try:
+            summary = await self._rolling_summary(session, history, summarized_through, on_result)
+        except Exception as e:
+            logger.warning(f"[{session.session_id}] History summary failed, sending full history: {e}")
+            return unchanged
+        
+        recent = [o for o in history if o.round_number >= first_verbatim and o.agent != AgentType.SYNTHESIS]
+        covered = f"Rounds 1-{summarized_through}" if summarized_through > 1 else "Round 1"
+        parts = [f"--- Summary of {covered} ---\n{summary}\n"]
+        parts.extend(TranscriptBuilder.render_entry(o) for o in recent)
+        text = "\n".join(parts)
+        
+        tokens = TranscriptBuilder.estimate_tokens(text)
+        logger.info(
+            f"[{session.session_id}] History budget ({task_type.value}): {full_tokens} -> {tokens} tokens "
+            f"(budget {budget}, rounds 1-{summarized_through} summarized)"
+        )
+        return {
+            "text": text,
+            "full_tokens": full_tokens,
+            "budget_tokens": budget,
+            "tokens_saved": max(0, full_tokens - tokens),
+            "summarized_through": summarized_through,
+        }
+    
+    async def _rolling_summary(
+        self,
+        session: SessionData,
+        history: List[RoundOutput],
+        through_round: int,
+        on_result: Optional[Callable[[Dict[str, Any]], None]]
+    ) -> str:
+        """Summary of rounds 1..through_round, built on the latest cached summary"""
+        cached = session.history_summaries.get(through_round)
+        if cached is not None:
+            return cached
+        
+        # Concurrent agents needing the same summary share one call
+        key = (session.session_id, through_round)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._summarize(session, history, through_round, on_result))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+    
+    async def _summarize(
+        self,
+        session: SessionData,
+        history: List[RoundOutput],
+        through_round: int,
+        on_result: Optional[Callable[[Dict[str, Any]], None]]
+    ) -> str:
+        previous_round = max((r for r in session.history_summaries if r < through_round), default=0)
+        previous = session.history_summaries.get(previous_round)
+        outputs = [
+            o for o in history
+            if previous_round < o.round_number <= through_round and o.agent != AgentType.SYNTHESIS
+        ]
+        system, prompt = self.prompts.format_history_summary(previous, outputs, settings.history_summary_max_words)
+        
+        model = model_router.route_for_session(session, TaskType.SUMMARIZATION, f"summary through round {through_round}")
+        result = await zai_client.generate(
+            prompt,
+            task_type=TaskType.SUMMARIZATION,
+            model=model,
+            system=system,
+            max_tokens=token_estimator.max_tokens_for("SUMMARY")
+        )
+        if on_result:
+            on_result(result)
+        
+        summary = result["response"].strip()
+        session.history_summaries[through_round] = summary
+        return summary
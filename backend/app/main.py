@@ -1,18 +1,31 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict
+from typing import List, Optional
 from uuid import UUID
 import logging
 import asyncio
+import hashlib
 from datetime import datetime
 
 from app.models import (
     SessionData, SessionState, InitRequest, ClarifyRequest, WSMessage, AgentType
 )
 from app.session_store import session_store
+from app.session_workers import session_workers, PoolFullError, PoolUnavailableError
+from app.recovery import session_recovery
 from app.state_machine import orchestrator
 from app.ollama_client import zai_client
+from app.model_router import model_router
+from app.hedging import hedger
+from app.circuit_breaker import circuit_breakers
+from app.token_estimator import token_estimator
+from app.prompts import PromptManager
 from app.config import get_settings
+from app.metrics import registry as metrics_registry, SESSIONS_FINISHED
+from app.tracing import span, start_trace, merge_into_timeline, timeline_view, export_trace
+from app.ws_hub import ws_hub
+from app.event_log import event_log
+from app.event_bus import event_bus
 
 # Configure logging
 logging.basicConfig(
@@ -31,10 +44,76 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-History-Total"],
 )
 
-# Active WebSocket connections
-active_connections: Dict[str, WebSocket] = {}
+# Live-state gauges, read at scrape time
+metrics_registry.gauge(
+    "websocket_connections_active", "Open WebSocket connections",
+    callback=lambda: ws_hub.connection_count
+)
+metrics_registry.gauge(
+    "websocket_queued_frames", "Frames waiting in WebSocket subscriber send queues",
+    callback=lambda: ws_hub.stats()["queued_frames"]
+)
+metrics_registry.gauge(
+    "session_queue_depth", "Sessions waiting for a worker",
+    callback=lambda: session_workers.queue_depth
+)
+metrics_registry.gauge(
+    "session_workers_busy", "Session workers currently processing a session",
+    callback=lambda: session_workers.stats()["running"]
+)
+metrics_registry.gauge(
+    "zai_scheduler_queued", "Upstream calls waiting for a scheduler slot", ["model"],
+    callback=lambda: {(model,): lane["queued"] for model, lane in zai_client.scheduler.stats().items()}
+)
+metrics_registry.gauge(
+    "zai_scheduler_active", "Upstream calls holding a scheduler slot", ["model"],
+    callback=lambda: {(model,): lane["active"] for model, lane in zai_client.scheduler.stats().items()}
+)
+metrics_registry.gauge(
+    "zai_circuit_state", "Circuit breaker state per model (0 closed, 1 half-open, 2 open)", ["model"],
+    callback=lambda: {
+        (model,): {"closed": 0, "half_open": 1, "open": 2}[breaker["state"]]
+        for model, breaker in circuit_breakers.stats().items()
+    }
+)
+
+# =============== LIFECYCLE ===============
+
+@app.on_event("startup")
+async def on_startup():
+    """Open and pre-warm the shared Z.AI connection pool, start the session workers and event bus, and recover in-flight sessions"""
+    await zai_client.start()
+    await session_workers.start(process_session_background, on_position=broadcast_queue_position)
+    await event_bus.start()
+    session_recovery.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Stop recovery, the event bus and the session workers, close the shared Z.AI connection pool and flush pending session writes"""
+    await session_recovery.stop()
+    await event_bus.stop()
+    await session_workers.stop()
+    await zai_client.close()
+    await session_store.close()
+
+async def admit_session_work(session_id: UUID) -> None:
+    """Refuse new background work when the queue of the session's owning worker cannot take it"""
+    try:
+        await event_bus.admit(session_id)
+    except PoolFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except PoolUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+async def enqueue_session(session_id: UUID) -> Optional[int]:
+    """Queue a session for background processing on its owning worker; returns its queue position there"""
+    try:
+        return await event_bus.submit(session_id)
+    except PoolUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
 # =============== REST ENDPOINTS ===============
 
@@ -47,14 +126,24 @@ async def health_check():
         logger.error(f"Health check failed: {e}")
         zai_healthy = False
     
+    # Models whose calls currently fail fast (or are rerouted)
+    open_circuits = circuit_breakers.open_models()
+    
     return {
-        "status": "healthy" if zai_healthy else "degraded",
+        "status": "healthy" if zai_healthy and not open_circuits else "degraded",
         "backend": "operational",
         "zai_connected": zai_healthy,
         "zai_url": settings.zai_base_url,
-        "max_rounds": settings.max_rounds
+        "max_rounds": settings.max_rounds,
+        "open_circuits": open_circuits,
+        "circuit_breakers": circuit_breakers.stats()
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=metrics_registry.render(), media_type=metrics_registry.CONTENT_TYPE)
+
 @app.get("/api/diagnose")
 async def active_diagnostic():
     """Active health check including inference probe"""
@@ -94,7 +183,63 @@ async def active_diagnostic():
     except Exception as e:
         report["checks"].append({"name": "disk_space", "status": "fail", "error": str(e)})
 
-    # 3. Cost Tracking Status
+    # 3. Response Cache
+    if zai_client.response_cache is not None:
+        report["checks"].append({
+            "name": "response_cache",
+            "status": "enabled",
+            **zai_client.response_cache.stats()
+        })
+    else:
+        report["checks"].append({"name": "response_cache", "status": "disabled"})
+
+    # 4. Upstream Scheduler
+    report["checks"].append({
+        "name": "upstream_scheduler",
+        "status": "enabled" if zai_client.scheduler.enabled else "disabled",
+        "models": zai_client.scheduler.stats()
+    })
+    report["checks"].append({
+        "name": "model_router",
+        "status": "enabled" if model_router.enabled else "disabled",
+        **model_router.stats()
+    })
+    report["checks"].append({
+        "name": "hedging",
+        "status": "enabled" if hedger.enabled else "disabled",
+        **hedger.stats()
+    })
+    report["checks"].append({
+        "name": "token_estimator",
+        "status": "pass",
+        "system_prompt_tokens": PromptManager.TEMPLATE_TOKENS,
+        **token_estimator.stats()
+    })
+
+    # 5. Session Workers
+    report["checks"].append({
+        "name": "session_workers",
+        "status": "pass" if session_workers.stats()["accepting"] else "fail",
+        **session_workers.stats()
+    })
+
+    # 6. Crash Recovery
+    report["checks"].append({"name": "session_recovery", **session_recovery.report})
+
+    # 7. Upstream Cassette
+    if zai_client.cassette is not None:
+        report["checks"].append({"name": "zai_cassette", "status": "enabled", **zai_client.cassette.stats()})
+    else:
+        report["checks"].append({"name": "zai_cassette", "status": "disabled"})
+
+    # 8. WebSocket Hub
+    report["checks"].append({"name": "websocket_hub", "status": "pass", **ws_hub.stats()})
+    report["checks"].append({"name": "ws_replay_buffer", "status": "pass", **event_log.stats()})
+
+    # 9. Event Bus
+    report["checks"].append({"name": "event_bus", "status": "pass", **event_bus.stats()})
+
+    # 10. Cost Tracking Status
     try:
         report["checks"].append({
             "name": "cost_tracking",
@@ -107,33 +252,36 @@ async def active_diagnostic():
     return report
 
 @app.post("/api/chat/init")
-async def init_session(request: InitRequest, background_tasks: BackgroundTasks):
+async def init_session(request: InitRequest):
     """
     Initialize new session
-    Returns: session_id and triggers background clarification generation
+    Returns: session_id and queues background clarification generation
+    (429/503 with Retry-After when the session queue is full)
     """
-    # Create session
+    # Create session (its id decides which worker processes it)
     session = SessionData(
         original_user_prompt=request.message,
         max_rounds=settings.max_rounds
     )
+    await admit_session_work(session.session_id)
     await session_store.save(session)
     
     logger.info(f"Session {session.session_id} created")
     
-    # Start background processing
-    background_tasks.add_task(process_session_background, session.session_id)
+    # Queue background processing
+    position = await enqueue_session(session.session_id)
     
     return {
         "session_id": str(session.session_id),
-        "status": session.state.value
+        "status": session.state.value,
+        "queue_position": position
     }
 
 @app.post("/api/chat/clarify")
-async def submit_clarification(request: ClarifyRequest, background_tasks: BackgroundTasks):
+async def submit_clarification(request: ClarifyRequest):
     """
     Submit clarification answers
-    Triggers background debate processing
+    Queues background debate processing (429/503 with Retry-After when the session queue is full)
     """
     # Load session
     session = await session_store.load(request.session_id)
@@ -143,6 +291,8 @@ async def submit_clarification(request: ClarifyRequest, background_tasks: Backgr
     if session.state != SessionState.CLARIFICATION_PENDING:
         raise HTTPException(status_code=400, detail=f"Invalid state: {session.state}")
     
+    await admit_session_work(session.session_id)
+    
     # Update session
     session.clarification_answers = request.answers
     session.state = SessionState.CLARIFICATION_COMPLETE
@@ -150,19 +300,106 @@ async def submit_clarification(request: ClarifyRequest, background_tasks: Backgr
     
     logger.info(f"Session {session.session_id} clarification received")
     
-    # Start background processing
-    background_tasks.add_task(process_session_background, session.session_id)
+    # Queue background processing
+    position = await enqueue_session(session.session_id)
     
-    return {"status": "processing_started"}
+    return {"status": "processing_started", "queue_position": position}
+
+def session_etag(version: int, request: Request) -> str:
+    """Weak ETag of one representation of a session (version + projection/page parameters)"""
+    if not request.query_params:
+        return f'W/"{version}"'
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f'W/"{version}-{hashlib.blake2b(query.encode(), digest_size=6).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison: W/"x" and "x" match
+    return "*" in candidates or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in candidates)
+
+# Left out of GET /api/chat/{id} unless named in fields= (they only grow; the
+# timeline has its own endpoint, history_budget_calls is inside cost_tracking)
+DIAGNOSTIC_FIELDS = {"timeline": True, "history_summaries": True, "model_reasoning": True}
+DIAGNOSTIC_COST_FIELDS = {"history_budget_calls"}
 
 @app.get("/api/chat/{session_id}")
-async def get_session(session_id: UUID):
-    """Get current session state"""
+async def get_session(
+    session_id: UUID,
+    request: Request,
+    fields: Optional[str] = None,
+    agent: Optional[AgentType] = None,
+    round_from: Optional[int] = None,
+    round_to: Optional[int] = None,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1)
+):
+    """
+    Get current session state
+    
+    Query parameters (all optional):
+        fields: Comma-separated SessionData fields to return, e.g. "state,cost_tracking".
+            Without it, the diagnostic fields (timeline, history_summaries,
+            model_reasoning, cost_tracking.history_budget_calls) are left out;
+            name them to get them.
+        agent, round_from, round_to: Only history outputs of that agent / round range
+        offset, limit: Page of the (filtered) history; the total is in X-History-Total
+    
+    Responses carry an ETag derived from the session version; send it back in
+    If-None-Match to get 304 Not Modified while the session is unchanged
+    (answered without loading the session when it is cached).
+    """
+    include = None
+    if fields:
+        include = {name.strip() for name in fields.split(",") if name.strip()}
+        unknown = include - set(SessionData.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    
+    if_none_match = request.headers.get("if-none-match")
+    version = session_store.cached_version(session_id)
+    if version is not None and etag_matches(if_none_match, session_etag(version, request)):
+        return Response(status_code=304, headers={"ETag": session_etag(version, request)})
+    
     session = await session_store.load(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    return session
+    etag = session_etag(session.version, request)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    if include is None or "history" in include:
+        history = [
+            output for output in session.history
+            if (agent is None or output.agent == agent)
+            and (round_from is None or output.round_number >= round_from)
+            and (round_to is None or output.round_number <= round_to)
+        ]
+        headers["X-History-Total"] = str(len(history))
+        history = history[offset:offset + limit] if limit is not None else history[offset:]
+        if len(history) != len(session.history):
+            session = session.model_copy(update={"history": history})
+    
+    exclude = None
+    if include is None:
+        exclude = {**DIAGNOSTIC_FIELDS, "cost_tracking": DIAGNOSTIC_COST_FIELDS}
+    return Response(
+        content=session.model_dump_json(include=include, exclude=exclude),
+        media_type="application/json",
+        headers=headers
+    )
+
+@app.get("/api/chat/{session_id}/timeline")
+async def get_session_timeline(session_id: UUID):
+    """Span timeline of a session's processing (waterfall-ready, times in ms since session creation)"""
+    session = await session_store.load(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    return timeline_view(session.session_id, session.created_at, session.timeline)
 
 @app.get("/api/chat/{session_id}/costs")
 async def get_session_costs(session_id: UUID):
@@ -175,6 +412,9 @@ async def get_session_costs(session_id: UUID):
         "session_id": str(session.session_id),
         "total_cost": session.cost_tracking.total_cost,
         "total_input_tokens": session.cost_tracking.total_input_tokens,
+        "total_cached_tokens": session.cost_tracking.total_cached_tokens,
+        "total_hedge_cost": session.cost_tracking.total_hedge_cost,
+        "hedged_calls": session.cost_tracking.hedged_calls,
         "total_output_tokens": session.cost_tracking.total_output_tokens,
         "model_costs": session.cost_tracking.model_costs,
         "state": session.state,
@@ -185,76 +425,140 @@ async def get_session_costs(session_id: UUID):
 # =============== WEBSOCKET ===============
 
 @app.websocket("/api/ws/{session_id}")
-async def websocket_endpoint(websocket: WebSocket, session_id: str):
+async def websocket_endpoint(websocket: WebSocket, session_id: str, since: Optional[int] = None):
     """
     WebSocket connection for real-time updates
     Streams: state changes, agent outputs, synthesis
+    (any number of connections per session; each has its own send queue)
+    
+    Every message carries the session's sequence number (seq). A client that
+    reconnects with ?since=<last seq seen> is sent only the messages it missed;
+    otherwise (or if they are no longer buffered) it gets a snapshot of the
+    session. Either way a "sync" message comes first, with the seq the stream
+    continues from and content "resumed" or "snapshot".
+    
+    Any worker process can serve the connection: a snapshot's seq comes from
+    the session's owner (event_bus.checkpoint), and a non-owner only replays
+    from a log it has been receiving without gaps (see app.event_bus).
     """
     await websocket.accept()
-    active_connections[session_id] = websocket
+    # Hold live messages until the catch-up frames are queued in front of them
+    subscriber = ws_hub.subscribe(session_id, websocket, hold=True)
     
-    logger.info(f"WebSocket connected for session {session_id}")
+    logger.info(
+        f"WebSocket connected for session {session_id} "
+        f"({ws_hub.subscriber_count(session_id)} subscribers, since={since})"
+    )
     
     try:
-        # Send initial state
         # Convert string to UUID for session_store operations
         session_id_uuid = UUID(session_id)
-        session = await session_store.load(session_id_uuid)
-        if session:
-            await websocket.send_json(WSMessage(
-                type="state_change",
-                session_id=session_id_uuid,
-                state=session.state
-            ).model_dump(mode='json'))
-            
-            # If clarification ready, send it
-            if session.clarification_questions:
-                await websocket.send_json(WSMessage(
-                    type="agent_output",
-                    session_id=session_id_uuid,
-                    agent=AgentType.CLARIFICATION,
-                    content=session.clarification_questions
-                ).model_dump(mode='json'))
-            
-            # If clarification ready, send it
-            if session.clarification_questions:
-                await websocket.send_json(WSMessage(
-                    type="agent_output",
-                    session_id=session_id_uuid,
-                    agent=AgentType.CLARIFICATION,
-                    content=session.clarification_questions
-                ).model_dump(mode='json'))
+        replayed = event_log.replay(session_id, since) if since is not None else None
+        if replayed is not None and len(replayed) <= ws_hub.max_queue // 2:
+            ws_hub.release(subscriber, [
+                WSMessage(type="sync", session_id=session_id_uuid, content="resumed", seq=since).model_dump(mode='json'),
+                *replayed
+            ])
+        else:
+            # Taken before the load: messages published while it is in flight may
+            # be missing from the loaded session, so they are sent after it
+            snapshot_seq = await event_bus.checkpoint(session_id_uuid)
+            session = await session_store.load(session_id_uuid)
+            frames = [WSMessage(type="sync", session_id=session_id_uuid, content="snapshot", seq=snapshot_seq)]
+            if session:
+                frames.extend(session_snapshot(session))
+            ws_hub.release(subscriber, [frame.model_dump(mode='json') for frame in frames], after_seq=snapshot_seq)
         
         # Keep connection alive
         while True:
             data = await websocket.receive_text()
             # Echo pings
             if data == "ping":
-                await websocket.send_text("pong")
+                ws_hub.send(subscriber, text="pong")
                 
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for session {session_id}")
     finally:
-        if session_id in active_connections:
-            del active_connections[session_id]
+        await ws_hub.unsubscribe(subscriber)
+
+def session_snapshot(session: SessionData) -> List[WSMessage]:
+    """Messages that bring a client with no prior state up to date with a session (state last, so it wins)"""
+    frames = []
+    
+    if session.clarification_questions:
+        frames.append(WSMessage(
+            type="agent_output",
+            session_id=session.session_id,
+            agent=AgentType.CLARIFICATION,
+            content=session.clarification_questions
+        ))
+    
+    for output in session.history:
+        frames.append(WSMessage(
+            type="synthesis" if output.agent == AgentType.SYNTHESIS else "agent_output",
+            session_id=session.session_id,
+            round=output.round_number,
+            agent=output.agent,
+            content=output.content
+        ))
+    
+    if session.state == SessionState.ERROR and session.error_message:
+        frames.append(WSMessage(type="error", session_id=session.session_id, content=session.error_message))
+    
+    frames.append(WSMessage(type="state_change", session_id=session.session_id, state=session.state))
+    
+    # If still waiting for a worker, tell the client where it stands
+    position = session_workers.position(session.session_id)
+    if position:
+        frames.append(WSMessage(type="queue_position", session_id=session.session_id, position=position))
+    return frames
 
 async def broadcast_to_session(session_id: UUID, message: WSMessage):
-    """Send message to WebSocket if connected"""
-    # Convert UUID to string for dictionary lookup (WebSocket stores str keys)
+    """Queue a message for every WebSocket subscribed to the session, in any worker (never waits on the network)"""
+    # Convert UUID to string for hub lookup (WebSocket paths carry str ids)
     sid = str(session_id)
-    if sid in active_connections:
-        try:
-            await active_connections[sid].send_json(message.model_dump(mode='json'))
-        except Exception as e:
-            logger.error(f"Failed to broadcast to {session_id}", exc_info=True)
+    message.seq = event_log.next_seq(sid)
+    if message.type == "agent_delta":
+        # Token deltas are too frequent to trace individually
+        await event_bus.publish(sid, message.model_dump(mode='json'))
+    else:
+        with span("ws.publish", type=message.type, seq=message.seq, local_subscribers=ws_hub.subscriber_count(sid)):
+            await event_bus.publish(sid, message.model_dump(mode='json'))
+
+async def broadcast_queue_position(session_id: UUID, position: int):
+    """Tell a waiting session's client its current place in the session queue"""
+    await broadcast_to_session(session_id, WSMessage(
+        type="queue_position",
+        session_id=session_id,
+        position=position
+    ))
 
 # =============== BACKGROUND PROCESSING ===============
 
 async def process_session_background(session_id: UUID):
     """
-    Background task to process session through state machine
-    Broadcasts updates via WebSocket
+    Background job (run by a session worker) to process session through state machine
+    Broadcasts updates via WebSocket; the run is traced into the session timeline
     """
+    with start_trace(session_id) as trace:
+        with span("session.run"):
+            await run_session(session_id)
+    if trace is not None:
+        await save_trace(session_id, trace)
+
+async def save_trace(session_id: UUID, trace):
+    """Append a finished run's spans to the session timeline (and the OTLP export file)"""
+    try:
+        session = await session_store.load(session_id)
+        if session is not None and trace.rows:
+            merge_into_timeline(session.timeline, trace, session.created_at)
+            await session_store.save(session)
+        await export_trace(trace)
+    except Exception as e:
+        logger.error(f"[{session_id}] Failed to save timeline: {e}")
+
+async def run_session(session_id: UUID):
+    """Drive a session through the state machine until it completes, fails or needs user input"""
     try:
         session = await session_store.load(session_id)
         if not session:
@@ -263,6 +567,17 @@ async def process_session_background(session_id: UUID):
         
         logger.info(f"[{session_id}] Background processing started, state: {session.state}")
         
+        # Forward streamed token deltas as incremental frames; the complete
+        # output still follows as an agent_output/synthesis message
+        async def broadcast_delta(round_number, agent, delta):
+            await broadcast_to_session(session_id, WSMessage(
+                type="agent_delta",
+                session_id=session_id,
+                round=round_number,
+                agent=agent,
+                content=delta
+            ))
+        
         # State machine loop
         while session.state not in [SessionState.COMPLETE, SessionState.ERROR]:
             
@@ -295,7 +610,9 @@ async def process_session_background(session_id: UUID):
                     ))
                 
                 # Start processing with callback - all rounds and synthesis will broadcast immediately
-                session = await orchestrator.process_clarification(session, on_output=broadcast_output)
+                session = await orchestrator.process_clarification(
+                    session, on_output=broadcast_output, on_delta=broadcast_delta
+                )
                 
             elif session.state == SessionState.ROUND_PROCESSING:
                 # Create broadcast callback for real-time output updates
@@ -309,7 +626,9 @@ async def process_session_background(session_id: UUID):
                         content=output.content
                     ))
                 
-                session = await orchestrator.process_round(session, on_output=broadcast_output)
+                session = await orchestrator.process_round(
+                    session, on_output=broadcast_output, on_delta=broadcast_delta
+                )
                 
             elif session.state == SessionState.SYNTHESIS_PROCESSING:
                 # Create broadcast callback
@@ -320,7 +639,9 @@ async def process_session_background(session_id: UUID):
                         content=output.content
                     ))
                 
-                session = await orchestrator.process_synthesis(session, on_output=broadcast_output)
+                session = await orchestrator.process_synthesis(
+                    session, on_output=broadcast_output, on_delta=broadcast_delta
+                )
             
             # Broadcast state change
             await broadcast_to_session(session_id, WSMessage(
@@ -329,10 +650,12 @@ async def process_session_background(session_id: UUID):
                 state=session.state
             ))
         
+        SESSIONS_FINISHED.inc(state=session.state.value)
         logger.info(f"[{session_id}] Background processing complete, final state: {session.state}")
         
     except Exception as e:
         logger.error(f"[{session_id}] Background processing failed: {e}", exc_info=True)
+        SESSIONS_FINISHED.inc(state=SessionState.ERROR.value)
         
         # Update session to ERROR state
         try:
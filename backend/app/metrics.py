@@ -0,0 +1,330 @@
+"""
+In-process Prometheus metrics
+
+A minimal implementation of counters, gauges and histograms rendered in the
+Prometheus text exposition format (served at GET /metrics), so the backend
+can be scraped without extra dependencies or services.
+
+Everything is updated from the event loop thread with plain integer/float
+arithmetic: no locks, no I/O, no allocation beyond the first observation of a
+label set. Gauges that mirror live state (WebSocket count, queue depth) are
+read through callbacks at scrape time instead of being updated on every
+change.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Default latency buckets (seconds), from fast cache hits to long premium generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+# Buckets for fast local operations (session store)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Output token throughput buckets (tokens/second)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """Base class: a named metric family with fixed label names"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+    
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+    
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+    
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """Monotonically increasing count per label set"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+class Gauge(Metric):
+    """
+    Point-in-time value per label set.
+    
+    Either set explicitly, or computed at scrape time by a callback returning
+    {label values tuple: value} (or a plain number for unlabeled gauges).
+    """
+    
+    kind = "gauge"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], object]] = None
+    ):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+    
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+    
+    def samples(self) -> List[str]:
+        values = self._values
+        if self.callback is not None:
+            current = self.callback()
+            values = current if isinstance(current, dict) else {(): current}
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram per label set"""
+    
+    kind = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+    
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = [0] * (len(self.buckets) + 1) + [0.0]
+            self._values[key] = state
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+    
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the wall time of a block (including awaits inside it)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Collection of metric families rendered together"""
+    
+    CONTENT_TYPE = "text/plain; version=0.0.4"  # the response adds charset=utf-8
+    
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+    
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+    
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], object]] = None
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, callback))
+    
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+    
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+    
+    def render(self) -> str:
+        """Prometheus text exposition of every registered metric"""
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # A failing gauge callback must not break the whole scrape
+                lines.append(f"# {metric.name} unavailable: {_escape(str(e))}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+# =============== UPSTREAM (Z.AI) ===============
+
+UPSTREAM_REQUEST_DURATION = registry.histogram(
+    "zai_request_duration_seconds",
+    "End-to-end duration of generate calls, including retries and queueing",
+    ["model", "task_type"]
+)
+UPSTREAM_ATTEMPT_DURATION = registry.histogram(
+    "zai_attempt_duration_seconds",
+    "Duration of individual upstream HTTP attempts",
+    ["model", "task_type"]
+)
+UPSTREAM_TIME_TO_FIRST_TOKEN = registry.histogram(
+    "zai_time_to_first_token_seconds",
+    "Time from request start to the first streamed content delta",
+    ["model", "task_type"]
+)
+UPSTREAM_QUEUE_WAIT = registry.histogram(
+    "zai_queue_wait_seconds",
+    "Time spent waiting for an upstream scheduler slot",
+    ["model"]
+)
+UPSTREAM_RESPONSES = registry.counter(
+    "zai_responses_total",
+    "Upstream attempts by outcome (HTTP status code, 'timeout' or 'error')",
+    ["model", "status"]
+)
+UPSTREAM_RETRIES = registry.counter(
+    "zai_retries_total",
+    "Upstream attempts beyond the first",
+    ["model", "task_type"]
+)
+UPSTREAM_TOKENS = registry.counter(
+    "zai_tokens_total",
+    "Tokens billed by the upstream API (cached_input: part of input served from the prefix cache)",
+    ["model", "direction"]
+)
+UPSTREAM_TOKENS_PER_SECOND = registry.histogram(
+    "zai_output_tokens_per_second",
+    "Output token throughput of successful attempts",
+    ["model"],
+    buckets=THROUGHPUT_BUCKETS
+)
+UPSTREAM_CACHE_HITS = registry.counter(
+    "zai_response_cache_hits_total",
+    "Generate calls served from the response cache",
+    ["task_type"]
+)
+UPSTREAM_HEDGES = registry.counter(
+    "zai_hedges_total",
+    "Hedged attempts by outcome (won/lost: whether the duplicate answered first, hedge_failed: the duplicate "
+    "errored, all_failed: every attempt errored, over_budget: not sent)",
+    ["task_type", "outcome"]
+)
+UPSTREAM_HEDGE_COST = registry.counter(
+    "zai_hedge_cost_usd_total",
+    "Estimated cost of attempts cancelled after losing a hedge race",
+    ["model"]
+)
+CIRCUIT_TRANSITIONS = registry.counter(
+    "zai_circuit_transitions_total",
+    "Circuit breaker state changes by the state entered",
+    ["model", "state"]
+)
+CIRCUIT_REJECTIONS = registry.counter(
+    "zai_circuit_rejections_total",
+    "Upstream attempts refused because the model's circuit was open",
+    ["model"]
+)
+UPSTREAM_PREFLIGHT = registry.counter(
+    "zai_preflight_adjustments_total",
+    "Requests changed before sending to fit the context window (max_tokens_lowered, trimmed, rejected)",
+    ["model", "action"]
+)
+MODEL_ROUTE_DECISIONS = registry.counter(
+    "model_route_decisions_total",
+    "Models chosen by the adaptive model router",
+    ["task_type", "model"]
+)
+
+# =============== ORCHESTRATOR ===============
+
+PHASE_DURATION = registry.histogram(
+    "orchestrator_phase_duration_seconds",
+    "Duration of orchestrator phases (round = one debate round, excluding later rounds)",
+    ["phase"]
+)
+SESSIONS_FINISHED = registry.counter(
+    "sessions_finished_total",
+    "Sessions reaching a terminal state",
+    ["state"]
+)
+
+# =============== SESSION STORE ===============
+
+STORE_OPERATION_DURATION = registry.histogram(
+    "session_store_operation_duration_seconds",
+    "Session store latency (save/load as seen by callers, write/read at the backend)",
+    ["operation", "backend"],
+    buckets=FAST_BUCKETS
+)
+
+# =============== WEBSOCKET ===============
+
+WS_FRAMES_COALESCED = registry.counter(
+    "websocket_frames_coalesced_total",
+    "Queued WebSocket frames merged into or replaced by a newer frame for a slow subscriber"
+)
+WS_SUBSCRIBERS_DROPPED = registry.counter(
+    "websocket_subscribers_dropped_total",
+    "WebSocket subscribers disconnected for falling behind",
+    ["reason"]
+)
@@ -23,14 +23,18 @@ class TaskType(str, Enum):
     CODE = "CODE"
     CREATIVE = "CREATIVE"
     GENERAL = "GENERAL"
+    SUMMARIZATION = "SUMMARIZATION"
 
 # Task-specific model routing configuration
+# max_concurrency / rpm: upstream scheduler limits for the model (see upstream_scheduler.py)
 TASK_MODEL_MAPPING = {
     TaskType.CLARIFICATION: {
         "model": "glm-4.7-flash",
         "tier": ModelTier.FREE,
         "input_cost": 0.0,
         "output_cost": 0.0,
+        "max_concurrency": 5,
+        "rpm": 60,
         "reason": "Free model for initial questions and context gathering"
     },
     TaskType.DEBATE: {
@@ -38,6 +42,8 @@ TASK_MODEL_MAPPING = {
         "tier": ModelTier.CHEAP,
         "input_cost": 0.1,
         "output_cost": 0.1,
+        "max_concurrency": 20,
+        "rpm": 300,
         "reason": "Extremely cheap model for reasoning rounds ($0.10 per 1M tokens)"
     },
     TaskType.SYNTHESIS: {
@@ -45,6 +51,8 @@ TASK_MODEL_MAPPING = {
         "tier": ModelTier.PREMIUM,
         "input_cost": 0.6,
         "output_cost": 2.2,
+        "max_concurrency": 10,
+        "rpm": 120,
         "reason": "Premium model for highest quality final output"
     },
     TaskType.CODE: {
@@ -52,6 +60,8 @@ TASK_MODEL_MAPPING = {
         "tier": ModelTier.STANDARD,
         "input_cost": 0.6,
         "output_cost": 2.2,
+        "max_concurrency": 10,
+        "rpm": 120,
         "reason": "Standard model optimized for coding tasks"
     },
     TaskType.CREATIVE: {
@@ -59,6 +69,8 @@ TASK_MODEL_MAPPING = {
         "tier": ModelTier.STANDARD,
         "input_cost": 0.6,
         "output_cost": 2.2,
+        "max_concurrency": 10,
+        "rpm": 120,
         "reason": "Standard model for creative writing and brainstorming"
     },
     TaskType.GENERAL: {
@@ -66,11 +78,25 @@ TASK_MODEL_MAPPING = {
         "tier": ModelTier.CHEAP,
         "input_cost": 0.07,
         "output_cost": 0.4,
+        "max_concurrency": 20,
+        "rpm": 300,
         "reason": "Balanced cheap model for general tasks"
+    },
+    TaskType.SUMMARIZATION: {
+        "model": "glm-4.7-flash",
+        "tier": ModelTier.FREE,
+        "input_cost": 0.0,
+        "output_cost": 0.0,
+        "max_concurrency": 5,
+        "rpm": 60,
+        "reason": "Free model for rolling summaries of older debate rounds"
     }
 }
 
-# Complete pricing catalog for all GLM models
+# Context window (input + output tokens) for models missing from the catalog
+DEFAULT_CONTEXT_WINDOW = 128_000
+
+# Complete pricing catalog for all GLM models (context_window: input + output tokens)
 PRICING_CATALOG = {
     "text": {
         "glm-4.7": {
@@ -78,98 +104,112 @@ PRICING_CATALOG = {
             "output": 2.2,
             "cached_input": 0.11,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.PREMIUM
+            "tier": ModelTier.PREMIUM,
+            "context_window": 200000
         },
         "glm-4.7-flashx": {
             "input": 0.07,
             "output": 0.4,
             "cached_input": 0.01,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.CHEAP
+            "tier": ModelTier.CHEAP,
+            "context_window": 200000
         },
         "glm-4.6": {
             "input": 0.6,
             "output": 2.2,
             "cached_input": 0.11,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.STANDARD
+            "tier": ModelTier.STANDARD,
+            "context_window": 200000
         },
         "glm-4.6v": {
             "input": 0.3,
             "output": 0.9,
             "cached_input": 0.05,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.STANDARD
+            "tier": ModelTier.STANDARD,
+            "context_window": 128000
         },
         "glm-4.6v-flashx": {
             "input": 0.04,
             "output": 0.4,
             "cached_input": 0.004,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.CHEAP
+            "tier": ModelTier.CHEAP,
+            "context_window": 128000
         },
         "glm-4.5": {
             "input": 0.6,
             "output": 2.2,
             "cached_input": 0.11,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.STANDARD
+            "tier": ModelTier.STANDARD,
+            "context_window": 128000
         },
         "glm-4.5v": {
             "input": 0.6,
             "output": 1.8,
             "cached_input": 0.11,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.STANDARD
+            "tier": ModelTier.STANDARD,
+            "context_window": 64000
         },
         "glm-4.5-x": {
             "input": 2.2,
             "output": 8.9,
             "cached_input": 0.45,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.PREMIUM
+            "tier": ModelTier.PREMIUM,
+            "context_window": 128000
         },
         "glm-4.5-air": {
             "input": 0.2,
             "output": 1.1,
             "cached_input": 0.03,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.CHEAP
+            "tier": ModelTier.CHEAP,
+            "context_window": 128000
         },
         "glm-4.5-airx": {
             "input": 1.1,
             "output": 4.5,
             "cached_input": 0.22,
             "cached_storage": "Limited-time Free",
-            "tier": ModelTier.PREMIUM
+            "tier": ModelTier.PREMIUM,
+            "context_window": 128000
         },
         "glm-4-32b-0414-128k": {
             "input": 0.1,
             "output": 0.1,
             "cached_input": 0.0,
             "cached_storage": "-",
-            "tier": ModelTier.CHEAP
+            "tier": ModelTier.CHEAP,
+            "context_window": 128000
         },
         "glm-4.7-flash": {
             "input": 0.0,
             "output": 0.0,
             "cached_input": 0.0,
             "cached_storage": "Free",
-            "tier": ModelTier.FREE
+            "tier": ModelTier.FREE,
+            "context_window": 200000
         },
         "glm-4.6v-flash": {
             "input": 0.0,
             "output": 0.0,
             "cached_input": 0.0,
             "cached_storage": "Free",
-            "tier": ModelTier.FREE
+            "tier": ModelTier.FREE,
+            "context_window": 128000
         },
         "glm-4.5-flash": {
             "input": 0.0,
             "output": 0.0,
             "cached_input": 0.0,
             "cached_storage": "Free",
-            "tier": ModelTier.FREE
+            "tier": ModelTier.FREE,
+            "context_window": 128000
         }
     },
     "image": {
@@ -227,14 +267,16 @@ def get_model_for_task(task: TaskType) -> Dict[str, Any]:
     """
     return TASK_MODEL_MAPPING.get(task, TASK_MODEL_MAPPING[TaskType.GENERAL])
 
-def calculate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+def calculate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
     """
     Calculate the cost of an API call.
     
     Args:
         model: Model identifier
-        input_tokens: Number of input tokens
+        input_tokens: Number of input tokens (including cached ones)
         output_tokens: Number of output tokens
+        cached_tokens: Input tokens served from the provider's prefix cache,
+            billed at the model's cached_input price
         
     Returns:
         Total cost in USD
@@ -246,9 +288,15 @@ def calculate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
     
     input_cost = model_info.get("input", 0.0)
     output_cost = model_info.get("output", 0.0)
+    cached_input_cost = model_info.get("cached_input", input_cost)
+    cached_tokens = min(max(cached_tokens, 0), input_tokens)
     
     # Prices are per 1M tokens
-    total_cost = (input_tokens / 1_000_000) * input_cost + (output_tokens / 1_000_000) * output_cost
+    total_cost = (
+        ((input_tokens - cached_tokens) / 1_000_000) * input_cost
+        + (cached_tokens / 1_000_000) * cached_input_cost
+        + (output_tokens / 1_000_000) * output_cost
+    )
     
     return round(total_cost, 6)
 
@@ -264,6 +312,19 @@ def get_model_info(model: str) -> Optional[Dict[str, Any]]:
     """
     return PRICING_CATALOG.get("text", {}).get(model)
 
+def get_context_window(model: str) -> int:
+    """
+    Get a model's context window (prompt and completion tokens together).
+    
+    Args:
+        model: Model identifier
+        
+    Returns:
+        Context window in tokens (DEFAULT_CONTEXT_WINDOW for unknown models)
+    """
+    model_info = PRICING_CATALOG.get("text", {}).get(model) or {}
+    return model_info.get("context_window", DEFAULT_CONTEXT_WINDOW)
+
 def list_models_by_tier(tier: ModelTier) -> list:
     """
     List all models of a specific pricing tier.
@@ -0,0 +1,323 @@
+"""
+Adaptive model routing for upstream calls
+
+TASK_MODEL_MAPPING names one model per TaskType. The router keeps that model
+as the default but tracks live rolling statistics for every model it sends
+calls to (latency percentiles, error rate, cost per output token) and moves a
+task to another eligible model when the default stops meeting the task's
+latency SLO, fails too often, or does not fit the session's remaining budget.
+
+Eligible models for a task are those of its allowed ModelTiers
+(settings.router_tiers, default: the tier of the task's default model),
+minus settings.router_excluded_models and models whose circuit breaker is
+open (unless every eligible model's is). Selection, per call:
+
+    1. the default model, if it is healthy (p95 within the SLO and error rate
+       below the limit) and its expected call cost fits the budget
+    2. otherwise the cheapest healthy model that fits the budget (models
+       without enough samples yet count as healthy)
+    3. otherwise the model with the lowest p95 latency that fits the budget
+    4. with nothing inside the budget, the cheapest eligible model
+
+Statistics only cover the last router_window calls and expire after
+router_window_seconds, so a model that was routed around gets tried
+again once its bad samples age out.
+
+Every decision is counted in the model_route_decisions metric and, for
+session calls, recorded as a "model.route" span in the session timeline;
+session.model_reasoning only keeps the calls routed away from the default.
+"""
+
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.circuit_breaker import circuit_breakers
+from app.config import get_settings
+from app.metrics import MODEL_ROUTE_DECISIONS
+from app.model_config import ModelTier, TaskType, get_model_for_task, get_model_info, list_models_by_tier
+from app.models import SessionData
+from app.tracing import span
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Nominal call size (input, output tokens) for cost estimates before any calls are observed
+NOMINAL_CALL_TOKENS = (2000, 500)
+
+class ModelStats:
+    """Rolling window of call outcomes for one model"""
+    
+    def __init__(self, model: str, window: int, window_seconds: float):
+        self.model = model
+        self.window_seconds = window_seconds
+        # (finished_at, latency_s or None on failure, output_tokens, cost)
+        self._samples: Deque[Tuple[float, Optional[float], int, float]] = deque(maxlen=max(1, window))
+    
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.window_seconds
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+    
+    def record_success(self, latency_s: float, output_tokens: int, cost: float) -> None:
+        self._samples.append((time.monotonic(), latency_s, output_tokens, cost))
+    
+    def record_failure(self) -> None:
+        self._samples.append((time.monotonic(), None, 0, 0.0))
+    
+    @property
+    def count(self) -> int:
+        self._expire()
+        return len(self._samples)
+    
+    def _latencies(self) -> List[float]:
+        self._expire()
+        return sorted(s[1] for s in self._samples if s[1] is not None)
+    
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        latencies = self._latencies()
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(percentile / 100 * len(latencies)))]
+    
+    @property
+    def error_rate(self) -> float:
+        self._expire()
+        if not self._samples:
+            return 0.0
+        return sum(1 for s in self._samples if s[1] is None) / len(self._samples)
+    
+    @property
+    def cost_per_output_token(self) -> Optional[float]:
+        self._expire()
+        tokens = sum(s[2] for s in self._samples if s[1] is not None)
+        if not tokens:
+            return None
+        return sum(s[3] for s in self._samples if s[1] is not None) / tokens
+    
+    @property
+    def mean_call_cost(self) -> Optional[float]:
+        self._expire()
+        costs = [s[3] for s in self._samples if s[1] is not None]
+        return sum(costs) / len(costs) if costs else None
+    
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95 = self.latency_percentile(50), self.latency_percentile(95)
+        cost_per_token = self.cost_per_output_token
+        return {
+            "samples": self.count,
+            "p50_s": round(p50, 3) if p50 is not None else None,
+            "p95_s": round(p95, 3) if p95 is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "cost_per_output_token": round(cost_per_token, 9) if cost_per_token is not None else None,
+        }
+
+class RouteDecision:
+    """The model picked for one call and why"""
+    
+    __slots__ = ("task_type", "model", "reason")
+    
+    def __init__(self, task_type: TaskType, model: str, reason: str):
+        self.task_type = task_type
+        self.model = model
+        self.reason = reason
+    
+    def __str__(self) -> str:
+        return f"{self.task_type.value} -> {self.model}: {self.reason}"
+
+class ModelRouter:
+    """Per-task model choice from live per-model statistics"""
+    
+    def __init__(
+        self,
+        enabled: bool,
+        tiers: Dict[str, List[str]],
+        latency_slo: Dict[str, float],
+        default_slo: float,
+        max_error_rate: float,
+        window: int,
+        window_seconds: float,
+        min_samples: int,
+        excluded_models: List[str],
+        session_cost_ceiling: float
+    ):
+        self.enabled = enabled
+        self.tiers = tiers
+        self.latency_slo = latency_slo
+        self.default_slo = default_slo
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.window_seconds = window_seconds
+        self.min_samples = max(1, min_samples)
+        self.excluded_models = set(excluded_models)
+        self.session_cost_ceiling = session_cost_ceiling
+        self._stats: Dict[str, ModelStats] = {}
+    
+    # =============== STATISTICS ===============
+    
+    def _model_stats(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = ModelStats(model, self.window, self.window_seconds)
+            self._stats[model] = stats
+        return stats
+    
+    def record_success(self, model: str, latency_s: float, output_tokens: int, cost: float) -> None:
+        """Record a successful attempt (upstream latency: from holding a scheduler slot to the last token)"""
+        self._model_stats(model).record_success(latency_s, output_tokens, cost)
+    
+    def record_failure(self, model: str) -> None:
+        """Record a failed upstream attempt"""
+        self._model_stats(model).record_failure()
+    
+    # =============== SELECTION ===============
+    
+    def slo_for(self, task_type: TaskType) -> float:
+        return self.latency_slo.get(task_type.value, self.default_slo)
+    
+    def candidates(self, task_type: TaskType) -> List[str]:
+        """Eligible models of the task's allowed tiers (default model first)"""
+        default = get_model_for_task(task_type)
+        tiers = self.tiers.get(task_type.value) or [default["tier"].value]
+        models = [default["model"]]
+        for tier in tiers:
+            for model in list_models_by_tier(ModelTier(tier)):
+                if model not in models and model not in self.excluded_models:
+                    models.append(model)
+        return models
+    
+    def expected_cost(self, model: str) -> float:
+        """Expected cost of one call: observed mean, or list price for a nominal call"""
+        observed = self._model_stats(model).mean_call_cost
+        if observed is not None:
+            return observed
+        info = get_model_info(model) or {}
+        input_tokens, output_tokens = NOMINAL_CALL_TOKENS
+        return (input_tokens * info.get("input", 0.0) + output_tokens * info.get("output", 0.0)) / 1_000_000
+    
+    def _health(self, model: str, slo: float) -> Tuple[bool, str]:
+        """(healthy, short description of the model's current stats)"""
+        stats = self._model_stats(model)
+        if stats.count < self.min_samples:
+            return True, f"{stats.count} samples"
+        p95 = stats.latency_percentile(95)
+        error_rate = stats.error_rate
+        latency_ok = p95 is not None and p95 <= slo
+        errors_ok = error_rate <= self.max_error_rate
+        described = (
+            (f"p95 {p95:.1f}s" if p95 is not None else "no successes")
+            + (" within" if latency_ok else " over") + f" SLO {slo:g}s, "
+            + f"{error_rate:.0%} errors" + ("" if errors_ok else f" > {self.max_error_rate:.0%}")
+        )
+        return latency_ok and errors_ok, described
+    
+    def route(self, task_type: Optional[TaskType] = None, session_cost: float = 0.0) -> RouteDecision:
+        """
+        Choose the model for one call.
+        
+        Args:
+            task_type: Task being run (GENERAL when omitted)
+            session_cost: Amount the session has spent so far, checked
+                against settings.session_cost_ceiling
+        
+        Returns:
+            RouteDecision with the model and a one-line reason
+        """
+        task_type = task_type or TaskType.GENERAL
+        default = get_model_for_task(task_type)["model"]
+        if not self.enabled:
+            return RouteDecision(task_type, default, "static mapping")
+        
+        slo = self.slo_for(task_type)
+        remaining = self.session_cost_ceiling - session_cost if self.session_cost_ceiling > 0 else None
+        eligible = self.candidates(task_type)
+        models = [m for m in eligible if circuit_breakers.available(m)] or eligible
+        affordable = [m for m in models if remaining is None or self.expected_cost(m) <= remaining]
+        health = {m: self._health(m, slo) for m in models}
+        
+        if default in affordable and health[default][0]:
+            decision = RouteDecision(task_type, default, f"default ({health[default][1]})")
+        else:
+            if default not in models:
+                why = f"default {default} circuit open"
+            elif default not in affordable:
+                why = f"default {default} over budget"
+            else:
+                why = f"default {default} unhealthy ({health[default][1]})"
+            healthy = [m for m in affordable if health[m][0]]
+            if healthy:
+                model = min(healthy, key=self.expected_cost)
+                decision = RouteDecision(task_type, model, f"{why}; cheapest healthy ({health[model][1]})")
+            elif affordable:
+                model = min(affordable, key=lambda m: self._model_stats(m).latency_percentile(95) or float("inf"))
+                decision = RouteDecision(task_type, model, f"{why}; none healthy, fastest ({health[model][1]})")
+            else:
+                model = min(models, key=self.expected_cost)
+                decision = RouteDecision(
+                    task_type, model,
+                    f"{why}; nothing fits remaining budget ${max(remaining, 0.0):.4f}, cheapest"
+                )
+        
+        MODEL_ROUTE_DECISIONS.inc(task_type=task_type.value, model=decision.model)
+        if decision.model != default:
+            logger.info(f"Model routing: {decision}")
+        return decision
+    
+    def fallback_for(self, task_type: TaskType, model: str) -> Optional[str]:
+        """Cheapest other healthy model of the same tier (for a hedged duplicate request)"""
+        info = get_model_info(model)
+        if info is None:
+            return None
+        slo = self.slo_for(task_type)
+        options = [
+            m for m in list_models_by_tier(ModelTier(info["tier"]))
+            if m != model and m not in self.excluded_models
+            and circuit_breakers.available(m) and self._health(m, slo)[0]
+        ]
+        return min(options, key=self.expected_cost) if options else None
+
+    def route_for_session(self, session: SessionData, task_type: TaskType, label: str) -> str:
+        """
+        Route one of a session's calls.
+        
+        The decision is recorded as a span in the session timeline; it is
+        appended to session.model_reasoning only when the call is moved off
+        the task's default model, so routine calls do not grow the session.
+        
+        Args:
+            session: Session the call is made for (its spend counts against the ceiling)
+            task_type: Task being run
+            label: Which call this is, e.g. "round 2 EXPANSION"
+        
+        Returns:
+            Model to call
+        """
+        decision = self.route(task_type, session_cost=session.cost_tracking.total_cost)
+        with span("model.route", call=label, task_type=task_type.value, model=decision.model, reason=decision.reason):
+            pass
+        if decision.model != get_model_for_task(task_type)["model"]:
+            entry = f"[{label}] {decision}"
+            session.model_reasoning = f"{session.model_reasoning}\n{entry}" if session.model_reasoning else entry
+        return decision.model
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "session_cost_ceiling": self.session_cost_ceiling,
+            "models": {model: stats.snapshot() for model, stats in self._stats.items()},
+        }
+
+# Singleton instance
+model_router = ModelRouter(
+    enabled=settings.enable_model_router,
+    tiers=settings.router_tiers,
+    latency_slo=settings.router_latency_slo,
+    default_slo=settings.router_default_slo,
+    max_error_rate=settings.router_max_error_rate,
+    window=settings.router_window,
+    window_seconds=settings.router_window_seconds,
+    min_samples=settings.router_min_samples,
+    excluded_models=settings.router_excluded_models,
+    session_cost_ceiling=settings.session_cost_ceiling
+)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from enum import Enum
 from uuid import UUID, uuid4
 from datetime import datetime
@@ -37,8 +37,15 @@ class CostTracking(BaseModel):
     total_cost: float = 0.0
     total_input_tokens: int = 0
     total_output_tokens: int = 0
+    total_cached_tokens: int = 0  # input tokens served from the provider's prefix cache (billed at cached_input)
+    total_hedge_cost: float = 0.0  # estimated cost of requests cancelled after a hedge race (part of total_cost)
+    hedged_calls: int = 0
     model_costs: dict = Field(default_factory=dict)
     
+    # History budgeting: input tokens avoided by summarizing older rounds
+    history_tokens_saved: int = 0
+    history_budget_calls: List[dict] = Field(default_factory=list)
+    
     class Config:
         protected_namespaces = ()
 
@@ -58,9 +65,13 @@ class SessionData(BaseModel):
     max_rounds: int = 3
     history: List[RoundOutput] = Field(default_factory=list)
     
+    # Rolling summaries of older rounds (round N -> summary of rounds 1..N)
+    history_summaries: Dict[int, str] = Field(default_factory=dict)
+    
     # Error handling
     error_message: Optional[str] = None
     retry_count: int = 0
+    recovery_attempts: int = 0  # times re-queued by startup crash recovery
     
     # Meta Agent Data
     selected_model: str = "glm-4.7"
@@ -69,6 +80,12 @@ class SessionData(BaseModel):
     # Cost tracking
     cost_tracking: CostTracking = Field(default_factory=CostTracking)
     
+    # Processing spans: [span_id, parent_id, name, start_ms, duration_ms, status, attributes]
+    timeline: List[List[Any]] = Field(default_factory=list)
+    
+    # Bumped by every save; GET /api/chat/{id} derives its ETag from it
+    version: int = 0
+    
     class Config:
         protected_namespaces = ()
 
@@ -80,11 +97,13 @@ class ClarifyRequest(BaseModel):
     answers: str
 
 class WSMessage(BaseModel):
-    type: str  # "state_change" | "agent_output" | "synthesis" | "error"
+    type: str  # "state_change" | "agent_output" | "agent_delta" | "synthesis" | "queue_position" | "error" | "sync"
     session_id: UUID
     content: Optional[str] = None
     round: Optional[int] = None
     agent: Optional[AgentType] = None
     state: Optional[SessionState] = None
     timestamp: float = Field(default_factory=lambda: datetime.now().timestamp())
-    cost: Optional[float] = None
\ No newline at end of file
+    cost: Optional[float] = None
+    position: Optional[int] = None  # queue_position: 1-based place in the session queue (0 = processing)
+    seq: Optional[int] = None  # per-session sequence number (resume with ?since=<seq>)
\ No newline at end of file
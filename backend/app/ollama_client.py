@@ -1,7 +1,12 @@
 import httpx
 import asyncio
+import json
 import logging
-from typing import Dict, Any, Optional
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional, AsyncIterator, Awaitable, Callable, Tuple
 from app.config import get_settings
 from app.model_config import (
     TaskType,
@@ -9,10 +14,43 @@ from app.model_config import (
     calculate_cost,
     get_model_info
 )
+from app.cassette import Cassette
+from app.circuit_breaker import CircuitOpenError, circuit_breakers, jittered
+from app.response_cache import ResponseCache, payload_key
+from app.tracing import span
+from app.upstream_scheduler import SchedulerSlot, UpstreamScheduler
+from app.model_router import model_router
+from app.hedging import hedger
+from app.token_estimator import token_estimator
+from app.metrics import (
+    UPSTREAM_ATTEMPT_DURATION,
+    UPSTREAM_CACHE_HITS,
+    UPSTREAM_QUEUE_WAIT,
+    UPSTREAM_REQUEST_DURATION,
+    UPSTREAM_RESPONSES,
+    UPSTREAM_RETRIES,
+    UPSTREAM_TIME_TO_FIRST_TOKEN,
+    UPSTREAM_TOKENS,
+    UPSTREAM_TOKENS_PER_SECOND
+)
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Per-call result fields that must not be replayed from the response cache
+PER_CALL_FIELDS = ("time_to_first_token_ms", "queue_wait_ms", "hedged", "hedge_cost")
+
+# Failures of the provider or the network: retried, and counted against the
+# model by the circuit breaker and router. Anything else (a cassette miss, a
+# bug on our side) is raised to the caller without touching the model's health.
+UPSTREAM_ERRORS = (httpx.HTTPStatusError, httpx.TransportError, json.JSONDecodeError)
+
 class ZaiClient:
     """Async client for Z.AI GLM Models API"""
     
@@ -28,10 +66,105 @@ class ZaiClient:
         self.max_retries = settings.ollama_max_retries
         self.retry_delay = settings.ollama_retry_delay
         
+        # Shared connection pool (created lazily, bound to the running event loop)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.http2 = settings.zai_http2 and HTTP2_AVAILABLE
+        if settings.zai_http2 and not HTTP2_AVAILABLE:
+            logger.warning("HTTP/2 requested but 'h2' is not installed; falling back to HTTP/1.1")
+        
+        # Opt-in content-addressed response cache
+        self.response_cache: Optional[ResponseCache] = None
+        if settings.enable_response_cache:
+            disk_path = settings.response_cache_path or str(Path(settings.session_storage_path) / "response_cache")
+            self.response_cache = ResponseCache(
+                max_entries=settings.response_cache_max_entries,
+                disk_path=Path(disk_path) if settings.response_cache_disk else None,
+                ttls=settings.response_cache_ttls,
+                default_ttl=settings.response_cache_default_ttl
+            )
+        
+        # Per-model concurrency / RPM limits and priority queueing
+        self.scheduler = UpstreamScheduler(
+            enabled=settings.enable_upstream_scheduler,
+            default_max_concurrency=settings.upstream_default_max_concurrency,
+            default_rpm=settings.upstream_default_rpm
+        )
+        
+        # Record/replay of upstream completions (replay never touches the network)
+        self.cassette: Optional[Cassette] = None
+        if settings.zai_cassette_mode != "off":
+            cassette_path = settings.zai_cassette_path or str(Path(settings.session_storage_path) / "cassettes" / "zai.jsonl")
+            self.cassette = Cassette(settings.zai_cassette_mode, Path(cassette_path), settings.zai_cassette_time_scale)
+            logger.info(f"Z.AI cassette {self.cassette.mode} mode ({cassette_path})")
+        
         # Validate API key
         if not self.api_key:
             logger.error("Z.AI API key not configured. Set ZAI_API_KEY in .env")
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        Get the pooled HTTP client, creating it on first use.
+        
+        The pool is tied to the event loop it was created on, so a client left
+        over from a previous loop (e.g. repeated asyncio.run calls in scripts)
+        is replaced rather than reused.
+        
+        Returns:
+            Shared httpx.AsyncClient instance
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                timeout=httpx.Timeout(self.timeout, connect=settings.zai_connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=settings.zai_max_connections,
+                    max_keepalive_connections=settings.zai_max_keepalive_connections,
+                    keepalive_expiry=settings.zai_keepalive_expiry
+                ),
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+            self._client_loop = loop
+            logger.info(
+                f"Z.AI connection pool created (HTTP/2: {self.http2}, "
+                f"max connections: {settings.zai_max_connections})"
+            )
+        return self._client
+    
+    @property
+    def replaying(self) -> bool:
+        """Completions are served from a cassette instead of the API"""
+        return self.cassette is not None and self.cassette.replaying
+    
+    async def start(self) -> None:
+        """Create the connection pool and pre-warm it with a few idle connections"""
+        if self.replaying:
+            return
+        client = self._get_client()
+        warm_count = max(0, settings.zai_prewarm_connections)
+        if not warm_count or not self.api_key:
+            return
+        
+        async def _warm():
+            try:
+                await client.get("/models", timeout=5.0)
+            except Exception as e:
+                logger.debug(f"Z.AI pre-warm request failed: {e}")
+        
+        # A single HTTP/2 connection multiplexes every stream, so one request is enough
+        await asyncio.gather(*[_warm() for _ in range(1 if self.http2 else warm_count)])
+        logger.info("Z.AI connection pool pre-warmed")
+    
+    async def close(self) -> None:
+        """Close the connection pool (called on application shutdown)"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Z.AI connection pool closed")
+        self._client = None
+        self._client_loop = None
+    
     def _get_model_for_task(self, task_type: TaskType) -> str:
         """
         Get the optimal model for a given task type.
@@ -49,7 +182,8 @@ class ZaiClient:
         self,
         model: str,
         input_tokens: int,
-        output_tokens: int
+        output_tokens: int,
+        cached_tokens: int = 0
     ) -> float:
         """
         Calculate the cost of an API call.
@@ -58,32 +192,571 @@ class ZaiClient:
             model: Model identifier
             input_tokens: Number of input tokens
             output_tokens: Number of output tokens
+            cached_tokens: Input tokens served from the provider's prefix cache
             
         Returns:
             Total cost in USD
         """
-        return calculate_cost(model, input_tokens, output_tokens)
+        return calculate_cost(model, input_tokens, output_tokens, cached_tokens)
     
     async def health_check(self) -> bool:
         """Check if Z.AI API is reachable"""
+        if self.replaying:
+            return True
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(
-                    f"{self.base_url}/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
-                )
-                is_healthy = response.status_code == 200
-                logger.info(f"Z.AI health check: {'OK' if is_healthy else 'FAILED'}")
-                return is_healthy
+            response = await self._get_client().get("/models", timeout=5.0)
+            is_healthy = response.status_code == 200
+            logger.info(f"Z.AI health check: {'OK' if is_healthy else 'FAILED'}")
+            return is_healthy
         except Exception as e:
             logger.error(f"Z.AI health check failed: {e}")
             return False
     
+    def _resolve_model(self, task_type: Optional[TaskType], model: Optional[str]) -> str:
+        """Pick the explicit model, or let the model router choose for the task (GENERAL by default)"""
+        if model:
+            return model
+        return model_router.route(task_type).model
+    
+    def _build_payload(
+        self,
+        model_name: str,
+        prompt: str,
+        system: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Build the OpenAI-compatible chat completion payload (system message first, so it is a cacheable prefix)"""
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({
+            "role": "user",
+            "content": prompt
+        })
+        return {
+            "model": model_name,
+            "messages": messages,
+            "max_tokens": max_tokens or settings.max_tokens,
+            "temperature": settings.temperature,
+            "top_p": settings.top_p,
+        }
+    
+    def _build_result(
+        self,
+        model_name: str,
+        text: str,
+        usage: Dict[str, Any],
+        duration_ns: int = 0
+    ) -> Dict[str, Any]:
+        """Assemble the normalized generation result from text, usage and attempt duration"""
+        input_tokens = usage.get("prompt_tokens", 0)
+        output_tokens = usage.get("completion_tokens", 0)
+        # Prompt prefix served from the provider's cache (billed at the cached_input rate)
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        
+        # Calculate cost
+        cost = self._calculate_request_cost(model_name, input_tokens, output_tokens, cached_tokens)
+        
+        result = {
+            "response": text,
+            "total_duration": duration_ns,  # Measured locally (not provided by API)
+            "tokens_generated": output_tokens,
+            "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
+            "output_tokens": output_tokens,
+            "model_used": model_name,
+            "cost": cost
+        }
+        
+        logger.info(
+            f"Z.AI API response received (Input: {input_tokens}, Cached: {cached_tokens}, "
+            f"Output: {output_tokens}, Model: {model_name}, Cost: ${cost:.6f})"
+        )
+        return result
+    
+    def _cache_key(self, payload: Dict[str, Any], task_type: Optional[TaskType]) -> Optional[str]:
+        """Response cache key for a request, or None if it should not be cached"""
+        if self.response_cache is None or self.response_cache.ttl_for(task_type) <= 0:
+            return None
+        return payload_key(payload)
+    
+    async def _cached_result(self, cache_key: Optional[str], task_type: Optional[TaskType]) -> Optional[Dict[str, Any]]:
+        """Serve a cached result as a zero-cost call"""
+        if cache_key is None:
+            return None
+        result = await self.response_cache.get(cache_key)
+        if result is None:
+            return None
+        UPSTREAM_CACHE_HITS.inc(task_type=(task_type or TaskType.GENERAL).value)
+        result["cost"] = 0.0
+        result["cache_hit"] = True
+        result["queue_wait_ms"] = 0
+        logger.info(f"Z.AI response cache hit (Model: {result['model_used']}, Key: {cache_key[:12]})")
+        return result
+    
+    async def _store_result(
+        self,
+        cache_key: Optional[str],
+        result: Dict[str, Any],
+        task_type: Optional[TaskType]
+    ) -> None:
+        if cache_key is None or not result.get("response"):
+            return
+        entry = {k: v for k, v in result.items() if k not in PER_CALL_FIELDS}
+        await self.response_cache.put(cache_key, entry, task_type)
+    
+    @staticmethod
+    def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+        """Parse a Retry-After header (delta-seconds or HTTP date)"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    async def _backoff(self, model_name: str, attempt: int, retry_after: Optional[float] = None) -> None:
+        """
+        Wait before the next attempt.
+        
+        After a 429/503 with Retry-After the model's scheduler lane is paused
+        instead, so every queued caller waits once rather than each sleeping
+        on its own. Exponential backoff is jittered so sessions that failed
+        together do not retry together, and skipped when the failures opened
+        the model's circuit (the next attempt fails fast or is rerouted).
+        """
+        if attempt >= self.max_retries - 1:
+            return
+        if not circuit_breakers.available(model_name):
+            return
+        if retry_after is not None and self.scheduler.enabled:
+            self.scheduler.pause(model_name, retry_after)
+            return
+        wait_time = retry_after if retry_after is not None else jittered(self.retry_delay * (2 ** attempt))
+        logger.info(f"Retrying in {wait_time:.1f}s...")
+        await asyncio.sleep(wait_time)
+    
+    def _reroute(self, error: CircuitOpenError, payload: Dict[str, Any], task_type: Optional[TaskType]) -> Dict[str, Any]:
+        """
+        Payload for another model of the same tier after a circuit-open rejection.
+        
+        Raises:
+            CircuitOpenError: No model to fall back to (fail fast)
+        """
+        fallback = None if self.replaying else model_router.fallback_for(task_type or TaskType.GENERAL, payload["model"])
+        if fallback is None:
+            raise error
+        logger.warning(f"{error}; rerouting to {fallback}")
+        return {**payload, "model": fallback}
+    
+    @asynccontextmanager
+    async def _attempt(
+        self,
+        model_name: str,
+        task_type: Optional[TaskType],
+        attempt: int,
+        hedge: bool = False
+    ) -> AsyncIterator[SchedulerSlot]:
+        """One upstream attempt: holds a scheduler slot and records attempt metrics"""
+        task = (task_type or TaskType.GENERAL).value
+        # Raises CircuitOpenError while the model's circuit is open
+        probe = circuit_breakers.acquire(model_name)
+        status = "cancelled"
+        retry_after = None
+        try:
+            if attempt and not hedge:
+                UPSTREAM_RETRIES.inc(model=model_name, task_type=task)
+            with span("zai.attempt", model=model_name, task_type=task, attempt=attempt + 1, hedge=hedge) as attempt_span:
+                async with self.scheduler.slot(model_name, task_type) as slot:
+                    UPSTREAM_QUEUE_WAIT.observe(slot.wait_ms / 1000, model=model_name)
+                    started = time.perf_counter()
+                    try:
+                        yield slot
+                        status = "200"
+                    except httpx.HTTPStatusError as e:
+                        status = str(e.response.status_code)
+                        retry_after = self._retry_after_seconds(e.response)
+                        raise
+                    except httpx.TimeoutException:
+                        status = "timeout"
+                        raise
+                    except UPSTREAM_ERRORS:
+                        status = "error"
+                        raise
+                    except Exception:
+                        status = "local_error"
+                        raise
+                    finally:
+                        UPSTREAM_ATTEMPT_DURATION.observe(time.perf_counter() - started, model=model_name, task_type=task)
+                        UPSTREAM_RESPONSES.inc(model=model_name, status=status)
+                        if self._is_failure(status):
+                            model_router.record_failure(model_name)
+                        if attempt_span is not None:
+                            attempt_span.set(status=status, queue_wait_ms=slot.wait_ms)
+        finally:
+            if self._is_failure(status):
+                circuit_breakers.record(
+                    model_name, False, probe, retry_after,
+                    error=f"HTTP {status}" if status.isdigit() else status
+                )
+            else:
+                circuit_breakers.record(model_name, True if status == "200" else None, probe)
+    
+    @staticmethod
+    def _is_failure(status: str) -> bool:
+        """Attempt outcomes that count against the model's health ("local_error" and "cancelled" do not)"""
+        return status in ("timeout", "error", "429") or status.startswith("5")
+    
+    @staticmethod
+    def _observe_result(
+        result: Dict[str, Any],
+        task_type: Optional[TaskType],
+        call_started: float,
+        input_bytes: int
+    ) -> None:
+        """Record token and latency metrics for a successful upstream call (and calibrate the token estimator)"""
+        model = result["model_used"]
+        task = (task_type or TaskType.GENERAL).value
+        latency_s = time.perf_counter() - call_started
+        UPSTREAM_REQUEST_DURATION.observe(latency_s, model=model, task_type=task)
+        UPSTREAM_TOKENS.inc(result["input_tokens"], model=model, direction="input")
+        UPSTREAM_TOKENS.inc(result.get("cached_tokens", 0), model=model, direction="cached_input")
+        UPSTREAM_TOKENS.inc(result["output_tokens"], model=model, direction="output")
+        token_estimator.calibrate(model, input_bytes, result["input_tokens"])
+        
+        generation_s = result["total_duration"] / 1e9
+        ttft_ms = result.get("time_to_first_token_ms")
+        if ttft_ms is not None:
+            UPSTREAM_TIME_TO_FIRST_TOKEN.observe(ttft_ms / 1000, model=model, task_type=task)
+            generation_s -= ttft_ms / 1000
+        if result["output_tokens"] and generation_s > 0:
+            UPSTREAM_TOKENS_PER_SECOND.observe(result["output_tokens"] / generation_s, model=model)
+    
+    async def _request_completion(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Single non-streaming completion attempt"""
+        started = time.perf_counter()
+        if self.replaying:
+            text, usage = await self.cassette.replay_completion(payload)
+            duration_ns = int((time.perf_counter() - started) * 1e9)
+            return self._build_result(payload["model"], text, usage, duration_ns)
+        
+        response = await self._get_client().post(
+            "/chat/completions",
+            json=payload,
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+        data = response.json()
+        
+        # Extract response from OpenAI-compatible format
+        choices = data.get("choices", [])
+        text = choices[0].get("message", {}).get("content", "") if choices else ""
+        duration_ns = int((time.perf_counter() - started) * 1e9)
+        if self.cassette is not None and self.cassette.recording:
+            await self.cassette.record(payload, text, data.get("usage") or {}, duration_ns)
+        return self._build_result(payload["model"], text, data.get("usage") or {}, duration_ns)
+    
+    async def _stream_completion(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Single streaming completion attempt over server-sent events.
+        
+        Yields {"type": "delta", "content": str} for each content fragment and
+        finally {"type": "done", "result": {...}} once the stream has ended.
+        """
+        if self.replaying:
+            async for event in self._replay_stream(payload):
+                yield event
+            return
+        
+        stream_payload = {**payload, "stream": True}
+        parts = []
+        usage: Dict[str, Any] = {}
+        started = time.monotonic()
+        first_token_at = None
+        recording = self.cassette is not None and self.cassette.recording
+        offsets = []
+        
+        async with self._get_client().stream(
+            "POST",
+            "/chat/completions",
+            json=stream_payload,
+            headers={"Content-Type": "application/json", "Accept": "text/event-stream"}
+        ) as response:
+            if response.status_code >= 400:
+                # Read the body so HTTPStatusError handlers can report it
+                await response.aread()
+            response.raise_for_status()
+            
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed SSE chunk: {data[:200]}")
+                    continue
+                
+                # Usage normally arrives on the final chunk
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                
+                choices = chunk.get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    if recording:
+                        offsets.append((time.monotonic() - started) * 1000)
+                    parts.append(delta)
+                    yield {"type": "delta", "content": delta}
+        
+        duration_ns = int((time.monotonic() - started) * 1e9)
+        result = self._build_result(payload["model"], "".join(parts), usage, duration_ns)
+        if first_token_at is not None:
+            result["time_to_first_token_ms"] = int((first_token_at - started) * 1000)
+        if recording:
+            await self.cassette.record(
+                payload, result["response"], usage, duration_ns,
+                ttft_ms=result.get("time_to_first_token_ms"),
+                deltas=list(zip(offsets, parts))
+            )
+        yield {"type": "done", "result": result}
+    
+    async def _replay_stream(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Streaming attempt served from the cassette (same events as _stream_completion)"""
+        parts = []
+        usage: Dict[str, Any] = {}
+        started = time.monotonic()
+        first_token_at = None
+        async for event in self.cassette.replay_stream(payload):
+            if "usage" in event:
+                usage = event["usage"]
+                continue
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            parts.append(event["content"])
+            yield {"type": "delta", "content": event["content"]}
+        
+        duration_ns = int((time.monotonic() - started) * 1e9)
+        result = self._build_result(payload["model"], "".join(parts), usage, duration_ns)
+        if first_token_at is not None:
+            result["time_to_first_token_ms"] = int((first_token_at - started) * 1000)
+        yield {"type": "done", "result": result}
+    
+    async def _attempt_events(
+        self,
+        payload: Dict[str, Any],
+        task_type: Optional[TaskType],
+        attempt: int,
+        streamed: bool,
+        waits: Optional[List[int]],
+        hedge: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        One upstream attempt as events: content deltas when streamed, then "done".
+        
+        Args:
+            waits: Scheduler queue waits of the call's attempts (hedges not included)
+            hedge: Whether this is the duplicate of a slow attempt
+        """
+        model_name = payload["model"]
+        async with self._attempt(model_name, task_type, attempt, hedge) as slot:
+            # Measured once the slot is held: the router judges the provider, not our queue
+            started = time.perf_counter()
+            if waits is not None:
+                waits.append(slot.wait_ms)
+            kind = "stream attempt" if streamed else "request attempt"
+            logger.info(
+                f"Z.AI API {kind} {attempt + 1}/{self.max_retries} to {model_name}{' (hedge)' if hedge else ''}"
+            )
+            if streamed:
+                events = self._stream_completion(payload)
+            else:
+                events = self._single_event(self._request_completion(payload))
+            async for event in events:
+                if event["type"] == "done":
+                    result = event["result"]
+                    model_router.record_success(
+                        model_name, time.perf_counter() - started, result["output_tokens"], result["cost"]
+                    )
+                yield event
+    
+    @staticmethod
+    async def _single_event(completion: Awaitable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        yield {"type": "done", "result": await completion}
+    
+    def _hedged_attempt(
+        self,
+        payload: Dict[str, Any],
+        task_type: Optional[TaskType],
+        attempt: int,
+        streamed: bool,
+        waits: List[int],
+        prompt_tokens: int
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """One attempt through the hedger, which may race a duplicate against it (see hedging.py)"""
+        def start(model: str, hedge: bool) -> AsyncIterator[Dict[str, Any]]:
+            return self._attempt_events(
+                {**payload, "model": model}, task_type, attempt, streamed, None if hedge else waits, hedge
+            )
+        
+        # Replays only hold the recorded models
+        return hedger.run(
+            task_type, payload["model"], streamed, start, prompt_tokens,
+            allow_fallback=not self.replaying
+        )
+    
+    def _failure(self, error: Exception, attempt: int) -> Tuple[str, Optional[float]]:
+        """
+        Describe a failed attempt that is worth retrying.
+        
+        Returns:
+            (error description, Retry-After to honor or None)
+        
+        Raises:
+            RuntimeError: The provider rejected the request itself (4xx other
+                than 429), so retrying would not help
+        """
+        if isinstance(error, httpx.TimeoutException):
+            logger.warning(f"Attempt {attempt + 1} timeout: {error}")
+            return f"Timeout after {self.timeout}s", None
+        if not isinstance(error, httpx.HTTPStatusError):
+            logger.error(f"Attempt {attempt + 1} failed: {error}")
+            return str(error), None
+        
+        status = error.response.status_code
+        description = f"HTTP {status}: {error.response.text}"
+        logger.error(f"Attempt {attempt + 1} HTTP error: {description}")
+        if status == 429:
+            # Rate limited: retry once the model's lane reopens
+            retry_after = self._retry_after_seconds(error.response)
+            return description, retry_after if retry_after is not None else self.retry_delay * (2 ** attempt)
+        if status == 503:
+            # Unavailable: honor Retry-After when the provider sends one
+            return description, self._retry_after_seconds(error.response)
+        if status >= 500:
+            return description, None  # Server error, retry
+        raise RuntimeError(description)
+    
+    async def _call(
+        self,
+        payload: Dict[str, Any],
+        task_type: Optional[TaskType],
+        streamed: bool,
+        prompt_tokens: int
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Run attempts until one succeeds, yielding its events (shared by generate and generate_stream).
+        
+        Upstream failures are retried up to max_retries attempts with backoff.
+        A call refused by an open circuit never reached the provider: it is
+        rerouted to another model of the same tier without using up an
+        attempt. A streamed call that fails after delivering content is not
+        retried, since a retry would repeat text the caller already has.
+        
+        Raises:
+            CircuitOpenError: The circuit is open and there is no model to fall back to
+            RuntimeError: The call failed for good
+            Exception: Local errors (e.g. CassetteMissError), unchanged
+        """
+        last_error = None
+        waits: List[int] = []
+        attempt = 0
+        reroutes = 0
+        while attempt < self.max_retries:
+            emitted = False
+            try:
+                async for event in self._hedged_attempt(payload, task_type, attempt, streamed, waits, prompt_tokens):
+                    if event["type"] == "delta":
+                        emitted = True
+                    else:
+                        event["result"]["queue_wait_ms"] = sum(waits)
+                    yield event
+                return
+            except CircuitOpenError as e:
+                # Bounded, so half-open models cannot bounce a call between them forever
+                reroutes += 1
+                if reroutes > self.max_retries:
+                    raise
+                payload = self._reroute(e, payload, task_type)
+                continue
+            except UPSTREAM_ERRORS as e:
+                last_error, retry_after = self._failure(e, attempt)
+            
+            if emitted:
+                raise RuntimeError(f"Z.AI API stream interrupted after partial output: {last_error}")
+            
+            # Wait before retry
+            await self._backoff(payload["model"], attempt, retry_after)
+            attempt += 1
+        
+        raise RuntimeError(f"Z.AI API generation failed after {self.max_retries} attempts: {last_error}")
+    
+    async def generate_stream(
+        self,
+        prompt: str,
+        task_type: Optional[TaskType] = None,
+        model: Optional[str] = None,
+        system: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream text from the Z.AI OpenAI-compatible API.
+        
+        Failed attempts are retried like generate() as long as no content has
+        been yielded yet; once deltas have reached the caller a failure is
+        raised instead, since a retry would repeat text already delivered.
+        
+        Args:
+            prompt: The input prompt
+            task_type: TaskType enum for automatic model routing
+            model: Specific model to use (overrides task_type)
+            system: Static system message sent ahead of the prompt
+            max_tokens: Completion budget (settings.max_tokens if None),
+                lowered when the prompt leaves less room in the context window
+            
+        Yields:
+            {"type": "delta", "content": str} for each content fragment, then
+            {"type": "done", "result": {...}} with the same result as generate()
+        
+        Raises:
+            PromptTooLargeError: The prompt cannot fit the model's context window
+        """
+        model_name = self._resolve_model(task_type, model)
+        preflight = token_estimator.preflight(model_name, prompt, system, max_tokens)
+        payload = self._build_payload(model_name, preflight.prompt, system, preflight.max_tokens)
+        
+        cache_key = self._cache_key(payload, task_type)
+        cached = await self._cached_result(cache_key, task_type)
+        if cached is not None:
+            # Replay the cached completion as a single delta
+            yield {"type": "delta", "content": cached["response"]}
+            yield {"type": "done", "result": cached}
+            return
+        
+        call_started = time.perf_counter()
+        async for event in self._call(payload, task_type, True, preflight.input_tokens):
+            if event["type"] == "done":
+                result = event["result"]
+                self._observe_result(result, task_type, call_started, preflight.input_bytes)
+                if result["model_used"] == model_name:
+                    await self._store_result(cache_key, result, task_type)
+            yield event
+    
     async def generate(
         self,
         prompt: str,
         task_type: Optional[TaskType] = None,
-        model: Optional[str] = None
+        model: Optional[str] = None,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+        system: Optional[str] = None,
+        max_tokens: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Generate text using Z.AI OpenAI-compatible API.
@@ -92,110 +765,60 @@ class ZaiClient:
             prompt: The input prompt
             task_type: TaskType enum for automatic model routing
             model: Specific model to use (overrides task_type)
+            on_delta: Optional async callback(delta: str). When given (and
+                streaming is enabled) the response is streamed and each content
+                fragment is passed to the callback as it arrives.
+            system: Static system message sent ahead of the prompt. Keep it
+                identical across calls so the provider can cache the prefix.
+            max_tokens: Completion budget (settings.max_tokens if None),
+                lowered when the prompt leaves less room in the context window
             
         Returns:
             {
                 "response": str,
-                "total_duration": int (nanoseconds),
+                "total_duration": int (nanoseconds, duration of the successful attempt),
                 "tokens_generated": int,
                 "input_tokens": int,
+                "cached_tokens": int (input tokens served from the provider's prefix cache),
                 "output_tokens": int,
                 "model_used": str,
-                "cost": float
+                "cost": float,
+                "queue_wait_ms": int (time spent waiting for an upstream slot),
+                "hedged": bool (a duplicate request was raced against a slow attempt),
+                "hedge_cost": float (estimated cost of the cancelled duplicate or original),
+                "cache_hit": bool (only present on response cache hits)
             }
+        
+        Raises:
+            PromptTooLargeError: The prompt cannot fit the model's context window
         """
-        # Determine which model to use
-        if model:
-            model_name = model
-        elif task_type:
-            model_name = self._get_model_for_task(task_type)
-        else:
-            # Default to general task
-            model_name = self._get_model_for_task(TaskType.GENERAL)
-        
-        # Build request payload
-        payload = {
-            "model": model_name,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "max_tokens": settings.max_tokens,
-            "temperature": settings.temperature,
-            "top_p": settings.top_p,
-        }
+        if on_delta is not None and settings.enable_streaming:
+            result = None
+            async for event in self.generate_stream(
+                prompt, task_type=task_type, model=model, system=system, max_tokens=max_tokens
+            ):
+                if event["type"] == "delta":
+                    await on_delta(event["content"])
+                else:
+                    result = event["result"]
+            return result
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        model_name = self._resolve_model(task_type, model)
+        preflight = token_estimator.preflight(model_name, prompt, system, max_tokens)
+        payload = self._build_payload(model_name, preflight.prompt, system, preflight.max_tokens)
         
-        last_error = None
-        for attempt in range(self.max_retries):
-            try:
-                async with httpx.AsyncClient(timeout=self.timeout) as client:
-                    logger.info(f"Z.AI API request attempt {attempt + 1}/{self.max_retries} to {model_name}")
-                    response = await client.post(
-                        f"{self.base_url}/chat/completions",
-                        json=payload,
-                        headers=headers
-                    )
-                    response.raise_for_status()
-                    data = response.json()
-                    
-                    # Extract response from OpenAI-compatible format
-                    choices = data.get("choices", [])
-                    text = choices[0].get("message", {}).get("content", "") if choices else ""
-                    usage = data.get("usage", {})
-                    
-                    input_tokens = usage.get("prompt_tokens", 0)
-                    output_tokens = usage.get("completion_tokens", 0)
-                    total_tokens = input_tokens + output_tokens
-                    
-                    # Calculate cost
-                    cost = self._calculate_request_cost(model_name, input_tokens, output_tokens)
-                    
-                    result = {
-                        "response": text,
-                        "total_duration": 0,  # Not provided by API
-                        "tokens_generated": output_tokens,
-                        "input_tokens": input_tokens,
-                        "output_tokens": output_tokens,
-                        "model_used": model_name,
-                        "cost": cost
-                    }
-                    
-                    logger.info(
-                        f"Z.AI API response received (Input: {input_tokens}, "
-                        f"Output: {output_tokens}, Model: {model_name}, Cost: ${cost:.6f})"
-                    )
-                    return result
-                    
-            except httpx.TimeoutException as e:
-                last_error = f"Timeout after {self.timeout}s"
-                logger.warning(f"Attempt {attempt + 1} timeout: {e}")
-                
-            except httpx.HTTPStatusError as e:
-                last_error = f"HTTP {e.response.status_code}: {e.response.text}"
-                logger.error(f"Attempt {attempt + 1} HTTP error: {last_error}")
-                if e.response.status_code >= 500:
-                    pass  # Server error, retry
-                else:
-                    raise RuntimeError(last_error)
-            
-            except Exception as e:
-                last_error = str(e)
-                logger.error(f"Attempt {attempt + 1} failed: {e}")
-            
-            # Wait before retry
-            if attempt < self.max_retries - 1:
-                wait_time = self.retry_delay * (2 ** attempt)
-                logger.info(f"Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
+        cache_key = self._cache_key(payload, task_type)
+        cached = await self._cached_result(cache_key, task_type)
+        if cached is not None:
+            return cached
         
-        raise RuntimeError(f"Z.AI API generation failed after {self.max_retries} attempts: {last_error}")
+        call_started = time.perf_counter()
+        async for event in self._call(payload, task_type, False, preflight.input_tokens):
+            result = event["result"]
+        self._observe_result(result, task_type, call_started, preflight.input_bytes)
+        if result["model_used"] == model_name:
+            await self._store_result(cache_key, result, task_type)
+        return result
 
 # Singleton instance - replaces ollama_client
 zai_client = ZaiClient()
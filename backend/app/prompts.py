@@ -1,9 +1,9 @@
-from typing import List
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from uuid import UUID
 from app.models import RoundOutput, AgentType
+from app.token_estimator import token_estimator
 
-class PromptManager:
-    """Manages all prompt templates and context assembly"""
-    
 from pathlib import Path
 
 PROMPTS_DIR = Path(__file__).parent / "prompts"
@@ -16,19 +16,145 @@ def load_prompt(filename: str) -> str:
         # Fallback or error reporting
         return f"Error loading prompt {filename}: {str(e)}"
 
+class TranscriptBuilder:
+    """
+    Incrementally rendered debate transcript for one session.
+    
+    Rendered entries are kept between calls, so each call only renders the
+    RoundOutputs appended since the previous one instead of rebuilding the
+    whole transcript from history. When a call passes a different view of
+    history (e.g. parallel agents of one round), only the entries past the
+    common prefix are re-rendered.
+    """
+    
+    def __init__(self):
+        self._keys: List[Tuple[int, str, float]] = []
+        self._ends: List[Tuple[int, int]] = []
+        self._text = ""
+        self.byte_length = 0
+    
+    @staticmethod
+    def render_entry(output: RoundOutput) -> str:
+        return f"--- Round {output.round_number} | Agent {output.agent.value} ---\n{output.content}\n"
+    
+    @staticmethod
+    def _key(output: RoundOutput) -> Tuple[int, str, float]:
+        return (output.round_number, output.agent.value, output.timestamp)
+    
+    def reset(self) -> None:
+        self._keys = []
+        self._ends = []
+        self._text = ""
+        self.byte_length = 0
+    
+    def _truncate(self, count: int) -> None:
+        """Drop rendered entries past the first count"""
+        if count == 0:
+            self.reset()
+            return
+        text_end, byte_end = self._ends[count - 1]
+        del self._keys[count:]
+        del self._ends[count:]
+        self._text = self._text[:text_end]
+        self.byte_length = byte_end
+    
+    def sync(self, history: List[RoundOutput]) -> None:
+        """Render any outputs appended to history since the last call"""
+        # Concurrent agents of a round may see different views of history;
+        # keep the common prefix and re-render only past the divergence
+        common = 0
+        for key, output in zip(self._keys, history):
+            if key != self._key(output):
+                break
+            common += 1
+        if common < len(self._keys):
+            self._truncate(common)
+        
+        for output in history[len(self._keys):]:
+            entry = self.render_entry(output)
+            if self._keys:
+                self._text = f"{self._text}\n{entry}"
+                self.byte_length += len(entry.encode("utf-8")) + 1
+            else:
+                self._text = entry
+                self.byte_length = len(entry.encode("utf-8"))
+            self._keys.append(self._key(output))
+            self._ends.append((len(self._text), self.byte_length))
+    
+    def render(self, history: List[RoundOutput]) -> str:
+        """Transcript text for history (entries separated by blank lines)"""
+        self.sync(history)
+        return self._text
+    
+    @property
+    def output_count(self) -> int:
+        return len(self._keys)
+    
+    @property
+    def token_estimate(self) -> int:
+        """Approximate token length of the rendered transcript"""
+        return token_estimator.tokens_for_bytes(self.byte_length)
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Approximate token length of arbitrary text"""
+        return token_estimator.estimate(text)
+
 class PromptManager:
-    """Manages all prompt templates and context assembly"""
+    """
+    Manages all prompt templates and context assembly
+    
+    Agent prompts are (system, user) pairs. The system message is a static
+    template file, byte-identical for every call of that agent across rounds
+    and sessions, so providers with prefix caching bill it at the cached-input
+    rate; everything session-specific goes into the user message after it.
+    """
+    
+    # Upper bound on sessions with a live transcript builder
+    MAX_TRANSCRIPTS = 512
     
     META_AGENT_TEMPLATE = load_prompt("meta_agent.txt")
-    CLARIFICATION_TEMPLATE = load_prompt("clarification.txt")
+    CLARIFICATION_SYSTEM_PROMPT = load_prompt("clarification.txt")
     EXPANSION_SYSTEM_PROMPT = load_prompt("expansion.txt")
     COMPRESSION_SYSTEM_PROMPT = load_prompt("compression.txt")
     SYNTHESIS_SYSTEM_PROMPT = load_prompt("synthesis.txt")
+    HISTORY_SUMMARY_SYSTEM_PROMPT = load_prompt("history_summary.txt")
+    
+    # System messages are measured once here, not on every call
+    TEMPLATE_TOKENS = token_estimator.register_templates({
+        "clarification": CLARIFICATION_SYSTEM_PROMPT,
+        "expansion": EXPANSION_SYSTEM_PROMPT,
+        "compression": COMPRESSION_SYSTEM_PROMPT,
+        "synthesis": SYNTHESIS_SYSTEM_PROMPT,
+        "history_summary": HISTORY_SUMMARY_SYSTEM_PROMPT,
+    })
+    
+    def __init__(self):
+        self._transcripts: "OrderedDict[UUID, TranscriptBuilder]" = OrderedDict()
+    
+    def transcript_for(self, session_id: UUID) -> TranscriptBuilder:
+        """Get (or create) the incremental transcript builder for a session"""
+        builder = self._transcripts.get(session_id)
+        if builder is None:
+            builder = TranscriptBuilder()
+            self._transcripts[session_id] = builder
+            while len(self._transcripts) > self.MAX_TRANSCRIPTS:
+                self._transcripts.popitem(last=False)
+        else:
+            self._transcripts.move_to_end(session_id)
+        return builder
+    
+    def release_transcript(self, session_id: UUID) -> None:
+        """Drop a session's transcript builder once the session is finished"""
+        self._transcripts.pop(session_id, None)
 
     @staticmethod
-    def format_clarification(user_prompt: str) -> str:
-        """Generate clarification prompt"""
-        return PromptManager.CLARIFICATION_TEMPLATE.format(user_prompt=user_prompt)
+    def format_clarification(user_prompt: str) -> Tuple[str, str]:
+        """Generate clarification prompt as (system, user) messages"""
+        return PromptManager.CLARIFICATION_SYSTEM_PROMPT, f"""User Input:
+{user_prompt}
+
+Generate output now."""
     
     @staticmethod
     def merge_context(user_prompt: str, answers: str) -> str:
@@ -44,9 +170,19 @@ Additional Context (from clarification):
         agent: AgentType,
         merged_context: str,
         history: List[RoundOutput],
-        current_round: int
-    ) -> str:
-        """Format prompt for Expansion (A) or Compression (B) agent"""
+        current_round: int,
+        transcript: Optional[TranscriptBuilder] = None,
+        history_text: Optional[str] = None
+    ) -> Tuple[str, str]:
+        """
+        Format prompt for Expansion (A) or Compression (B) agent as (system, user) messages
+        
+        Args:
+            transcript: Session transcript builder to reuse; a throwaway one is
+                used when omitted
+            history_text: Pre-rendered (e.g. budgeted) history used instead of
+                the full transcript
+        """
         
         # Select system prompt
         if agent == AgentType.EXPANSION:
@@ -55,51 +191,56 @@ Additional Context (from clarification):
             system_prompt = PromptManager.COMPRESSION_SYSTEM_PROMPT
         
         # Assemble full debate history
-        transcript = ""
+        history_block = ""
         if history:
-            transcript_parts = []
-            for output in history:
-                transcript_parts.append(f"--- Round {output.round_number} | Agent {output.agent.value} ---\n{output.content}\n")
-            transcript = "\n".join(transcript_parts)
-            transcript = f"\n\nDEBATE HISTORY:\n{transcript}"
+            rendered = history_text if history_text is not None else (transcript or TranscriptBuilder()).render(history)
+            history_block = f"\n\nDEBATE HISTORY:\n{rendered}"
         
-        return f"""[INST]
-{system_prompt}
-
-User Context (Merged with Clarification):
+        return system_prompt, f"""User Context (Merged with Clarification):
 {merged_context}
-{transcript}
+{history_block}
 
-This is Round {current_round}. Generate your response now.
-[/INST]"""
+This is Round {current_round}. Generate your response now."""
+    
+    @staticmethod
+    def format_history_summary(
+        previous_summary: Optional[str],
+        outputs: List[RoundOutput],
+        max_words: int
+    ) -> Tuple[str, str]:
+        """Format the rolling-summary prompt (folds new rounds into the existing summary) as (system, user) messages"""
+        new_rounds = "\n".join(TranscriptBuilder.render_entry(o) for o in outputs)
+        return PromptManager.HISTORY_SUMMARY_SYSTEM_PROMPT, f"""EXISTING SUMMARY (earlier rounds):
+{previous_summary or "(none yet)"}
+
+NEW ROUNDS TO FOLD IN:
+{new_rounds}
+
+Write the updated summary in under {max_words} words now."""
     
     def format_meta(self, user_prompt: str) -> str:
         return self.META_AGENT_TEMPLATE.format(user_prompt=user_prompt)
 
     @staticmethod
-    def format_synthesis(merged_context: str, history: List[RoundOutput]) -> str:
-        """Format synthesis prompt with full debate transcript"""
+    def format_synthesis(
+        merged_context: str,
+        history: List[RoundOutput],
+        transcript: Optional[TranscriptBuilder] = None,
+        history_text: Optional[str] = None
+    ) -> Tuple[str, str]:
+        """Format synthesis prompt as (system, user) messages with full (or budgeted, via history_text) debate transcript"""
         
         # Assemble complete debate transcript
-        transcript_parts = []
-        for output in history:
-            transcript_parts.append(
-                f"--- Round {output.round_number} | Agent {output.agent.value} ---\n{output.content}\n"
-            )
-        transcript = "\n".join(transcript_parts)
+        rendered = history_text if history_text is not None else (transcript or TranscriptBuilder()).render(history)
         
         round_count = max([o.round_number for o in history]) if history else 0
         
-        system_prompt = PromptManager.SYNTHESIS_SYSTEM_PROMPT.format(round_count=round_count)
-        
-        return f"""[INST]
-{system_prompt}
-
-User Context:
+        return PromptManager.SYNTHESIS_SYSTEM_PROMPT, f"""User Context:
 {merged_context}
 
 Complete Debate Transcript:
-{transcript}
+{rendered}
+
+Round Count: {round_count}
 
-Generate final synthesis now.
-[/INST]"""
\ No newline at end of file
+Generate final synthesis now."""
\ No newline at end of file
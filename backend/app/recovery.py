@@ -0,0 +1,184 @@
+"""
+Startup crash recovery for in-flight sessions
+
+Sessions persist after every agent output, so a restart loses at most the
+agent call that was in flight. On startup, sessions left in a processing
+state are put back on the session worker queue:
+
+    INIT                   -> clarification is generated again
+    CLARIFICATION_COMPLETE -> the debate starts at round 1
+    ROUND_PROCESSING       -> the current round resumes; agents whose output
+                              is already in history are not run again
+    SYNTHESIS_PROCESSING   -> the synthesis is generated again
+
+CLARIFICATION_PENDING sessions are waiting on the user and are left alone.
+
+Recovery is paced (recovery_rate_per_second) and only fills a share of the
+worker queue, so a large backlog neither floods the provider nor locks out
+new sessions. Sessions older than recovery_max_age_hours, or that have
+already been recovered recovery_max_attempts times (a session that keeps
+crashing the process), are marked ERROR instead. With several worker
+processes on one host, a lock file makes sure only one of them recovers, and
+each session is handed to its owning worker through the event bus.
+"""
+
+import asyncio
+import fcntl
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from app.config import get_settings
+from app.event_bus import event_bus
+from app.models import SessionState
+from app.session_store import session_store
+from app.session_workers import session_workers, PoolFullError, PoolUnavailableError
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+RECOVERABLE_STATES = (
+    SessionState.INIT,
+    SessionState.CLARIFICATION_COMPLETE,
+    SessionState.ROUND_PROCESSING,
+    SessionState.SYNTHESIS_PROCESSING,
+)
+
+class SessionRecovery:
+    """Finds orphaned in-flight sessions and re-queues them at a bounded rate"""
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._lock_file = None
+        self.report: Dict[str, Any] = {"status": "idle"}
+    
+    def _acquire_lock(self) -> bool:
+        """Take the host-wide recovery lock (held until the process exits)"""
+        lock_path = Path(settings.session_storage_path) / ".recovery.lock"
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        handle = open(lock_path, "a")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self._lock_file = handle
+        return True
+    
+    def start(self) -> None:
+        """Run recovery in the background (does not delay startup)"""
+        if not settings.enable_session_recovery or self._task is not None:
+            return
+        self._task = asyncio.create_task(self.run(), name="session-recovery")
+    
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+    
+    async def _wait_for_queue_room(self, session_id: UUID) -> None:
+        """
+        Keep recovered sessions to a share of the local queue, leaving room
+        for new users, and wait while the session's owner has a full queue.
+        
+        Raises:
+            PoolUnavailableError: The owner's pool is not running
+        """
+        limit = max(1, int(session_workers.max_queue_depth * settings.recovery_queue_share))
+        while session_workers.queue_depth >= limit:
+            await asyncio.sleep(1.0)
+        while True:
+            try:
+                await event_bus.admit(session_id)
+                return
+            except PoolFullError as e:
+                await asyncio.sleep(e.retry_after)
+    
+    async def _abandon(self, session_id: UUID, reason: str) -> None:
+        session = await session_store.load(session_id)
+        if session is None:
+            return
+        session.state = SessionState.ERROR
+        session.error_message = reason
+        await session_store.save(session)
+        logger.warning(f"[{session_id}] Not recovered: {reason}")
+    
+    async def run(self) -> Dict[str, Any]:
+        """
+        Re-queue every recoverable session, oldest first.
+        
+        Returns:
+            Recovery report (also kept in self.report)
+        """
+        if not await asyncio.to_thread(self._acquire_lock):
+            self.report = {"status": "skipped", "reason": "another process holds the recovery lock"}
+            logger.info("Session recovery skipped: another process is recovering")
+            return self.report
+        
+        started = time.monotonic()
+        candidates = await session_store.list_sessions(states=RECOVERABLE_STATES)
+        candidates.reverse()  # oldest first
+        self.report = {"status": "running", "found": len(candidates), "requeued": 0, "abandoned": 0, "failed": 0}
+        if not candidates:
+            self.report["status"] = "complete"
+            return self.report
+        logger.info(f"Session recovery: {len(candidates)} in-flight sessions found")
+        
+        interval = 1.0 / settings.recovery_rate_per_second if settings.recovery_rate_per_second > 0 else 0.0
+        cutoff = time.time() - settings.recovery_max_age_hours * 3600
+        
+        for summary in candidates:
+            session_id = UUID(summary["session_id"])
+            try:
+                if summary["created_at"] < cutoff:
+                    await self._abandon(session_id, "Abandoned after restart (session too old to resume)")
+                    self.report["abandoned"] += 1
+                    continue
+                
+                session = await session_store.load(session_id)
+                if session is None or session.state not in RECOVERABLE_STATES:
+                    continue
+                if session.recovery_attempts >= settings.recovery_max_attempts:
+                    await self._abandon(
+                        session_id,
+                        f"Abandoned after {session.recovery_attempts} restarts while processing"
+                    )
+                    self.report["abandoned"] += 1
+                    continue
+                
+                await self._wait_for_queue_room(session_id)
+                session.recovery_attempts += 1
+                await session_store.save(session, flush=True)
+                try:
+                    await event_bus.submit(session_id)
+                except PoolUnavailableError:
+                    # Not queued anywhere: this attempt does not count
+                    session.recovery_attempts -= 1
+                    await session_store.save(session, flush=True)
+                    raise
+                self.report["requeued"] += 1
+                logger.info(
+                    f"[{session_id}] Recovered in {session.state.value} at round {session.current_round} "
+                    f"({len(session.history)} persisted outputs, attempt {session.recovery_attempts})"
+                )
+            except (PoolFullError, PoolUnavailableError) as e:
+                # Leave it for the next restart rather than dropping it
+                self.report["failed"] += 1
+                logger.warning(f"[{session_id}] Recovery deferred: {e}")
+            except Exception as e:
+                self.report["failed"] += 1
+                logger.error(f"[{session_id}] Recovery failed: {e}", exc_info=True)
+            
+            if interval:
+                await asyncio.sleep(interval)
+        
+        self.report["status"] = "complete"
+        self.report["duration_s"] = round(time.monotonic() - started, 2)
+        logger.info(f"Session recovery complete: {self.report}")
+        return self.report
+
+# Singleton instance
+session_recovery = SessionRecovery()
@@ -0,0 +1,136 @@
+"""
+Content-addressed LLM response cache
+
+Completions are keyed by a SHA-256 hash of the full request payload (model,
+messages, sampling parameters, max_tokens), so only byte-identical requests
+share an entry. Two tiers are kept:
+
+    memory: LRU of recent results, bounded by entry count
+    disk:   one JSON file per key under settings.response_cache_path, shared
+            across restarts (and across workers on the same host)
+
+Entries expire after a per-TaskType TTL; a TTL of 0 disables caching for that
+task type.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from app.model_config import TaskType
+from app.session_journal import atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+# Request fields that change transport, not content
+NON_CONTENT_FIELDS = ("stream", "stream_options")
+
+def payload_key(payload: Dict[str, Any]) -> str:
+    """Stable hash of a chat completion request payload"""
+    content = {k: v for k, v in payload.items() if k not in NON_CONTENT_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Two-tier (memory LRU + disk) cache of generation results"""
+    
+    def __init__(
+        self,
+        max_entries: int,
+        disk_path: Optional[Path],
+        ttls: Dict[str, int],
+        default_ttl: int
+    ):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        if self.disk_path:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+    
+    def ttl_for(self, task_type: Optional[TaskType]) -> int:
+        """TTL in seconds for a task type (0 = not cached)"""
+        task = (task_type or TaskType.GENERAL).value
+        return int(self.ttls.get(task, self.default_ttl))
+    
+    def _disk_file(self, key: str) -> Path:
+        return self.disk_path / key[:2] / f"{key}.json"
+    
+    def _read_disk(self, key: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        path = self._disk_file(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Discarding unreadable response cache entry {key}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        if entry["expires_at"] <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["expires_at"], entry["result"]
+    
+    def _write_disk(self, key: str, expires_at: float, result: Dict[str, Any]) -> None:
+        path = self._disk_file(key)
+        path.parent.mkdir(exist_ok=True)
+        atomic_write_text(path, json.dumps({"expires_at": expires_at, "result": result}))
+    
+    def _remember(self, key: str, expires_at: float, result: Dict[str, Any]) -> None:
+        self._memory[key] = (expires_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a cached result; returns a copy, or None on miss/expiry"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, result = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return dict(result)
+            del self._memory[key]
+        
+        if self.disk_path:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self._remember(key, *entry)
+                self._stats["hits"] += 1
+                self._stats["disk_hits"] += 1
+                return dict(entry[1])
+        
+        self._stats["misses"] += 1
+        return None
+    
+    async def put(self, key: str, result: Dict[str, Any], task_type: Optional[TaskType]) -> None:
+        """Store a result under the task type's TTL"""
+        ttl = self.ttl_for(task_type)
+        if ttl <= 0:
+            return
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, result)
+        self._stats["stores"] += 1
+        if self.disk_path:
+            try:
+                await asyncio.to_thread(self._write_disk, key, expires_at, result)
+            except OSError as e:
+                logger.warning(f"Failed to persist response cache entry {key}: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and occupancy"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
@@ -0,0 +1,164 @@
+"""
+Round executor: runs a debate round as a dependency graph of agents
+
+Each round is described by a RoundGraph: a set of agent nodes, each listing
+the agents (of the same round) whose outputs it needs. Independent agents run
+concurrently; a dependent agent starts as soon as its own dependencies have
+finished. The default graph (settings.round_graph) reproduces the classic
+sequential pair:
+
+    EXPANSION -> COMPRESSION
+
+Outputs are reported to on_complete the moment each agent finishes, but are
+committed (appended to session history) in the graph's topological order, so
+history order is deterministic no matter which agent finishes first.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.model_config import TaskType
+from app.models import AgentType, RoundOutput
+
+logger = logging.getLogger(__name__)
+
+class AgentNode:
+    """One agent in a round graph"""
+    
+    def __init__(self, agent: AgentType, depends_on: Iterable[AgentType] = (), task_type: TaskType = TaskType.DEBATE):
+        self.agent = agent
+        self.depends_on: Tuple[AgentType, ...] = tuple(depends_on)
+        self.task_type = task_type
+    
+    def __repr__(self) -> str:
+        deps = ", ".join(d.value for d in self.depends_on)
+        return f"AgentNode({self.agent.value} <- [{deps}])"
+
+class RoundGraph:
+    """Validated agent dependency graph with a stable topological order"""
+    
+    def __init__(self, nodes: List[AgentNode]):
+        if not nodes:
+            raise ValueError("Round graph needs at least one agent")
+        self.nodes: Dict[AgentType, AgentNode] = {}
+        for node in nodes:
+            if node.agent in self.nodes:
+                raise ValueError(f"Agent {node.agent.value} appears twice in round graph")
+            self.nodes[node.agent] = node
+        for node in nodes:
+            for dep in node.depends_on:
+                if dep not in self.nodes:
+                    raise ValueError(f"Agent {node.agent.value} depends on unknown agent {dep.value}")
+        self.order: List[AgentType] = self._topological_order(nodes)
+    
+    @staticmethod
+    def _topological_order(nodes: List[AgentNode]) -> List[AgentType]:
+        """Kahn's algorithm, breaking ties by declaration order"""
+        remaining = {node.agent: set(node.depends_on) for node in nodes}
+        order = []
+        while remaining:
+            ready = [node.agent for node in nodes if node.agent in remaining and not remaining[node.agent]]
+            if not ready:
+                cycle = ", ".join(a.value for a in remaining)
+                raise ValueError(f"Round graph has a dependency cycle among: {cycle}")
+            agent = ready[0]
+            order.append(agent)
+            del remaining[agent]
+            for deps in remaining.values():
+                deps.discard(agent)
+        return order
+    
+    @classmethod
+    def from_config(cls, config: Dict[str, List[str]]) -> "RoundGraph":
+        """Build a graph from {"AGENT": ["DEPENDENCY", ...]} (as in settings.round_graph)"""
+        return cls([
+            AgentNode(AgentType(agent), [AgentType(dep) for dep in deps])
+            for agent, deps in config.items()
+        ])
+
+class RoundExecutor:
+    """Runs one round of a RoundGraph with asyncio concurrency"""
+    
+    def __init__(self, graph: RoundGraph):
+        self.graph = graph
+    
+    async def run(
+        self,
+        round_number: int,
+        run_agent: Callable[[AgentNode, List[RoundOutput]], Awaitable[RoundOutput]],
+        commit: Callable[[RoundOutput], Awaitable[None]],
+        on_complete: Optional[Callable[[RoundOutput], Awaitable[None]]] = None,
+        completed: Optional[Dict[AgentType, RoundOutput]] = None
+    ) -> List[RoundOutput]:
+        """
+        Execute the round.
+        
+        Args:
+            round_number: Round being executed (for logging)
+            run_agent: async (node, dependency_outputs) -> RoundOutput; the
+                dependency outputs are given in topological order
+            commit: async (output) called in topological order to append an
+                output to history (and checkpoint it)
+            on_complete: async (output) called as soon as an agent finishes
+            completed: Outputs already committed for this round (e.g. when
+                resuming); those agents are not run again
+        
+        Returns:
+            The round's outputs in topological order
+        """
+        completed = dict(completed or {})
+        done: Dict[AgentType, asyncio.Future] = {}
+        loop = asyncio.get_running_loop()
+        for agent in self.graph.order:
+            done[agent] = loop.create_future()
+            if agent in completed:
+                done[agent].set_result(completed[agent])
+        
+        commit_index = 0
+        commit_lock = asyncio.Lock()
+        
+        async def _commit_ready() -> None:
+            # Commit the longest finished prefix of the topological order
+            nonlocal commit_index
+            async with commit_lock:
+                while commit_index < len(self.graph.order):
+                    agent = self.graph.order[commit_index]
+                    if not done[agent].done() or done[agent].exception() is not None:
+                        break
+                    if agent not in completed:
+                        await commit(done[agent].result())
+                    commit_index += 1
+        
+        async def _run(node: AgentNode) -> None:
+            dep_outputs = [
+                await done[dep]
+                for dep in self.graph.order
+                if dep in node.depends_on
+            ]
+            output = await run_agent(node, dep_outputs)
+            done[node.agent].set_result(output)
+            await _commit_ready()
+            if on_complete:
+                await on_complete(output)
+        
+        tasks = [
+            asyncio.create_task(_run(self.graph.nodes[agent]), name=f"round-{round_number}-{agent.value}")
+            for agent in self.graph.order
+            if agent not in completed
+        ]
+        if completed:
+            logger.info(
+                f"Round {round_number}: resuming, skipping completed agents "
+                f"{[a.value for a in self.graph.order if a in completed]}"
+            )
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        
+        await _commit_ready()
+        return [done[agent].result() for agent in self.graph.order]
@@ -0,0 +1,275 @@
+"""
+Pluggable session storage backends
+
+SessionStore owns the in-process cache and write-behind scheduling; a
+SessionBackend owns durable storage. Backends are selected with
+settings.session_backend:
+
+    "file":   one JSON snapshot per session (optionally with an append-only
+              journal, see settings.session_storage_mode)
+    "sqlite": embedded SQLite database in WAL mode with normalized, indexed
+              tables (see app.sqlite_backend)
+"""
+
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from app.models import SessionData, SessionState
+from app.session_journal import (
+    SNAPSHOT_SEQ_KEY,
+    JournalCursor,
+    SessionJournal,
+    apply_records,
+    atomic_write_text,
+    diff_records,
+    snapshot_payload,
+)
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATES = (SessionState.COMPLETE, SessionState.ERROR)
+
+def session_summary(session: SessionData) -> Dict[str, Any]:
+    """Compact listing row for a session (shared by every backend's list_sessions)"""
+    return {
+        "session_id": str(session.session_id),
+        "state": session.state.value,
+        "created_at": session.created_at,
+        "current_round": session.current_round,
+        "max_rounds": session.max_rounds,
+        "selected_model": session.selected_model,
+        "total_cost": session.cost_tracking.total_cost,
+    }
+
+def session_matches(
+    session: SessionData,
+    states: Optional[Iterable[SessionState]] = None,
+    created_after: Optional[float] = None,
+    created_before: Optional[float] = None,
+    model: Optional[str] = None
+) -> bool:
+    """Apply list_sessions filters to a loaded session (used by backends without indexes)"""
+    if states is not None and session.state not in set(states):
+        return False
+    if created_after is not None and session.created_at < created_after:
+        return False
+    if created_before is not None and session.created_at >= created_before:
+        return False
+    if model is not None:
+        used = {o.model_used for o in session.history} | set(session.cost_tracking.model_costs)
+        if model not in used and session.selected_model != model:
+            return False
+    return True
+
+class SessionBackend(ABC):
+    """Durable storage interface used by SessionStore"""
+    
+    # Short backend name (used as a metrics label)
+    name = "custom"
+    
+    @abstractmethod
+    async def write(self, session: SessionData) -> None:
+        """Persist the current state of a session"""
+    
+    @abstractmethod
+    async def read(self, session_id: UUID) -> Optional[SessionData]:
+        """Read a session, or None if it does not exist"""
+    
+    @abstractmethod
+    async def remove(self, session_id: UUID) -> bool:
+        """Delete a session; returns True if it existed"""
+    
+    @abstractmethod
+    async def list_sessions(
+        self,
+        states: Optional[Iterable[SessionState]] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None,
+        model: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Find sessions by state, creation time and model.
+        
+        Returns:
+            Session summaries (see session_summary), newest first
+        """
+    
+    def forget(self, session_id: UUID) -> None:
+        """Drop any per-session write state (on cache eviction or failed writes)"""
+    
+    async def close(self) -> None:
+        """Release backend resources"""
+
+class FileSessionBackend(SessionBackend):
+    """
+    One JSON document per session in settings.session_storage_path.
+    
+    Storage modes:
+        "snapshot": every write atomically replaces {session_id}.json
+        "journal": writes append only the changes to {session_id}.journal;
+            terminal sessions are compacted back into a single snapshot
+    """
+    
+    name = "file"
+    
+    def __init__(self, storage_path: Path, mode: str = "snapshot", journal_commit_delay: float = 0.0):
+        self.storage_path = storage_path
+        self.storage_path.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.journal = SessionJournal(self.storage_path, journal_commit_delay)
+        self._cursors: Dict[UUID, JournalCursor] = {}
+    
+    def _get_file_path(self, session_id: UUID) -> Path:
+        return self.storage_path / f"{session_id}.json"
+    
+    def forget(self, session_id: UUID) -> None:
+        self._cursors.pop(session_id, None)
+    
+    async def write(self, session: SessionData) -> None:
+        if self.mode == "journal" and session.state not in TERMINAL_STATES:
+            await self._write_journal(session)
+        else:
+            await self._write_snapshot(session)
+    
+    async def _write_snapshot(self, session: SessionData) -> None:
+        """Atomically replace the snapshot and drop any journal it supersedes"""
+        session_id = session.session_id
+        cursor = self._cursors.get(session_id)
+        if cursor is not None:
+            seq = cursor.seq
+        else:
+            # No cursor (evicted, released, a failed write, or snapshot mode):
+            # a journal may still hold records. The snapshot must claim them,
+            # or a reload would replay them on top of state that contains them.
+            seq = await asyncio.to_thread(self.journal.last_seq, session_id)
+        data = snapshot_payload(session, seq)
+        if self.mode == "journal":
+            self._cursors[session_id] = JournalCursor(session, seq)
+        
+        def _write():
+            atomic_write_text(self._get_file_path(session_id), data)
+            if seq:
+                # Every journaled record is folded into this snapshot
+                self.journal.discard(session_id)
+        
+        await asyncio.to_thread(_write)
+        logger.debug(f"Session {session_id} saved")
+    
+    async def _write_journal(self, session: SessionData) -> None:
+        """Append the changes since the last write to the session journal"""
+        session_id = session.session_id
+        cursor = self._cursors.get(session_id)
+        records = diff_records(session, cursor) if cursor else None
+        if records is None:
+            # No base snapshot yet (new session) or a non-append change
+            await self._write_snapshot(session)
+            return
+        
+        for record in records:
+            cursor.seq += 1
+            record["seq"] = cursor.seq
+        self._cursors[session_id] = JournalCursor(session, cursor.seq)
+        await self.journal.append(session_id, records)
+        logger.debug(f"Session {session_id} journaled ({len(records)} records)")
+    
+    def _read_file(self, session_id: UUID, repair: bool = True) -> Tuple[Optional[SessionData], int]:
+        """
+        Read snapshot plus journal tail (blocking).
+        
+        Args:
+            repair: Truncate a torn journal tail (only the session's writer should)
+        
+        Returns:
+            The session (or None) and its journal seq
+        """
+        file_path = self._get_file_path(session_id)
+        try:
+            data = json.loads(file_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None, 0
+        
+        seq = data.pop(SNAPSHOT_SEQ_KEY, 0)
+        tail = [r for r in self.journal.read(session_id, repair) if r.get("seq", 0) > seq]
+        if tail:
+            apply_records(data, tail)
+            seq = tail[-1]["seq"]
+        return SessionData.model_validate(data), seq
+    
+    def read_sync(self, session_id: UUID) -> Optional[SessionData]:
+        """Read a session from disk (blocking) and track it for journaled writes"""
+        session, seq = self._read_file(session_id)
+        if session is not None:
+            self._cursors[session_id] = JournalCursor(session, seq)
+        return session
+    
+    def peek_sync(self, session_id: UUID) -> Optional[SessionData]:
+        """Read a session from disk (blocking) without tracking it or modifying its files"""
+        session, _ = self._read_file(session_id, repair=False)
+        return session
+    
+    async def read(self, session_id: UUID) -> Optional[SessionData]:
+        return await asyncio.to_thread(self.read_sync, session_id)
+    
+    async def remove(self, session_id: UUID) -> bool:
+        self.forget(session_id)
+        self.journal.discard(session_id)
+        file_path = self._get_file_path(session_id)
+        if file_path.exists():
+            file_path.unlink()
+            return True
+        return False
+    
+    def session_ids(self) -> List[UUID]:
+        """All session ids with a snapshot on disk"""
+        ids = []
+        for path in self.storage_path.glob("*.json"):
+            try:
+                ids.append(UUID(path.stem))
+            except ValueError:
+                continue
+        return ids
+    
+    async def list_sessions(
+        self,
+        states: Optional[Iterable[SessionState]] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None,
+        model: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        # No index: every session on disk is parsed
+        def _scan():
+            rows = []
+            for session_id in self.session_ids():
+                try:
+                    session = self.peek_sync(session_id)
+                except Exception as e:
+                    logger.warning(f"Skipping unreadable session {session_id}: {e}")
+                    continue
+                if session and session_matches(session, states, created_after, created_before, model):
+                    rows.append(session_summary(session))
+            rows.sort(key=lambda row: row["created_at"], reverse=True)
+            return rows[:limit] if limit else rows
+        
+        return await asyncio.to_thread(_scan)
+
+def create_backend(settings) -> SessionBackend:
+    """Instantiate the backend selected by settings.session_backend"""
+    storage_path = Path(settings.session_storage_path)
+    if settings.session_backend == "sqlite":
+        from app.sqlite_backend import SQLiteSessionBackend
+        db_path = Path(settings.session_sqlite_path) if settings.session_sqlite_path else storage_path / "sessions.db"
+        return SQLiteSessionBackend(db_path)
+    if settings.session_backend != "file":
+        raise ValueError(f"Unknown session backend: {settings.session_backend}")
+    return FileSessionBackend(
+        storage_path,
+        mode=settings.session_storage_mode,
+        journal_commit_delay=settings.session_journal_commit_delay
+    )
@@ -0,0 +1,288 @@
+"""
+Append-only session journal
+
+Instead of rewriting the full session document on every save, the journal
+appends one JSON line per change (new RoundOutput, state transition, changed
+cost entries, other field updates) to a per-session log. Appends from concurrent
+sessions are group-committed: one writer thread writes every pending record
+and fsyncs each touched file once per batch.
+
+Fields that only grow between saves (timeline spans, model_reasoning lines,
+history_summaries entries, history_budget_calls) are journaled as the part
+that was added ("extend", "concat" and "merge" records), not rewritten in
+full, so a session's journal grows with its changes rather than with its size.
+
+Every record carries a per-session sequence number. Snapshots store the last
+sequence number they include ("journal_seq"), so a crash between writing a
+compacted snapshot and removing the old log never re-applies records.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from app.models import SessionData
+
+logger = logging.getLogger(__name__)
+
+# Snapshot key recording the last journal record folded into the snapshot
+SNAPSHOT_SEQ_KEY = "journal_seq"
+
+def atomic_write_text(path: Path, data: str) -> None:
+    """
+    Crash-atomic file replacement: write a temp file, fsync it, then rename.
+    
+    Readers see either the old or the new file, never a truncated one.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def snapshot_payload(session: SessionData, journal_seq: int) -> str:
+    """Serialize a session snapshot tagged with the journal sequence it covers"""
+    data = session.model_dump_json()
+    # Splice the marker into the top-level object instead of round-tripping
+    # through a dict; model_dump_json always emits a single JSON object
+    return f'{data[:-1]},"{SNAPSHOT_SEQ_KEY}":{journal_seq}}}'
+
+class JournalCursor:
+    """Last persisted view of a session, used to compute the next journal records"""
+    
+    def __init__(self, session: SessionData, seq: int):
+        self.seq = seq
+        self.history_len = len(session.history)
+        self.state = session.state
+        self.fields = session.model_dump(mode="json", exclude={"history", "state", "cost_tracking"})
+        self.cost = session.cost_tracking.model_dump(mode="json")
+
+def _growth_record(key: str, old: Any, new: Any) -> Optional[Dict[str, Any]]:
+    """
+    Record holding only what was added to a field, if the change is pure growth.
+    
+    Returns:
+        An "extend" (list), "concat" (str) or "merge" (dict) record for key,
+        or None if the old value is not a prefix/subset of the new one
+    """
+    if isinstance(old, list) and isinstance(new, list):
+        if len(new) > len(old) and new[:len(old)] == old:
+            return {"t": "extend", "k": key, "v": new[len(old):]}
+    elif isinstance(old, str) and isinstance(new, str):
+        if old and len(new) > len(old) and new.startswith(old):
+            return {"t": "concat", "k": key, "v": new[len(old):]}
+    elif isinstance(old, dict) and isinstance(new, dict):
+        if all(k in new and new[k] == v for k, v in old.items()):
+            return {"t": "merge", "k": key, "v": {k: v for k, v in new.items() if k not in old}}
+    return None
+
+def _cost_changes(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Entries of a CostTracking dump that changed since the last flush.
+    
+    Changed values are recorded as their new absolute value rather than a
+    numeric difference: replaying float differences would not reproduce the
+    live totals exactly, and absolute values make replay idempotent.
+    """
+    changes: Dict[str, Any] = {}
+    for key, value in new.items():
+        if key != "model_costs" and not isinstance(value, list) and value != old.get(key):
+            changes[key] = value
+    
+    old_models = old.get("model_costs", {})
+    model_changes = {}
+    for model, stats in new.get("model_costs", {}).items():
+        previous = old_models.get(model, {})
+        changed = {k: v for k, v in stats.items() if previous.get(k) != v}
+        if changed or model not in old_models:
+            model_changes[model] = changed
+    if model_changes:
+        changes["model_costs"] = model_changes
+    return changes
+
+def diff_records(session: SessionData, cursor: JournalCursor) -> Optional[List[Dict[str, Any]]]:
+    """
+    Compute the journal records that bring the cursor's view up to date.
+    
+    Returns:
+        List of records (without sequence numbers), or None if the change cannot
+        be expressed as appends (e.g. history was rewritten) and a full
+        snapshot is required.
+    """
+    if len(session.history) < cursor.history_len:
+        return None
+    
+    records: List[Dict[str, Any]] = []
+    for output in session.history[cursor.history_len:]:
+        records.append({"t": "output", "v": output.model_dump(mode="json")})
+    
+    fields = session.model_dump(mode="json", exclude={"history", "state", "cost_tracking"})
+    changed = {}
+    for key, value in fields.items():
+        old = cursor.fields.get(key)
+        if old == value:
+            continue
+        growth = _growth_record(key, old, value)
+        if growth is not None:
+            records.append(growth)
+        else:
+            changed[key] = value
+    if changed:
+        records.append({"t": "fields", "v": changed})
+    
+    cost_dump = session.cost_tracking.model_dump(mode="json")
+    cost = _cost_changes(cursor.cost, cost_dump)
+    for key, value in cost_dump.items():
+        # List entries (history_budget_calls) only ever grow
+        old = cursor.cost.get(key)
+        if isinstance(value, list) and value != old:
+            growth = _growth_record(f"cost_tracking.{key}", old or [], value)
+            if growth is not None:
+                records.append(growth)
+            else:
+                cost[key] = value
+    if cost:
+        records.append({"t": "cost", "v": cost})
+    
+    # State last, so a replayed transition always follows the data it covers
+    if session.state != cursor.state:
+        records.append({"t": "state", "v": session.state.value})
+    return records
+
+def _growth_target(data: Dict[str, Any], key: str) -> Tuple[Dict[str, Any], str]:
+    """Object holding a (possibly dotted, e.g. cost_tracking.history_budget_calls) key"""
+    *parents, name = key.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    return data, name
+
+def apply_records(data: Dict[str, Any], records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply journal records (newer than the snapshot) to a snapshot dict in place"""
+    for record in records:
+        kind, value = record.get("t"), record.get("v")
+        if kind == "output":
+            data.setdefault("history", []).append(value)
+        elif kind == "fields":
+            data.update(value)
+        elif kind in ("extend", "concat", "merge"):
+            target, name = _growth_target(data, record["k"])
+            if kind == "concat":
+                target[name] = (target.get(name) or "") + value
+            elif kind == "extend":
+                if target.get(name) is None:
+                    target[name] = []
+                target[name].extend(value)
+            else:
+                if target.get(name) is None:
+                    target[name] = {}
+                target[name].update(value)
+        elif kind == "state":
+            data["state"] = value
+        elif kind == "cost":
+            cost = data.setdefault("cost_tracking", {})
+            model_costs = cost.setdefault("model_costs", {})
+            for model, changed in value.get("model_costs", {}).items():
+                model_costs.setdefault(model, {}).update(changed)
+            cost.update({k: v for k, v in value.items() if k != "model_costs"})
+        else:
+            logger.warning(f"Skipping unknown journal record type: {kind}")
+    return data
+
+class SessionJournal:
+    """Per-session append-only logs with group-commit fsync"""
+    
+    def __init__(self, storage_path: Path, commit_delay: float = 0.0):
+        self.storage_path = storage_path
+        self.commit_delay = commit_delay
+        self._pending: List[Tuple[UUID, List[str], asyncio.Future]] = []
+        self._commit_task: Optional[asyncio.Task] = None
+    
+    def get_path(self, session_id: UUID) -> Path:
+        return self.storage_path / f"{session_id}.journal"
+    
+    async def append(self, session_id: UUID, records: List[Dict[str, Any]]) -> None:
+        """Append records and wait until they are durable (fsynced)"""
+        if not records:
+            return
+        lines = [json.dumps(record, separators=(",", ":")) + "\n" for record in records]
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((session_id, lines, future))
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit_loop())
+        await future
+    
+    async def _commit_loop(self) -> None:
+        """Drain pending appends in batches; each batch costs one fsync per file"""
+        while self._pending:
+            if self.commit_delay:
+                # Give concurrent sessions a moment to join this batch
+                await asyncio.sleep(self.commit_delay)
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+    
+    def _write_batch(self, batch: List[Tuple[UUID, List[str], asyncio.Future]]) -> None:
+        by_session: Dict[UUID, List[str]] = {}
+        for session_id, lines, _ in batch:
+            by_session.setdefault(session_id, []).extend(lines)
+        for session_id, lines in by_session.items():
+            with open(self.get_path(session_id), "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def read(self, session_id: UUID, repair: bool = True) -> List[Dict[str, Any]]:
+        """
+        Read all records of a session log (blocking).
+        
+        A torn trailing line left by a crash mid-append is discarded. With
+        repair (the session's writer) it is also truncated away, so later
+        appends start on a clean line; other readers leave the file untouched.
+        """
+        path = self.get_path(session_id)
+        try:
+            raw = path.read_bytes()
+        except FileNotFoundError:
+            return []
+        
+        complete_end = raw.rfind(b"\n") + 1
+        if complete_end < len(raw) and repair:
+            logger.warning(f"Session {session_id} journal has a torn tail; truncating {len(raw) - complete_end} bytes")
+            with open(path, "r+b") as f:
+                f.truncate(complete_end)
+        
+        records = []
+        for line in raw[:complete_end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.error(f"Session {session_id} journal has a corrupt record; stopping replay there")
+                break
+        return records
+    
+    def last_seq(self, session_id: UUID) -> int:
+        """Sequence number of the last durable record of a session log (blocking), or 0"""
+        records = self.read(session_id)
+        return records[-1].get("seq", 0) if records else 0
+    
+    def discard(self, session_id: UUID) -> None:
+        """Remove a session log (blocking); used after compaction and on delete"""
+        try:
+            self.get_path(session_id).unlink()
+        except FileNotFoundError:
+            pass
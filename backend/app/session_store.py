@@ -1,54 +1,306 @@
-import json
-import os
-import aiofiles
-from pathlib import Path
-from typing import Optional
+import asyncio
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
 from uuid import UUID
-from app.models import SessionData
+from app.models import SessionData, SessionState
 from app.config import get_settings
+from app.session_backends import SessionBackend, create_backend
+from app.metrics import STORE_OPERATION_DURATION
+from app.tracing import span
 import logging
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
 class SessionStore:
-    """File-based session persistence"""
+    """
+    Session persistence with an in-process write-behind cache.
     
-    def __init__(self):
-        self.storage_path = Path(settings.session_storage_path)
-        self.storage_path.mkdir(parents=True, exist_ok=True)
+    Live SessionData objects are kept in an LRU cache bounded by entry count and
+    approximate memory size. Saves mark a session dirty and schedule a delayed
+    background flush, so the several saves made per debate round coalesce into
+    one disk write. State transitions (and explicit flush=True) are written
+    synchronously so persisted state never lags a transition.
     
-    def _get_file_path(self, session_id: UUID) -> Path:
-        return self.storage_path / f"{session_id}.json"
+    Durable storage is delegated to a SessionBackend (settings.session_backend).
     
-    async def save(self, session: SessionData) -> None:
-        """Save session to disk"""
-        file_path = self._get_file_path(session.session_id)
-        async with aiofiles.open(file_path, 'w') as f:
-            await f.write(session.model_dump_json(indent=2))
-        logger.debug(f"Session {session.session_id} saved")
+    With several worker processes, only the process owning a session (see
+    app.event_bus) may cache it; saves and loads of sessions owned elsewhere go
+    straight to the backend so no process serves a stale copy.
+    """
+    
+    def __init__(self, backend: Optional[SessionBackend] = None):
+        self.backend = backend or create_backend(settings)
+        
+        self.write_behind = settings.session_write_behind
+        self.flush_delay = settings.session_flush_delay
+        self.max_entries = settings.session_cache_max_entries
+        self.max_bytes = settings.session_cache_max_bytes
+        
+        self._cache: "OrderedDict[UUID, SessionData]" = OrderedDict()
+        self._sizes: Dict[UUID, int] = {}
+        self._cache_bytes = 0
+        self._dirty: Set[UUID] = set()
+        self._flush_tasks: Dict[UUID, asyncio.Task] = {}
+        self._write_locks: Dict[UUID, asyncio.Lock] = {}
+        self._persisted_state: Dict[UUID, SessionState] = {}
+        
+        # Ownership predicate, replaced by the event bus when running multi-process
+        self.owns: Callable[[UUID], bool] = lambda session_id: True
+    
+    @staticmethod
+    def _estimate_size(session: SessionData) -> int:
+        """Approximate in-memory footprint of a session (dominated by text fields)"""
+        size = 1024
+        for text in (
+            session.original_user_prompt,
+            session.clarification_questions,
+            session.clarification_answers,
+            session.merged_user_prompt,
+            session.model_reasoning,
+            session.error_message,
+        ):
+            if text:
+                size += len(text)
+        for output in session.history:
+            size += 256 + len(output.content)
+        return size
+    
+    # =============== CACHE ===============
+    
+    def _cache_put(self, session: SessionData) -> None:
+        """Insert or refresh a session in the LRU cache"""
+        session_id = session.session_id
+        size = self._estimate_size(session)
+        self._cache_bytes += size - self._sizes.get(session_id, 0)
+        self._sizes[session_id] = size
+        self._cache[session_id] = session
+        self._cache.move_to_end(session_id)
+    
+    def _cache_pop(self, session_id: UUID) -> None:
+        """Drop a session from the cache"""
+        self._cache.pop(session_id, None)
+        self._cache_bytes -= self._sizes.pop(session_id, 0)
+        self._persisted_state.pop(session_id, None)
+        self._write_locks.pop(session_id, None)
+        self.backend.forget(session_id)
+    
+    async def _evict(self) -> None:
+        """Evict least recently used sessions until the cache fits its limits"""
+        while self._cache and (len(self._cache) > self.max_entries or self._cache_bytes > self.max_bytes):
+            session_id = next(iter(self._cache))
+            if session_id in self._dirty:
+                # Never drop unsaved changes: write them out first
+                await self._flush(session_id)
+                if session_id not in self._cache:
+                    continue
+            self._cancel_flush(session_id)
+            self._cache_pop(session_id)
+            logger.debug(f"Session {session_id} evicted from cache")
+    
+    # =============== WRITE-BEHIND ===============
+    
+    def _cancel_flush(self, session_id: UUID) -> None:
+        task = self._flush_tasks.pop(session_id, None)
+        if task is not None and task is not asyncio.current_task() and not task.done():
+            task.cancel()
+    
+    def _schedule_flush(self, session_id: UUID) -> None:
+        """Schedule a delayed flush; further saves before it fires are coalesced"""
+        if session_id in self._flush_tasks:
+            return
+        self._flush_tasks[session_id] = asyncio.create_task(self._delayed_flush(session_id))
+    
+    async def _delayed_flush(self, session_id: UUID) -> None:
+        try:
+            await asyncio.sleep(self.flush_delay)
+            await self._flush(session_id)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Background flush of session {session_id} failed: {e}", exc_info=True)
+    
+    async def _flush(self, session_id: UUID) -> None:
+        """Write the cached session to disk if it has unsaved changes"""
+        self._cancel_flush(session_id)
+        lock = self._write_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            session = self._cache.get(session_id)
+            if session is None or session_id not in self._dirty:
+                return
+            # Capture the changes synchronously so saves made while the write
+            # is in flight mark the session dirty again instead of being lost
+            self._dirty.discard(session_id)
+            state = session.state
+            try:
+                with STORE_OPERATION_DURATION.time(operation="write", backend=self.backend.name), span("store.write"):
+                    await self.backend.write(session)
+            except Exception:
+                self._dirty.add(session_id)
+                # Resynchronize from a full write on the next flush
+                self.backend.forget(session_id)
+                raise
+            self._persisted_state[session_id] = state
+    
+    async def flush_all(self) -> None:
+        """Write every dirty session to disk (called on shutdown)"""
+        for session_id in list(self._dirty):
+            try:
+                await self._flush(session_id)
+            except Exception as e:
+                logger.error(f"Failed to flush session {session_id}: {e}")
+    
+    async def close(self) -> None:
+        """Flush pending writes and stop background flush tasks"""
+        await self.flush_all()
+        for session_id in list(self._flush_tasks):
+            self._cancel_flush(session_id)
+        await self.backend.close()
+    
+    # =============== PUBLIC API ===============
+    
+    async def save(self, session: SessionData, flush: bool = False) -> None:
+        """
+        Save session (write-behind).
+        
+        Args:
+            session: Session to persist
+            flush: Write to disk before returning. State transitions are
+                always flushed synchronously.
+        """
+        with STORE_OPERATION_DURATION.time(operation="save", backend=self.backend.name), span("store.save"):
+            session_id = session.session_id
+            session.version += 1
+            if not self.owns(session_id):
+                await self._write_through(session)
+                return
+            self._cache_put(session)
+            self._dirty.add(session_id)
+            
+            state_changed = self._persisted_state.get(session_id) != session.state
+            if flush or state_changed or not self.write_behind:
+                await self._flush(session_id)
+            else:
+                self._schedule_flush(session_id)
+            
+            await self._evict()
+    
+    async def flush(self, session_id: UUID) -> None:
+        """Write one session's unsaved changes now (before another process reads it from storage)"""
+        await self._flush(session_id)
     
     async def load(self, session_id: UUID) -> Optional[SessionData]:
-        """Load session from disk"""
-        file_path = self._get_file_path(session_id)
-        if not file_path.exists():
+        """Load session from cache, falling back to disk"""
+        with STORE_OPERATION_DURATION.time(operation="load", backend=self.backend.name), span("store.load"):
+            return await self._load(session_id)
+    
+    async def _load(self, session_id: UUID) -> Optional[SessionData]:
+        if not self.owns(session_id):
+            await self.release(session_id)
+            with STORE_OPERATION_DURATION.time(operation="read", backend=self.backend.name), span("store.read"):
+                return await self.backend.read(session_id)
+        
+        session = self._cache.get(session_id)
+        if session is not None:
+            self._cache.move_to_end(session_id)
+            return session
+        
+        with STORE_OPERATION_DURATION.time(operation="read", backend=self.backend.name), span("store.read"):
+            session = await self.backend.read(session_id)
+        if session is None:
             logger.warning(f"Session {session_id} not found")
             return None
+        logger.debug(f"Session {session_id} loaded")
         
-        async with aiofiles.open(file_path, 'r') as f:
-            data = await f.read()
-            session = SessionData.model_validate_json(data)
-            logger.debug(f"Session {session_id} loaded")
-            return session
+        self._cache_put(session)
+        self._persisted_state[session_id] = session.state
+        await self._evict()
+        return session
+    
+    async def _write_through(self, session: SessionData) -> None:
+        """Write a session owned by another process without caching it"""
+        session_id = session.session_id
+        await self.release(session_id)
+        with STORE_OPERATION_DURATION.time(operation="write", backend=self.backend.name), span("store.write"):
+            await self.backend.write(session)
+        # Backends may track per-session write state (journal cursors); start over next time
+        self.backend.forget(session_id)
+    
+    async def release(self, session_id: UUID) -> None:
+        """Flush and drop a cached session (its ownership moved to another process)"""
+        if session_id not in self._cache:
+            return
+        if session_id in self._dirty:
+            await self._flush(session_id)
+        self._cancel_flush(session_id)
+        self._cache_pop(session_id)
+    
+    def cached_version(self, session_id: UUID) -> Optional[int]:
+        """
+        Version of a cached session, without touching storage.
+        
+        Returns:
+            SessionData.version, or None if the session is not cached here
+        """
+        if not self.owns(session_id):
+            return None
+        session = self._cache.get(session_id)
+        return session.version if session is not None else None
+    
+    def invalidate(self, session_id: UUID) -> None:
+        """
+        Forget the cached copy of a session another process has just written.
+        
+        Unflushed changes are discarded: the other process's write is newer.
+        """
+        self._cancel_flush(session_id)
+        self._dirty.discard(session_id)
+        self._cache_pop(session_id)
     
     async def delete(self, session_id: UUID) -> bool:
-        """Delete session from disk"""
-        file_path = self._get_file_path(session_id)
-        if file_path.exists():
-            file_path.unlink()
+        """Delete session from cache and disk"""
+        self._cancel_flush(session_id)
+        self._dirty.discard(session_id)
+        self._cache_pop(session_id)
+        
+        deleted = await self.backend.remove(session_id)
+        if deleted:
             logger.info(f"Session {session_id} deleted")
-            return True
-        return False
+        return deleted
+    
+    async def list_sessions(
+        self,
+        states: Optional[Iterable[SessionState]] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None,
+        model: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Find sessions by state, creation time and model.
+        
+        Pending write-behind changes are flushed first so results reflect the
+        live sessions.
+        
+        Returns:
+            Session summaries, newest first
+        """
+        await self.flush_all()
+        return await self.backend.list_sessions(
+            states=states,
+            created_after=created_after,
+            created_before=created_before,
+            model=model,
+            limit=limit
+        )
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """Current cache occupancy"""
+        return {
+            "entries": len(self._cache),
+            "approx_bytes": self._cache_bytes,
+            "dirty": len(self._dirty),
+        }
 
 # Singleton instance
 session_store = SessionStore()
@@ -0,0 +1,210 @@
+"""
+Bounded worker pool for background session processing
+
+Sessions that need processing are queued and served by a fixed number of
+async workers, so a process never runs more than session_workers sessions at
+once. The queue itself is bounded by session_queue_max_depth; when it is full
+new work is refused (HTTP 429 with a Retry-After estimate) instead of piling
+up. Waiting sessions are told their queue position whenever it changes.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+from uuid import UUID
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+class PoolFullError(Exception):
+    """The session queue is at its depth limit"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Session queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class PoolUnavailableError(Exception):
+    """The pool is not accepting work (not started or shutting down)"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__("Session worker pool is not accepting work")
+        self.retry_after = retry_after
+
+class SessionWorkerPool:
+    """Fixed-size pool of async workers consuming a bounded session queue"""
+    
+    # Smoothing factor for the job duration estimate behind Retry-After
+    DURATION_EWMA_ALPHA = 0.2
+    
+    def __init__(self, size: int, max_queue_depth: int, default_job_seconds: float):
+        self.size = max(1, size)
+        self.max_queue_depth = max(0, max_queue_depth)
+        self._pending: Deque[UUID] = deque()
+        self._running: Set[UUID] = set()
+        self._rerun: Set[UUID] = set()
+        self._workers: List[asyncio.Task] = []
+        self._not_empty: Optional[asyncio.Condition] = None
+        self._handler: Optional[Callable[[UUID], Awaitable[None]]] = None
+        self._on_position: Optional[Callable[[UUID, int], Awaitable[None]]] = None
+        self._accepting = False
+        self._avg_job_seconds = default_job_seconds
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+    
+    async def start(
+        self,
+        handler: Callable[[UUID], Awaitable[None]],
+        on_position: Optional[Callable[[UUID, int], Awaitable[None]]] = None
+    ) -> None:
+        """
+        Start the workers.
+        
+        Args:
+            handler: async (session_id) run for each queued session
+            on_position: async (session_id, position) called when a waiting
+                session's 1-based queue position changes
+        """
+        if self._workers:
+            return
+        self._handler = handler
+        self._on_position = on_position
+        self._not_empty = asyncio.Condition()
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"session-worker-{i}")
+            for i in range(self.size)
+        ]
+        self._accepting = True
+        logger.info(f"Session worker pool started ({self.size} workers, queue limit {self.max_queue_depth})")
+    
+    async def stop(self) -> None:
+        """Stop accepting work and cancel the workers (unfinished sessions stay persisted mid-state)"""
+        self._accepting = False
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._pending or self._running:
+            logger.warning(
+                f"Session worker pool stopped with {len(self._running)} running and "
+                f"{len(self._pending)} queued sessions"
+            )
+        self._pending.clear()
+        self._running.clear()
+        self._rerun.clear()
+    
+    def retry_after(self) -> int:
+        """Estimated seconds until the queue has room again"""
+        backlog = len(self._pending) + 1 - self.max_queue_depth
+        waves = max(1, math.ceil(backlog / self.size))
+        return max(1, math.ceil(self._avg_job_seconds * waves))
+    
+    def check_admission(self) -> None:
+        """
+        Raise if new work would be refused.
+        
+        Endpoints call this before changing any session state, then submit()
+        once the session is saved.
+        
+        Raises:
+            PoolUnavailableError: The pool is not running
+            PoolFullError: The queue is at its depth limit
+        """
+        if not self._accepting:
+            raise PoolUnavailableError(retry_after=max(1, math.ceil(self._avg_job_seconds)))
+        if len(self._pending) >= self.max_queue_depth:
+            self._stats["rejected"] += 1
+            raise PoolFullError(retry_after=self.retry_after())
+    
+    async def submit(self, session_id: UUID) -> int:
+        """
+        Queue a session for processing.
+        
+        A session that is already queued is not queued twice; one that is
+        running is run again as soon as its current run finishes (its state
+        may have changed after the running job last looked at it).
+        
+        Returns:
+            1-based queue position, or 0 if a worker picked it up immediately
+        """
+        if not self._accepting:
+            raise PoolUnavailableError(retry_after=max(1, math.ceil(self._avg_job_seconds)))
+        if session_id in self._running:
+            self._rerun.add(session_id)
+            return 0
+        if session_id not in self._pending:
+            self._pending.append(session_id)
+            self._stats["submitted"] += 1
+            async with self._not_empty:
+                self._not_empty.notify()
+        return self.position(session_id) or 0
+    
+    def position(self, session_id: UUID) -> Optional[int]:
+        """1-based position of a waiting session, 0 if running, None if unknown"""
+        if session_id in self._running:
+            return 0
+        try:
+            return self._pending.index(session_id) + 1
+        except ValueError:
+            return None
+    
+    async def _notify_positions(self) -> None:
+        if self._on_position is None:
+            return
+        for index, session_id in enumerate(list(self._pending)):
+            try:
+                await self._on_position(session_id, index + 1)
+            except Exception as e:
+                logger.debug(f"[{session_id}] Queue position update failed: {e}")
+    
+    async def _worker(self, index: int) -> None:
+        while True:
+            async with self._not_empty:
+                while not self._pending:
+                    await self._not_empty.wait()
+                session_id = self._pending.popleft()
+            self._running.add(session_id)
+            await self._notify_positions()
+            
+            started = time.monotonic()
+            try:
+                await self._handler(session_id)
+                self._stats["completed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.error(f"[{session_id}] Session worker {index} failed: {e}", exc_info=True)
+            finally:
+                self._running.discard(session_id)
+                elapsed = time.monotonic() - started
+                self._avg_job_seconds += self.DURATION_EWMA_ALPHA * (elapsed - self._avg_job_seconds)
+            
+            if session_id in self._rerun:
+                self._rerun.discard(session_id)
+                self._pending.appendleft(session_id)
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Pool occupancy and counters"""
+        return {
+            "accepting": self._accepting,
+            "workers": self.size,
+            "running": len(self._running),
+            "queued": len(self._pending),
+            "max_queue_depth": self.max_queue_depth,
+            "avg_job_seconds": round(self._avg_job_seconds, 2),
+            **self._stats,
+        }
+
+session_workers = SessionWorkerPool(
+    size=settings.session_workers,
+    max_queue_depth=settings.session_queue_max_depth,
+    default_job_seconds=settings.session_job_estimate_seconds
+)
@@ -0,0 +1,390 @@
+"""
+Embedded SQLite session backend
+
+Sessions are stored in normalized tables (sessions, round_outputs,
+cost_entries, session_appends) with indexes on state, creation time and model,
+so sessions can be found without scanning and parsing every file. The database runs in WAL
+mode; writes go through one connection and reads through another, each used
+from worker threads so the event loop never blocks on disk.
+
+Writes are incremental: only RoundOutputs not yet in the database are
+inserted, and per-model cost entries are upserted. Other fields that only grow
+during a session (APPEND_FIELDS) are kept out of the sessions.data document,
+which is rewritten on every save, and stored as append-only session_appends
+rows instead.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import UUID
+
+from app.models import SessionData, SessionState
+from app.session_backends import SessionBackend
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    current_round INTEGER NOT NULL,
+    max_rounds INTEGER NOT NULL,
+    selected_model TEXT,
+    total_cost REAL NOT NULL DEFAULT 0,
+    total_input_tokens INTEGER NOT NULL DEFAULT 0,
+    total_output_tokens INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_state ON sessions(state);
+CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_selected_model ON sessions(selected_model);
+
+CREATE TABLE IF NOT EXISTS round_outputs (
+    session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    round_number INTEGER NOT NULL,
+    agent TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    tokens_used INTEGER,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    model_used TEXT,
+    cost REAL,
+    extra TEXT,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_round_outputs_model ON round_outputs(model_used);
+
+CREATE TABLE IF NOT EXISTS cost_entries (
+    session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+    model TEXT NOT NULL,
+    cost REAL NOT NULL DEFAULT 0,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    calls INTEGER NOT NULL DEFAULT 0,
+    extra TEXT,
+    PRIMARY KEY (session_id, model)
+);
+CREATE INDEX IF NOT EXISTS idx_cost_entries_model ON cost_entries(model);
+
+CREATE TABLE IF NOT EXISTS session_appends (
+    session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (session_id, field, seq)
+);
+"""
+
+# RoundOutput fields with their own columns; anything else goes to "extra"
+OUTPUT_COLUMNS = (
+    "round_number", "agent", "content", "timestamp", "tokens_used",
+    "input_tokens", "output_tokens", "model_used", "cost"
+)
+COST_COLUMNS = ("cost", "input_tokens", "output_tokens", "calls")
+
+# Growing session fields stored as session_appends rows -> how rows map to the value:
+#   "list": one JSON item per row, "dict": one JSON [key, value] entry per row,
+#   "text": appended chunks, concatenated in order
+APPEND_FIELDS = {
+    "timeline": "list",
+    "history_summaries": "dict",
+    "model_reasoning": "text",
+    "cost_tracking.history_budget_calls": "list",
+}
+
+def _pop_field(data: Dict[str, Any], field: str) -> Any:
+    """Remove a (dotted) field from a session document and return its value"""
+    *parents, name = field.split(".")
+    for parent in parents:
+        data = data.get(parent) or {}
+    return data.pop(name, None)
+
+def _set_field(data: Dict[str, Any], field: str, value: Any) -> None:
+    """Set a (dotted) field in a session document"""
+    *parents, name = field.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    data[name] = value
+
+class SQLiteSessionBackend(SessionBackend):
+    """SQLite (WAL) implementation of SessionBackend"""
+    
+    name = "sqlite"
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._write_conn = self._connect()
+        self._write_conn.executescript(SCHEMA)
+        self._read_conn = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        logger.info(f"SQLite session backend ready at {self.db_path}")
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+    
+    # =============== WRITE ===============
+    
+    def _write_session(self, conn: sqlite3.Connection, doc: Dict[str, Any]) -> None:
+        """Upsert one session, given as a SessionData JSON-mode dump, inside the caller's transaction"""
+        sid = doc["session_id"]
+        history = doc["history"]
+        cost = doc["cost_tracking"]
+        data = {k: v for k, v in doc.items() if k != "history"}
+        data["cost_tracking"] = {k: v for k, v in cost.items() if k != "model_costs"}
+        appends = {field: _pop_field(data, field) for field in APPEND_FIELDS}
+        
+        conn.execute(
+            """
+            INSERT INTO sessions (
+                session_id, state, created_at, updated_at, current_round, max_rounds,
+                selected_model, total_cost, total_input_tokens, total_output_tokens, data
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                state = excluded.state,
+                updated_at = excluded.updated_at,
+                current_round = excluded.current_round,
+                max_rounds = excluded.max_rounds,
+                selected_model = excluded.selected_model,
+                total_cost = excluded.total_cost,
+                total_input_tokens = excluded.total_input_tokens,
+                total_output_tokens = excluded.total_output_tokens,
+                data = excluded.data
+            """,
+            (
+                sid, doc["state"], doc["created_at"], time.time(),
+                doc["current_round"], doc["max_rounds"], doc["selected_model"],
+                cost["total_cost"], cost["total_input_tokens"], cost["total_output_tokens"],
+                json.dumps(data, separators=(",", ":"))
+            )
+        )
+        
+        # Round outputs are append-only: insert only rows past the stored tail
+        stored = conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM round_outputs WHERE session_id = ?", (sid,)
+        ).fetchone()[0]
+        if stored > len(history):
+            conn.execute("DELETE FROM round_outputs WHERE session_id = ? AND seq >= ?", (sid, len(history)))
+            stored = len(history)
+        rows = []
+        for seq, output in enumerate(history[stored:], start=stored):
+            extra = {k: v for k, v in output.items() if k not in OUTPUT_COLUMNS}
+            rows.append((sid, seq, *(output[c] for c in OUTPUT_COLUMNS), json.dumps(extra) if extra else None))
+        if rows:
+            conn.executemany(
+                f"INSERT INTO round_outputs (session_id, seq, {', '.join(OUTPUT_COLUMNS)}, extra) "
+                f"VALUES ({', '.join('?' * (len(OUTPUT_COLUMNS) + 3))})",
+                rows
+            )
+        
+        cost_rows = []
+        for model, stats in cost["model_costs"].items():
+            extra = {k: v for k, v in stats.items() if k not in COST_COLUMNS}
+            cost_rows.append((sid, model, *(stats.get(c, 0) for c in COST_COLUMNS), json.dumps(extra) if extra else None))
+        if cost_rows:
+            conn.executemany(
+                """
+                INSERT INTO cost_entries (session_id, model, cost, input_tokens, output_tokens, calls, extra)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(session_id, model) DO UPDATE SET
+                    cost = excluded.cost,
+                    input_tokens = excluded.input_tokens,
+                    output_tokens = excluded.output_tokens,
+                    calls = excluded.calls,
+                    extra = excluded.extra
+                """,
+                cost_rows
+            )
+        
+        self._write_appends(conn, sid, appends)
+    
+    def _write_appends(self, conn: sqlite3.Connection, sid: str, appends: Dict[str, Any]) -> None:
+        """Insert only the growth of each APPEND_FIELDS field; a field that shrank is rewritten"""
+        stored = {
+            row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT field, COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM session_appends "
+                "WHERE session_id = ? GROUP BY field",
+                (sid,)
+            )
+        }
+        rows = []
+        for field, kind in APPEND_FIELDS.items():
+            value = appends[field]
+            count, length = stored.get(field, (0, 0))
+            if kind == "text":
+                text = value or ""
+                if len(text) < length:
+                    conn.execute("DELETE FROM session_appends WHERE session_id = ? AND field = ?", (sid, field))
+                    count, length = 0, 0
+                if len(text) > length:
+                    rows.append((sid, field, count, text[length:]))
+                continue
+            
+            items = list(value.items()) if kind == "dict" else (value or [])
+            if len(items) < count:
+                conn.execute(
+                    "DELETE FROM session_appends WHERE session_id = ? AND field = ? AND seq >= ?",
+                    (sid, field, len(items))
+                )
+                count = len(items)
+            for seq, item in enumerate(items[count:], start=count):
+                rows.append((sid, field, seq, json.dumps(item, separators=(",", ":"))))
+        if rows:
+            conn.executemany("INSERT INTO session_appends (session_id, field, seq, value) VALUES (?, ?, ?, ?)", rows)
+    
+    def write_many_sync(self, sessions: List[SessionData]) -> None:
+        """Write several sessions in one transaction (blocking)"""
+        self.write_documents_sync([session.model_dump(mode="json") for session in sessions])
+    
+    def write_documents_sync(self, docs: List[Dict[str, Any]]) -> None:
+        """
+        Write several already-validated sessions in one transaction (blocking).
+        
+        Args:
+            docs: SessionData.model_dump(mode="json") results; used by bulk
+                migration so sessions validated in a worker are not re-parsed
+        """
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for doc in docs:
+                    self._write_session(conn, doc)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    
+    async def write(self, session: SessionData) -> None:
+        await asyncio.to_thread(self.write_many_sync, [session])
+        logger.debug(f"Session {session.session_id} saved")
+    
+    # =============== READ ===============
+    
+    def _read_sync(self, session_id: UUID) -> Optional[SessionData]:
+        sid = str(session_id)
+        with self._read_lock:
+            conn = self._read_conn
+            row = conn.execute("SELECT data FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+            if row is None:
+                return None
+            outputs = conn.execute(
+                f"SELECT {', '.join(OUTPUT_COLUMNS)}, extra FROM round_outputs WHERE session_id = ? ORDER BY seq",
+                (sid,)
+            ).fetchall()
+            costs = conn.execute(
+                f"SELECT model, {', '.join(COST_COLUMNS)}, extra FROM cost_entries WHERE session_id = ?",
+                (sid,)
+            ).fetchall()
+            appends = conn.execute(
+                "SELECT field, value FROM session_appends WHERE session_id = ? ORDER BY field, seq", (sid,)
+            ).fetchall()
+        
+        data = json.loads(row["data"])
+        history = []
+        for output in outputs:
+            entry = {c: output[c] for c in OUTPUT_COLUMNS}
+            if output["extra"]:
+                entry.update(json.loads(output["extra"]))
+            history.append(entry)
+        data["history"] = history
+        
+        model_costs = {}
+        for entry in costs:
+            stats = {c: entry[c] for c in COST_COLUMNS}
+            if entry["extra"]:
+                stats.update(json.loads(entry["extra"]))
+            model_costs[entry["model"]] = stats
+        data.setdefault("cost_tracking", {})["model_costs"] = model_costs
+        
+        # Rows replace the copy still embedded in "data" by older versions
+        grown: Dict[str, List[str]] = {}
+        for entry in appends:
+            grown.setdefault(entry["field"], []).append(entry["value"])
+        for field, values in grown.items():
+            kind = APPEND_FIELDS.get(field)
+            if kind == "text":
+                _set_field(data, field, "".join(values))
+            elif kind == "dict":
+                _set_field(data, field, dict(json.loads(v) for v in values))
+            elif kind == "list":
+                _set_field(data, field, [json.loads(v) for v in values])
+        return SessionData.model_validate(data)
+    
+    async def read(self, session_id: UUID) -> Optional[SessionData]:
+        return await asyncio.to_thread(self._read_sync, session_id)
+    
+    def _remove_sync(self, session_id: UUID) -> bool:
+        with self._write_lock:
+            cursor = self._write_conn.execute("DELETE FROM sessions WHERE session_id = ?", (str(session_id),))
+            return cursor.rowcount > 0
+    
+    async def remove(self, session_id: UUID) -> bool:
+        return await asyncio.to_thread(self._remove_sync, session_id)
+    
+    async def list_sessions(
+        self,
+        states: Optional[Iterable[SessionState]] = None,
+        created_after: Optional[float] = None,
+        created_before: Optional[float] = None,
+        model: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        clauses, params = [], []
+        if states is not None:
+            states = [SessionState(s).value for s in states]
+            if not states:
+                return []
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        if created_after is not None:
+            clauses.append("created_at >= ?")
+            params.append(created_after)
+        if created_before is not None:
+            clauses.append("created_at < ?")
+            params.append(created_before)
+        if model is not None:
+            clauses.append(
+                "(selected_model = ? OR session_id IN (SELECT session_id FROM cost_entries WHERE model = ?))"
+            )
+            params.extend([model, model])
+        
+        query = (
+            "SELECT session_id, state, created_at, current_round, max_rounds, selected_model, total_cost "
+            "FROM sessions"
+        )
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY created_at DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        def _query():
+            with self._read_lock:
+                return [dict(row) for row in self._read_conn.execute(query, params).fetchall()]
+        
+        return await asyncio.to_thread(_query)
+    
+    async def close(self) -> None:
+        with self._write_lock:
+            self._write_conn.close()
+        with self._read_lock:
+            self._read_conn.close()
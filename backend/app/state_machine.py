@@ -1,35 +1,59 @@
 import logging
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, List, Optional
+from app.config import get_settings
 from app.models import SessionData, SessionState, AgentType, RoundOutput
 from app.prompts import PromptManager
+from app.history_budget import HistoryBudgeter
 from app.ollama_client import zai_client
 from app.session_store import session_store
 from app.model_config import TaskType
+from app.model_router import model_router
+from app.token_estimator import token_estimator
+from app.round_executor import AgentNode, RoundExecutor, RoundGraph
+from app.metrics import PHASE_DURATION
+from app.tracing import span, traced
 
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
 class StateMachineOrchestrator:
     """Core state machine managing debate workflow with Z.AI model routing"""
     
     def __init__(self):
         self.prompts = PromptManager()
+        self.history_budget = HistoryBudgeter(self.prompts)
+        self.round_executor = RoundExecutor(RoundGraph.from_config(settings.round_graph))
     
     def _track_cost(self, session: SessionData, result: Dict[str, Any]) -> None:
         """
         Track API costs for a session.
         
+        Response cache hits are recorded as zero-cost calls: they count
+        towards the model's calls and cache_hits but add no billed tokens.
+        Time spent queued in the upstream scheduler is summed per model, and
+        the estimated cost of a cancelled hedge request is added to the total.
+        
         Args:
             session: Current session data
             result: API response with cost information
         """
+        cache_hit = result.get("cache_hit", False)
         cost = result.get("cost", 0.0)
-        input_tokens = result.get("input_tokens", 0)
-        output_tokens = result.get("output_tokens", 0)
+        input_tokens = 0 if cache_hit else result.get("input_tokens", 0)
+        cached_tokens = 0 if cache_hit else result.get("cached_tokens", 0)
+        output_tokens = 0 if cache_hit else result.get("output_tokens", 0)
         model = result.get("model_used", "unknown")
         
+        hedge_cost = result.get("hedge_cost", 0.0)
+        
         # Update session cost tracking
-        session.cost_tracking.total_cost += cost
+        session.cost_tracking.total_cost += cost + hedge_cost
+        if result.get("hedged"):
+            session.cost_tracking.hedged_calls += 1
+            session.cost_tracking.total_hedge_cost += hedge_cost
         session.cost_tracking.total_input_tokens += input_tokens
+        session.cost_tracking.total_cached_tokens += cached_tokens
         session.cost_tracking.total_output_tokens += output_tokens
         
         # Track per-model costs
@@ -45,12 +69,76 @@ class StateMachineOrchestrator:
         session.cost_tracking.model_costs[model]["input_tokens"] += input_tokens
         session.cost_tracking.model_costs[model]["output_tokens"] += output_tokens
         session.cost_tracking.model_costs[model]["calls"] += 1
+        model_costs = session.cost_tracking.model_costs[model]
+        if cached_tokens:
+            model_costs["cached_tokens"] = model_costs.get("cached_tokens", 0) + cached_tokens
+        if cache_hit:
+            model_costs["cache_hits"] = model_costs.get("cache_hits", 0) + 1
+        if result.get("queue_wait_ms"):
+            model_costs["queue_wait_ms"] = model_costs.get("queue_wait_ms", 0) + result["queue_wait_ms"]
         
         logger.info(
-            f"[{session.session_id}] Cost tracking - Model: {model}, "
+            f"[{session.session_id}] Cost tracking - Model: {model}{' (cached)' if cache_hit else ''}, "
             f"Call cost: ${cost:.6f}, Total session cost: ${session.cost_tracking.total_cost:.6f}"
         )
     
+    async def _budget_history(
+        self,
+        session: SessionData,
+        task_type: TaskType,
+        round_number: int,
+        agent: AgentType,
+        history: Optional[List[RoundOutput]] = None
+    ):
+        """
+        Fit the session history to the task's token budget.
+        
+        Summarization calls are cost-tracked, and the tokens saved are recorded
+        per call in the session's cost tracking.
+        
+        Args:
+            history: Outputs the prompt covers (defaults to the full session history)
+        
+        Returns:
+            Budgeted history text, or None to send the full transcript
+        """
+        budgeted = await self.history_budget.fit(
+            session,
+            session.history if history is None else history,
+            task_type,
+            self.prompts.transcript_for(session.session_id),
+            on_result=lambda result: self._track_cost(session, result)
+        )
+        if budgeted["tokens_saved"]:
+            session.cost_tracking.history_tokens_saved += budgeted["tokens_saved"]
+            session.cost_tracking.history_budget_calls.append({
+                "round": round_number,
+                "agent": agent.value,
+                "task_type": task_type.value,
+                "full_tokens": budgeted["full_tokens"],
+                "budget_tokens": budgeted["budget_tokens"],
+                "tokens_saved": budgeted["tokens_saved"],
+                "summarized_through": budgeted["summarized_through"]
+            })
+        return budgeted["text"]
+    
+    @staticmethod
+    def _delta_callback(on_delta, round_number: int, agent: AgentType):
+        """
+        Bind an orchestrator-level on_delta(round, agent, delta) callback to one agent call.
+        
+        Returns:
+            Async callback(delta) for zai_client.generate, or None when streaming is not requested
+        """
+        if on_delta is None:
+            return None
+        
+        async def _forward(delta: str) -> None:
+            await on_delta(round_number, agent, delta)
+        
+        return _forward
+    
+    @traced("orchestrator.init")
     async def process_init(self, session: SessionData) -> SessionData:
         """
         State: INIT
@@ -58,14 +146,22 @@ class StateMachineOrchestrator:
         Next State: CLARIFICATION_PENDING or CLARIFICATION_COMPLETE
         """
         logger.info(f"[{session.session_id}] Processing INIT")
+        phase_started = time.perf_counter()
         
         try:
             # Clarification Agent (Uses FREE GLM-4.7-Flash model)
             logger.info(f"[{session.session_id}] Running Clarification Agent (FREE model)...")
-            prompt = self.prompts.format_clarification(session.original_user_prompt)
+            system, prompt = self.prompts.format_clarification(session.original_user_prompt)
             
             # Use FREE model for clarification
-            result = await zai_client.generate(prompt, task_type=TaskType.CLARIFICATION)
+            model = model_router.route_for_session(session, TaskType.CLARIFICATION, "clarification")
+            result = await zai_client.generate(
+                prompt,
+                task_type=TaskType.CLARIFICATION,
+                model=model,
+                system=system,
+                max_tokens=token_estimator.max_tokens_for(AgentType.CLARIFICATION.value)
+            )
             
             # Track cost
             self._track_cost(session, result)
@@ -73,7 +169,6 @@ class StateMachineOrchestrator:
             # Store clarification questions
             session.clarification_questions = result["response"]
             session.selected_model = result["model_used"]
-            session.model_reasoning = "Auto-selected for clarification task"
             
             # Smart Auto-Skip Logic
             if session.clarification_questions and "NO CLARIFICATION NEEDED" in session.clarification_questions:
@@ -86,6 +181,7 @@ class StateMachineOrchestrator:
             # Save progress
             await session_store.save(session)
             
+            PHASE_DURATION.observe(time.perf_counter() - phase_started, phase="init")
             logger.info(f"[{session.session_id}] Init processing done. State: {session.state}")
             return session
             
@@ -96,7 +192,7 @@ class StateMachineOrchestrator:
             await session_store.save(session)
             raise
     
-    async def process_clarification(self, session: SessionData, on_output=None) -> SessionData:
+    async def process_clarification(self, session: SessionData, on_output=None, on_delta=None) -> SessionData:
         """
         State: CLARIFICATION_PENDING
         Action: Merge user prompt with clarification answers
@@ -119,19 +215,26 @@ class StateMachineOrchestrator:
         await session_store.save(session)
         
         # Immediately start Round 1 with callback
-        return await self.process_round(session, on_output=on_output)
+        return await self.process_round(session, on_output=on_output, on_delta=on_delta)
     
-    async def process_round(self, session: SessionData, on_output=None) -> SessionData:
+    async def process_round(self, session: SessionData, on_output=None, on_delta=None) -> SessionData:
         """
         State: ROUND_PROCESSING
-        Action: Run Expansion (A) then Compression (B) for current round using CHEAP model
+        Action: Run the round's agent graph (settings.round_graph; by default
+            Expansion (A) then Compression (B)) for the current round using CHEAP model
         Next State: ROUND_PROCESSING (next round) OR SYNTHESIS_PROCESSING
         
+        Independent agents run concurrently; each agent sees the previous
+        rounds plus the outputs of the agents it depends on. Outputs are
+        appended to history in the graph's topological order.
+        
         Args:
-            on_output: Optional callback(output: RoundOutput) called after each agent finishes
+            on_output: Optional callback(output: RoundOutput) called as soon as each agent finishes
+            on_delta: Optional callback(round, agent, delta) called for each streamed token delta
         """
         round_num = session.current_round
         logger.info(f"[{session.session_id}] Processing Round {round_num}")
+        phase_started = time.perf_counter()
         
         session.state = SessionState.ROUND_PROCESSING
         await session_store.save(session)
@@ -140,99 +243,96 @@ class StateMachineOrchestrator:
             # Use merged prompt or fall back to original
             merged_context = session.merged_user_prompt or session.original_user_prompt
             
-            # Step 1: Expansion Agent (A)
-            logger.info(f"[{session.session_id}] Round {round_num} - Agent A (Expansion) - CHEAP model")
-            prompt_a = self.prompts.format_agent_round(
-                AgentType.EXPANSION,
-                merged_context,
-                session.history,
-                round_num
-            )
-            result_a = await zai_client.generate(prompt_a, task_type=TaskType.DEBATE)
-            
-            # Track cost
-            self._track_cost(session, result_a)
-            
-            # Store Agent A output
-            output_a = RoundOutput(
-                round_number=round_num,
-                agent=AgentType.EXPANSION,
-                content=result_a["response"],
-                tokens_used=result_a["tokens_generated"],
-                input_tokens=result_a["input_tokens"],
-                output_tokens=result_a["output_tokens"],
-                model_used=result_a["model_used"],
-                cost=result_a["cost"]
-            )
-            session.history.append(output_a)
-            await session_store.save(session)
-            
-            # Broadcast Agent A output immediately
-            if on_output:
-                await on_output(output_a)
-            
-            # Step 2: Compression Agent (B)
-            logger.info(f"[{session.session_id}] Round {round_num} - Agent B (Compression) - CHEAP model")
-            prompt_b = self.prompts.format_agent_round(
-                AgentType.COMPRESSION,
-                merged_context,
-                session.history,
-                round_num
-            )
-            result_b = await zai_client.generate(prompt_b, task_type=TaskType.DEBATE)
+            # Outputs of earlier rounds, and any of this round already persisted (resume)
+            prior_history = [o for o in session.history if o.round_number < round_num]
+            completed = {
+                o.agent: o for o in session.history
+                if o.round_number == round_num and o.agent in self.round_executor.graph.nodes
+            }
             
-            # Track cost
-            self._track_cost(session, result_b)
+            async def run_agent(node: AgentNode, dep_outputs: List[RoundOutput]) -> RoundOutput:
+                with span("agent", agent=node.agent.value, round=round_num):
+                    agent = node.agent
+                    visible_history = prior_history + dep_outputs
+                    logger.info(f"[{session.session_id}] Round {round_num} - Agent {agent.value} - CHEAP model")
+                    history_text = await self._budget_history(
+                        session, node.task_type, round_num, agent, history=visible_history
+                    )
+                    system, prompt = self.prompts.format_agent_round(
+                        agent,
+                        merged_context,
+                        visible_history,
+                        round_num,
+                        transcript=self.prompts.transcript_for(session.session_id),
+                        history_text=history_text
+                    )
+                    model = model_router.route_for_session(session, node.task_type, f"round {round_num} {agent.value}")
+                    result = await zai_client.generate(
+                        prompt,
+                        task_type=node.task_type,
+                        model=model,
+                        system=system,
+                        max_tokens=token_estimator.max_tokens_for(agent.value),
+                        on_delta=self._delta_callback(on_delta, round_num, agent)
+                    )
+                    
+                    # Track cost
+                    self._track_cost(session, result)
+                    
+                    return RoundOutput(
+                        round_number=round_num,
+                        agent=agent,
+                        content=result["response"],
+                        tokens_used=result["tokens_generated"],
+                        input_tokens=result["input_tokens"],
+                        output_tokens=result["output_tokens"],
+                        model_used=result["model_used"],
+                        cost=result["cost"]
+                    )
             
-            # Store Agent B output
-            output_b = RoundOutput(
-                round_number=round_num,
-                agent=AgentType.COMPRESSION,
-                content=result_b["response"],
-                tokens_used=result_b["tokens_generated"],
-                input_tokens=result_b["input_tokens"],
-                output_tokens=result_b["output_tokens"],
-                model_used=result_b["model_used"],
-                cost=result_b["cost"]
-            )
-            session.history.append(output_b)
-            await session_store.save(session)
+            async def commit(output: RoundOutput) -> None:
+                # Checkpoint each paid-for output durably; crash recovery resumes from here
+                session.history.append(output)
+                await session_store.save(session, flush=True)
             
-            # Broadcast Agent B output immediately
-            if on_output:
-                await on_output(output_b)
+            with span("orchestrator.round", round=round_num, resumed_agents=len(completed)):
+                await self.round_executor.run(
+                    round_num,
+                    run_agent,
+                    commit,
+                    on_complete=on_output,
+                    completed=completed
+                )
+            PHASE_DURATION.observe(time.perf_counter() - phase_started, phase="round")
             
             # Check if we should continue or synthesize
-            # Calculate total agent outputs so far
-            total_outputs = len(session.history)
-            
-            # Each round has 2 agents (A and B), so divide by 2
-            total_rounds = total_outputs // 2
-            
-            if total_rounds >= session.max_rounds:
-                logger.info(f"[{session.session_id}] Completed {session.max_rounds} rounds ({total_rounds} total outputs), moving to synthesis")
-                return await self.process_synthesis(session, on_output)
+            if round_num >= session.max_rounds:
+                logger.info(f"[{session.session_id}] Completed {session.max_rounds} rounds ({len(session.history)} total outputs), moving to synthesis")
+                return await self.process_synthesis(session, on_output, on_delta)
             else:
                 # Continue to next round
                 session.current_round += 1
                 await session_store.save(session)
                 logger.info(f"[{session.session_id}] Round {round_num} complete, continuing to Round {session.current_round}")
-                return await self.process_round(session, on_output)
+                return await self.process_round(session, on_output, on_delta)
                 
         except Exception as e:
             logger.error(f"[{session.session_id}] Round {round_num} failed: {e}")
+            self.prompts.release_transcript(session.session_id)
             session.state = SessionState.ERROR
             session.error_message = str(e)
             await session_store.save(session)
             raise
     
-    async def process_synthesis(self, session: SessionData, on_output=None) -> SessionData:
+    @traced("orchestrator.synthesis")
+    async def process_synthesis(self, session: SessionData, on_output=None, on_delta=None) -> SessionData:
         """
         State: SYNTHESIS_PROCESSING
         Action: Generate final synthesis from debate history using PREMIUM model
         Next State: COMPLETE
         """
         logger.info(f"[{session.session_id}] Processing SYNTHESIS")
+        phase_started = time.perf_counter()
         
         session.state = SessionState.SYNTHESIS_PROCESSING
         await session_store.save(session)
@@ -242,13 +342,24 @@ class StateMachineOrchestrator:
             merged_context = session.merged_user_prompt or session.original_user_prompt
             
             # Generate synthesis prompt
-            prompt = self.prompts.format_synthesis(
+            history_text = await self._budget_history(session, TaskType.SYNTHESIS, 0, AgentType.SYNTHESIS)
+            system, prompt = self.prompts.format_synthesis(
                 merged_context,
-                session.history
+                session.history,
+                transcript=self.prompts.transcript_for(session.session_id),
+                history_text=history_text
             )
             
             # Call Z.AI with PREMIUM model
-            result = await zai_client.generate(prompt, task_type=TaskType.SYNTHESIS)
+            model = model_router.route_for_session(session, TaskType.SYNTHESIS, "synthesis")
+            result = await zai_client.generate(
+                prompt,
+                task_type=TaskType.SYNTHESIS,
+                model=model,
+                system=system,
+                max_tokens=token_estimator.max_tokens_for(AgentType.SYNTHESIS.value),
+                on_delta=self._delta_callback(on_delta, 0, AgentType.SYNTHESIS)
+            )
             
             # Track cost
             self._track_cost(session, result)
@@ -266,6 +377,7 @@ class StateMachineOrchestrator:
             )
             session.history.append(synthesis)
             session.state = SessionState.COMPLETE
+            self.prompts.release_transcript(session.session_id)
             
             await session_store.save(session)
             
@@ -273,6 +385,8 @@ class StateMachineOrchestrator:
             if on_output:
                 await on_output(synthesis)
             
+            PHASE_DURATION.observe(time.perf_counter() - phase_started, phase="synthesis")
+            
             # Log final cost summary
             logger.info(
                 f"[{session.session_id}] Session complete - Total cost: ${session.cost_tracking.total_cost:.6f}, "
@@ -284,6 +398,7 @@ class StateMachineOrchestrator:
             
         except Exception as e:
             logger.error(f"[{session.session_id}] Synthesis failed: {e}")
+            self.prompts.release_transcript(session.session_id)
             session.state = SessionState.ERROR
             session.error_message = str(e)
             await session_store.save(session)
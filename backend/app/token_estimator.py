@@ -0,0 +1,234 @@
+"""
+Local token estimates for pre-flight request sizing
+
+Token counts are otherwise only known once a call returns its usage. The
+estimator converts UTF-8 byte lengths to tokens with a bytes-per-token ratio
+per model family (glm-4.7, glm-4.5, ...), starting from
+settings.token_estimate_bytes_per_token and calibrated from the prompt_tokens
+that completed calls report. The static system prompts are measured once at
+load (register_templates), so per call only the session-specific user
+message is measured.
+
+Before each call ZaiClient sizes the request against the model's context
+window (model_config.get_context_window):
+
+    - max_tokens comes from settings.agent_max_tokens for the calling agent
+      instead of the global settings.max_tokens, and is lowered (down to
+      min_output_tokens) when prompt and completion would not fit
+    - a prompt that still does not fit is trimmed from the middle of the user
+      message, keeping the context at its start and the most recent rounds
+      and instruction at its end, or rejected with PromptTooLargeError when
+      oversized_prompt_policy is "reject"
+"""
+
+import logging
+import math
+from typing import Any, Dict, Optional
+
+from app.config import get_settings
+from app.metrics import UPSTREAM_PREFLIGHT
+from app.model_config import get_context_window
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+POLICIES = ("trim", "reject")
+
+# Calls with shorter prompts are not used for calibration (chat-template tokens dominate them)
+MIN_CALIBRATION_TOKENS = 200
+
+# Weight of each new observation in a family's calibrated ratio
+CALIBRATION_WEIGHT = 0.1
+
+# Inserted where a prompt was trimmed
+TRIM_MARKER = "\n\n[... earlier content trimmed to fit the context window ...]\n\n"
+
+# Share of a trimmed prompt kept from its start (the rest comes from its end)
+TRIM_HEAD_SHARE = 0.4
+
+# Trim attempts before whatever is left goes out (the safety margin absorbs the rest)
+TRIM_PASSES = 4
+
+class PromptTooLargeError(RuntimeError):
+    """A prompt that cannot fit the model's context window (not retried)"""
+    
+    def __init__(self, model: str, input_tokens: int, context_window: int):
+        super().__init__(
+            f"Prompt of ~{input_tokens} tokens does not fit the {context_window}-token context window of {model}"
+        )
+        self.model = model
+        self.input_tokens = input_tokens
+
+class Preflight:
+    """A request sized to fit its model"""
+    
+    __slots__ = ("prompt", "max_tokens", "input_bytes", "input_tokens")
+    
+    def __init__(self, prompt: str, max_tokens: int, input_bytes: int, input_tokens: int):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.input_bytes = input_bytes
+        self.input_tokens = input_tokens
+
+def family_of(model: str) -> str:
+    """Tokenizer family of a model: its name up to the version, e.g. glm-4.7-flash -> glm-4.7"""
+    return "-".join(model.split("-")[:2])
+
+class TokenEstimator:
+    """Calibrated bytes-per-token estimates and pre-flight request sizing"""
+    
+    def __init__(
+        self,
+        bytes_per_token: float,
+        safety_margin: float,
+        min_output_tokens: int,
+        policy: str,
+        agent_max_tokens: Dict[str, int],
+        default_max_tokens: int
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown oversized prompt policy '{policy}' (expected one of {', '.join(POLICIES)})")
+        self.default_ratio = bytes_per_token
+        self.safety_margin = safety_margin
+        self.min_output_tokens = min_output_tokens
+        self.policy = policy
+        self.agent_max_tokens = agent_max_tokens
+        self.default_max_tokens = default_max_tokens
+        self._ratios: Dict[str, float] = {}
+        # Static template text -> UTF-8 byte length
+        self._static: Dict[str, int] = {}
+        self._stats = {"calibrations": 0, "relative_error_sum": 0.0, "max_tokens_lowered": 0, "trimmed": 0, "rejected": 0}
+    
+    # =============== ESTIMATES ===============
+    
+    def bytes_per_token(self, model: Optional[str] = None) -> float:
+        if model is None:
+            return self.default_ratio
+        return self._ratios.get(family_of(model), self.default_ratio)
+    
+    def tokens_for_bytes(self, byte_length: int, model: Optional[str] = None) -> int:
+        return math.ceil(byte_length / self.bytes_per_token(model))
+    
+    def estimate(self, text: str, model: Optional[str] = None) -> int:
+        """Approximate token length of text"""
+        return self.tokens_for_bytes(len(text.encode("utf-8")), model)
+    
+    def _template_bytes(self, text: str) -> int:
+        """Byte length of a static template (measured at load) or other text"""
+        cached = self._static.get(text)
+        return cached if cached is not None else len(text.encode("utf-8"))
+    
+    def register_templates(self, templates: Dict[str, str]) -> Dict[str, int]:
+        """
+        Measure static prompt templates once.
+        
+        Returns:
+            Template name -> estimated tokens (default ratio)
+        """
+        counts = {}
+        for name, text in templates.items():
+            self._static[text] = len(text.encode("utf-8"))
+            counts[name] = self.tokens_for_bytes(self._static[text])
+        return counts
+    
+    def calibrate(self, model: str, input_bytes: int, prompt_tokens: int) -> None:
+        """Move a family's ratio towards the one observed on a completed call"""
+        if prompt_tokens < MIN_CALIBRATION_TOKENS or input_bytes <= 0:
+            return
+        predicted = self.tokens_for_bytes(input_bytes, model)
+        self._stats["calibrations"] += 1
+        self._stats["relative_error_sum"] += abs(predicted - prompt_tokens) / prompt_tokens
+        family = family_of(model)
+        observed = min(8.0, max(1.0, input_bytes / prompt_tokens))
+        current = self._ratios.get(family, self.default_ratio)
+        self._ratios[family] = current + CALIBRATION_WEIGHT * (observed - current)
+    
+    # =============== SIZING ===============
+    
+    def max_tokens_for(self, agent: Optional[str]) -> int:
+        """Completion budget for an agent (AgentType value, or "SUMMARY")"""
+        return self.agent_max_tokens.get(agent, self.default_max_tokens) if agent else self.default_max_tokens
+    
+    def preflight(self, model: str, prompt: str, system: Optional[str], max_tokens: Optional[int]) -> Preflight:
+        """
+        Size a request to the model's context window.
+        
+        Args:
+            model: Model the request goes to
+            prompt: User message (trimmed here if it has to be)
+            system: Static system message (never trimmed)
+            max_tokens: Requested completion budget (settings.max_tokens if None)
+        
+        Returns:
+            Preflight with the prompt and max_tokens to send
+        
+        Raises:
+            PromptTooLargeError: The prompt does not fit and may not (or
+                cannot) be trimmed
+        """
+        max_tokens = max_tokens or self.default_max_tokens
+        window = get_context_window(model)
+        usable = int(window * (1 - self.safety_margin))
+        system_bytes = self._template_bytes(system) if system else 0
+        prompt_bytes = len(prompt.encode("utf-8"))
+        input_tokens = self.tokens_for_bytes(system_bytes + prompt_bytes, model)
+        if input_tokens + max_tokens <= usable:
+            return Preflight(prompt, max_tokens, system_bytes + prompt_bytes, input_tokens)
+        
+        room = usable - input_tokens
+        if room >= min(max_tokens, self.min_output_tokens):
+            self._stats["max_tokens_lowered"] += 1
+            UPSTREAM_PREFLIGHT.inc(model=model, action="max_tokens_lowered")
+            logger.info(f"max_tokens for {model} lowered from {max_tokens} to {room} (prompt ~{input_tokens} tokens)")
+            return Preflight(prompt, room, system_bytes + prompt_bytes, input_tokens)
+        
+        max_tokens = min(max_tokens, self.min_output_tokens)
+        # Bytes of the user message that fit next to the system message and the completion
+        keep_bytes = math.floor((usable - max_tokens) * self.bytes_per_token(model)) - system_bytes
+        keep_bytes -= len(TRIM_MARKER.encode("utf-8"))
+        if self.policy == "reject" or keep_bytes <= 0:
+            self._stats["rejected"] += 1
+            UPSTREAM_PREFLIGHT.inc(model=model, action="rejected")
+            raise PromptTooLargeError(model, input_tokens, window)
+        
+        trimmed, trimmed_bytes = prompt, prompt_bytes
+        # Shares are applied to characters, so multi-byte text can need another pass
+        for _ in range(TRIM_PASSES):
+            if trimmed_bytes <= keep_bytes + len(TRIM_MARKER.encode("utf-8")):
+                break
+            trimmed = self._trim(prompt, keep_bytes / trimmed_bytes * len(trimmed) / len(prompt))
+            trimmed_bytes = len(trimmed.encode("utf-8"))
+        trimmed_tokens = self.tokens_for_bytes(system_bytes + trimmed_bytes, model)
+        self._stats["trimmed"] += 1
+        UPSTREAM_PREFLIGHT.inc(model=model, action="trimmed")
+        logger.warning(f"Prompt for {model} trimmed from ~{input_tokens} to ~{trimmed_tokens} tokens to fit its context window")
+        return Preflight(trimmed, max_tokens, system_bytes + trimmed_bytes, trimmed_tokens)
+    
+    @staticmethod
+    def _trim(prompt: str, keep_share: float) -> str:
+        """Cut the middle out of a prompt, keeping keep_share of it (by characters)"""
+        keep = int(len(prompt) * keep_share)
+        head = int(keep * TRIM_HEAD_SHARE)
+        tail = keep - head
+        return f"{prompt[:head]}{TRIM_MARKER}{prompt[len(prompt) - tail:] if tail else ''}"
+    
+    def stats(self) -> Dict[str, Any]:
+        calibrations = self._stats["calibrations"]
+        return {
+            "policy": self.policy,
+            "bytes_per_token": {family: round(ratio, 3) for family, ratio in self._ratios.items()},
+            "default_bytes_per_token": self.default_ratio,
+            "template_bytes": sum(self._static.values()),
+            "mean_relative_error": round(self._stats["relative_error_sum"] / calibrations, 4) if calibrations else None,
+            **{key: value for key, value in self._stats.items() if key != "relative_error_sum"},
+        }
+
+# Singleton instance
+token_estimator = TokenEstimator(
+    bytes_per_token=settings.token_estimate_bytes_per_token,
+    safety_margin=settings.token_estimate_safety_margin,
+    min_output_tokens=settings.min_output_tokens,
+    policy=settings.oversized_prompt_policy,
+    agent_max_tokens=settings.agent_max_tokens,
+    default_max_tokens=settings.max_tokens
+)
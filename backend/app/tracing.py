@@ -0,0 +1,256 @@
+"""
+Lightweight per-session span tracing
+
+Each background run of a session (process_session_background) opens a trace;
+code running inside it (orchestrator phases, agent calls, upstream attempts,
+session store calls, WebSocket sends) records spans through span(). The
+active trace and parent span travel in context variables, so spans from
+concurrent agent tasks nest under the right parent without being passed
+around.
+
+When the run ends, its spans are appended to session.timeline in a compact
+row format:
+
+    [span_id, parent_id, name, start_ms, duration_ms, status, attributes]
+
+with start_ms relative to session.created_at and parent_id 0 for roots.
+timeline_view() turns that into a waterfall-ready structure for the API, and
+when settings.trace_export_path is set each run is also appended to that file
+as one OTLP/JSON ExportTraceServiceRequest per line.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Row layout of session.timeline entries
+SPAN_ID, SPAN_PARENT, SPAN_NAME, SPAN_START, SPAN_DURATION, SPAN_STATUS, SPAN_ATTRS = range(7)
+
+class Span:
+    """An open span; attributes can be added until it ends"""
+    
+    __slots__ = ("span_id", "parent_id", "name", "start", "attrs", "status")
+    
+    def __init__(self, span_id: int, parent_id: int, name: str, start: float, attrs: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.attrs = attrs
+        self.status = "ok"
+    
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+class Trace:
+    """Spans recorded during one background run of a session"""
+    
+    def __init__(self, session_id: UUID, max_spans: int):
+        self.session_id = session_id
+        self.max_spans = max_spans
+        self.rows: List[List[Any]] = []
+        self.dropped = 0
+        self._next_id = 1
+        # Wall-clock anchor for the monotonic span clock
+        self._wall_anchor = time.time()
+        self._perf_anchor = time.perf_counter()
+    
+    def now_ms(self) -> float:
+        """Current time as epoch milliseconds (monotonic within the trace)"""
+        return (self._wall_anchor + (time.perf_counter() - self._perf_anchor)) * 1000
+    
+    def open(self, name: str, parent_id: int, attrs: Dict[str, Any]) -> Span:
+        span = Span(self._next_id, parent_id, name, self.now_ms(), attrs)
+        self._next_id += 1
+        return span
+    
+    def close(self, span: Span) -> None:
+        if len(self.rows) >= self.max_spans:
+            self.dropped += 1
+            return
+        duration = round(self.now_ms() - span.start, 3)
+        self.rows.append([span.span_id, span.parent_id, span.name, span.start, duration, span.status, span.attrs])
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[int] = ContextVar("current_span", default=0)
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """
+    Record a span around a block (no-op outside a trace).
+    
+    Yields the Span (or None when not tracing) so callers can attach
+    attributes discovered inside the block. An exception escaping the block
+    marks the span "error" and is re-raised.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.open(name, _current_span.get(), attrs)
+    token = _current_span.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+        current.attrs.setdefault("error", str(e)[:200])
+        raise
+    finally:
+        _current_span.reset(token)
+        trace.close(current)
+
+def traced(name: str):
+    """Decorator recording a span around each call of an async function"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def start_trace(session_id: UUID) -> Iterator[Optional[Trace]]:
+    """Make a new trace current for the block (None when tracing is disabled)"""
+    if not settings.enable_tracing:
+        yield None
+        return
+    trace = Trace(session_id, settings.trace_max_spans_per_run)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(0)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+def merge_into_timeline(timeline: List[List[Any]], trace: Trace, created_at: float) -> int:
+    """
+    Append a finished trace's spans to a session timeline.
+    
+    Span ids are offset past the ids already in the timeline, and start times
+    made relative to the session's creation.
+    
+    Returns:
+        Number of spans appended
+    """
+    room = max(0, settings.trace_max_spans_per_session - len(timeline))
+    rows = sorted(trace.rows, key=lambda row: row[SPAN_START])[:room]
+    offset = max((row[SPAN_ID] for row in timeline), default=0)
+    base_ms = created_at * 1000
+    for row in rows:
+        timeline.append([
+            row[SPAN_ID] + offset,
+            row[SPAN_PARENT] + offset if row[SPAN_PARENT] else 0,
+            row[SPAN_NAME],
+            round(row[SPAN_START] - base_ms, 3),
+            row[SPAN_DURATION],
+            row[SPAN_STATUS],
+            row[SPAN_ATTRS],
+        ])
+    if trace.dropped or len(rows) < len(trace.rows):
+        logger.warning(
+            f"[{trace.session_id}] Timeline truncated: {trace.dropped + len(trace.rows) - len(rows)} spans dropped"
+        )
+    return len(rows)
+
+def timeline_view(session_id: UUID, created_at: float, timeline: List[List[Any]]) -> Dict[str, Any]:
+    """Waterfall-ready view of a session timeline (spans ordered by start, with depth)"""
+    depth: Dict[int, int] = {}
+    spans = []
+    for row in sorted(timeline, key=lambda r: (r[SPAN_START], r[SPAN_ID])):
+        span_depth = depth.get(row[SPAN_PARENT], -1) + 1 if row[SPAN_PARENT] else 0
+        depth[row[SPAN_ID]] = span_depth
+        spans.append({
+            "id": row[SPAN_ID],
+            "parent_id": row[SPAN_PARENT] or None,
+            "name": row[SPAN_NAME],
+            "start_ms": row[SPAN_START],
+            "duration_ms": row[SPAN_DURATION],
+            "end_ms": round(row[SPAN_START] + row[SPAN_DURATION], 3),
+            "depth": span_depth,
+            "status": row[SPAN_STATUS],
+            "attributes": row[SPAN_ATTRS],
+        })
+    return {
+        "session_id": str(session_id),
+        "trace_id": session_id.hex,
+        "created_at": created_at,
+        "duration_ms": max((s["end_ms"] for s in spans), default=0.0),
+        "span_count": len(spans),
+        "spans": spans,
+    }
+
+# =============== OTLP EXPORT ===============
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp(trace: Trace) -> Dict[str, Any]:
+    """One run's spans as an OTLP/JSON ExportTraceServiceRequest"""
+    trace_id = trace.session_id.hex
+    # Span ids must be unique within the trace across runs: prefix with the run's anchor time
+    run_prefix = int(trace._wall_anchor * 1000) & 0xFFFFFFFF
+    
+    def span_id(local_id: int) -> str:
+        return f"{run_prefix:08x}{local_id:08x}"
+    
+    spans = []
+    for row in trace.rows:
+        start_ns = int(row[SPAN_START] * 1_000_000)
+        otlp_span = {
+            "traceId": trace_id,
+            "spanId": span_id(row[SPAN_ID]),
+            "name": row[SPAN_NAME],
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(row[SPAN_DURATION] * 1_000_000)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in row[SPAN_ATTRS].items()],
+            "status": {"code": 1 if row[SPAN_STATUS] == "ok" else 2},  # STATUS_CODE_OK / ERROR
+        }
+        if row[SPAN_PARENT]:
+            otlp_span["parentSpanId"] = span_id(row[SPAN_PARENT])
+        spans.append(otlp_span)
+    
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": settings.trace_service_name}},
+                {"key": "session.id", "value": {"stringValue": str(trace.session_id)}},
+            ]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+        }]
+    }
+
+def _append_line(path: Path, line: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+async def export_trace(trace: Trace) -> None:
+    """Append the trace to settings.trace_export_path as OTLP/JSON (one request per line)"""
+    if not settings.trace_export_path or not trace.rows:
+        return
+    line = json.dumps(to_otlp(trace), separators=(",", ":"))
+    try:
+        await asyncio.to_thread(_append_line, Path(settings.trace_export_path), line)
+    except OSError as e:
+        logger.warning(f"[{trace.session_id}] OTLP trace export failed: {e}")
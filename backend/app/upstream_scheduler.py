@@ -0,0 +1,221 @@
+"""
+Upstream request scheduler for the Z.AI API
+
+Every upstream HTTP attempt must take a slot on its model's lane first. A lane
+enforces, per model:
+
+    max_concurrency: requests in flight at once
+    rpm:             request starts per rolling 60 seconds (0 = unlimited)
+
+Limits come from TASK_MODEL_MAPPING ("max_concurrency" / "rpm"); models used
+by several task types get the strictest values, and models not in the mapping
+use the settings defaults. Waiting requests are served by priority class, so
+calls that finish a session (synthesis) or unblock a user (clarification) go
+ahead of debate rounds; within a class, first come first served.
+
+A 429 from the provider pauses the model's lane (honoring Retry-After) instead
+of letting each caller back off on its own.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from app.model_config import TASK_MODEL_MAPPING, TaskType
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Scheduling classes (lower value is served first)"""
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+TASK_PRIORITIES: Dict[TaskType, Priority] = {
+    TaskType.SYNTHESIS: Priority.HIGH,
+    TaskType.CLARIFICATION: Priority.HIGH,
+    TaskType.SUMMARIZATION: Priority.NORMAL,
+    TaskType.CODE: Priority.NORMAL,
+    TaskType.CREATIVE: Priority.NORMAL,
+    TaskType.GENERAL: Priority.NORMAL,
+    TaskType.DEBATE: Priority.LOW,
+}
+
+RPM_WINDOW = 60.0
+
+class SchedulerSlot:
+    """A granted lane slot; wait_ms is the time spent queued for it"""
+    
+    def __init__(self, model: str, priority: Priority, wait_ms: int):
+        self.model = model
+        self.priority = priority
+        self.wait_ms = wait_ms
+
+class ModelLane:
+    """Priority queue plus concurrency and RPM limits for one model"""
+    
+    def __init__(self, model: str, max_concurrency: int, rpm: int):
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.rpm = max(0, rpm)
+        self.active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._starts: Deque[float] = deque()
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._stats = {"granted": 0, "waited": 0, "rate_limited": 0, "wait_ms_total": 0, "wait_ms_max": 0}
+    
+    def _start_delay(self, now: float) -> float:
+        """Seconds until the next request may start (0 = now)"""
+        delay = max(0.0, self._paused_until - now)
+        if self.rpm:
+            while self._starts and now - self._starts[0] >= RPM_WINDOW:
+                self._starts.popleft()
+            if len(self._starts) >= self.rpm:
+                delay = max(delay, RPM_WINDOW - (now - self._starts[0]))
+        return delay
+    
+    def _dispatch(self) -> None:
+        """Grant slots to waiters in priority order while limits allow"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self.active < self.max_concurrency:
+            waiter = self._waiters[0][2]
+            if waiter.done():
+                # Cancelled while queued
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            delay = self._start_delay(now)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.active += 1
+            self._starts.append(now)
+            waiter.set_result(None)
+    
+    async def acquire(self, priority: Priority) -> int:
+        """
+        Wait for a slot.
+        
+        Returns:
+            Time spent waiting, in milliseconds
+        """
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._order), waiter))
+        self._dispatch()
+        if not waiter.done():
+            self._stats["waited"] += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the caller was cancelled
+                self.release()
+            raise
+        wait_ms = int((time.monotonic() - started) * 1000)
+        self._stats["granted"] += 1
+        self._stats["wait_ms_total"] += wait_ms
+        self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+        return wait_ms
+    
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+    
+    def pause(self, seconds: float) -> None:
+        """Hold new starts for a while (upstream rate limit)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._stats["rate_limited"] += 1
+        logger.warning(f"Upstream lane {self.model} paused for {seconds:.1f}s after rate limiting")
+        self._dispatch()
+    
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, waiter in self._waiters if not waiter.done())
+    
+    def stats(self) -> Dict[str, Any]:
+        granted = self._stats["granted"]
+        return {
+            "max_concurrency": self.max_concurrency,
+            "rpm": self.rpm,
+            "active": self.active,
+            "queued": self.queued,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            **self._stats,
+            "wait_ms_avg": round(self._stats["wait_ms_total"] / granted, 1) if granted else 0.0,
+        }
+
+class UpstreamScheduler:
+    """Per-model lanes shared by every upstream call in the process"""
+    
+    def __init__(self, enabled: bool, default_max_concurrency: int, default_rpm: int):
+        self.enabled = enabled
+        self.default_max_concurrency = default_max_concurrency
+        self.default_rpm = default_rpm
+        self._lanes: Dict[str, ModelLane] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def limits_for(self, model: str) -> Tuple[int, int]:
+        """(max_concurrency, rpm) for a model from TASK_MODEL_MAPPING, strictest wins"""
+        concurrency, rpm = [], []
+        for config in TASK_MODEL_MAPPING.values():
+            if config["model"] == model:
+                concurrency.append(config.get("max_concurrency", self.default_max_concurrency))
+                rpm.append(config.get("rpm", self.default_rpm))
+        if not concurrency:
+            return self.default_max_concurrency, self.default_rpm
+        limited_rpm = [r for r in rpm if r]
+        return min(concurrency), min(limited_rpm) if limited_rpm else 0
+    
+    def _lane(self, model: str) -> ModelLane:
+        # Lanes hold futures and timers of the loop they were used on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lanes = {}
+            self._loop = loop
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = ModelLane(model, *self.limits_for(model))
+            self._lanes[model] = lane
+        return lane
+    
+    @staticmethod
+    def priority_for(task_type: Optional[TaskType]) -> Priority:
+        return TASK_PRIORITIES.get(task_type or TaskType.GENERAL, Priority.NORMAL)
+    
+    @asynccontextmanager
+    async def slot(self, model: str, task_type: Optional[TaskType]) -> AsyncIterator[SchedulerSlot]:
+        """Hold a slot on the model's lane for the duration of one upstream attempt"""
+        priority = self.priority_for(task_type)
+        if not self.enabled:
+            yield SchedulerSlot(model, priority, 0)
+            return
+        
+        lane = self._lane(model)
+        wait_ms = await lane.acquire(priority)
+        if wait_ms:
+            logger.debug(f"Upstream slot for {model} ({priority.name}) granted after {wait_ms}ms")
+        try:
+            yield SchedulerSlot(model, priority, wait_ms)
+        finally:
+            lane.release()
+    
+    def pause(self, model: str, seconds: float) -> None:
+        """Pause a model's lane after an upstream 429"""
+        if self.enabled and seconds > 0:
+            self._lane(model).pause(seconds)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Per-model lane occupancy and queue-wait statistics"""
+        return {model: lane.stats() for model, lane in self._lanes.items()}
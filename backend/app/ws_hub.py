@@ -0,0 +1,294 @@
+"""
+WebSocket fan-out hub
+
+Any number of WebSocket connections can subscribe to a session. Publishing a
+message never touches the network: it is appended to each subscriber's
+bounded send queue and that subscriber's writer task delivers it. A slow or
+stalled client therefore only ever delays itself, never the orchestrator or
+the session's other subscribers.
+
+When a subscriber falls behind, the slow-consumer policy decides what
+happens:
+
+    coalesce  queued frames are merged where no information is lost: token
+              deltas for the same agent and round are concatenated, and a
+              newer queue_position / state_change replaces a queued one. If
+              the queue is still full, the subscriber is disconnected.
+    drop      the subscriber is disconnected as soon as its queue is full.
+
+Disconnected clients reconnect with ?since=<seq> and are sent what they
+missed from the session's event log, so nothing is lost silently. A send that
+takes longer than ws_send_timeout also disconnects.
+"""
+
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from app.config import get_settings
+from app.event_log import event_log
+from app.metrics import WS_FRAMES_COALESCED, WS_SUBSCRIBERS_DROPPED
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+POLICIES = ("coalesce", "drop")
+
+# Message types where only the latest queued value matters
+SUPERSEDED_TYPES = ("queue_position", "state_change")
+
+# WebSocket close code 1013: "Try Again Later"
+CLOSE_SLOW_CONSUMER = 1013
+
+class Frame:
+    """A message queued for delivery, serialized once and shared by every subscriber"""
+    
+    __slots__ = ("message", "_text")
+    
+    def __init__(self, message: Optional[Dict[str, Any]] = None, text: Optional[str] = None):
+        self.message = message
+        self._text = text
+    
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message, separators=(",", ":"), ensure_ascii=False)
+        return self._text
+
+def _frame_type(frame: Frame) -> Optional[str]:
+    return frame.message.get("type") if frame.message is not None else None
+
+def _merge_deltas(queued: Frame, frame: Frame) -> Optional[Frame]:
+    """One delta frame carrying both, or None if they belong to different outputs"""
+    old, new = queued.message, frame.message
+    if _frame_type(queued) != "agent_delta":
+        return None
+    if old.get("round") != new.get("round") or old.get("agent") != new.get("agent"):
+        return None
+    return Frame({**new, "content": (old.get("content") or "") + (new.get("content") or "")})
+
+class Subscriber:
+    """One WebSocket connection with its own send queue and writer task"""
+    
+    def __init__(self, session_id: str, websocket: WebSocket, max_queue: int):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.max_queue = max(1, max_queue)
+        self.queue: Deque[Frame] = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+    
+    def offer(self, frame: Frame, policy: str) -> bool:
+        """
+        Queue a frame without blocking.
+        
+        Returns:
+            False if the subscriber is too far behind and must be disconnected
+        """
+        if self.queue and policy == "coalesce":
+            kind = _frame_type(frame)
+            if kind == "agent_delta":
+                # Only the newest queued frame, so deltas never overtake other messages
+                merged = _merge_deltas(self.queue[-1], frame)
+                if merged is not None:
+                    self.queue[-1] = merged
+                    WS_FRAMES_COALESCED.inc()
+                    return True
+            elif kind in SUPERSEDED_TYPES:
+                for index in range(len(self.queue) - 1, -1, -1):
+                    if _frame_type(self.queue[index]) == kind:
+                        del self.queue[index]
+                        WS_FRAMES_COALESCED.inc()
+                        break
+        if len(self.queue) >= self.max_queue:
+            return False
+        self.queue.append(frame)
+        self._ready.set()
+        return True
+    
+    async def run_writer(self, send_timeout: float, on_failure) -> None:
+        """Deliver queued frames in order until closed"""
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                frame = self.queue.popleft()
+                await asyncio.wait_for(self.websocket.send_text(frame.text), send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            on_failure(self, "send_timeout")
+        except Exception as e:
+            logger.debug(f"[{self.session_id}] WebSocket send failed: {e}")
+            on_failure(self, "send_error")
+
+class WebSocketHub:
+    """Session -> subscribers registry with non-blocking publish"""
+    
+    def __init__(self, max_queue: int, policy: str, send_timeout: float):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{policy}' (expected one of {', '.join(POLICIES)})")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self._subscribers: Dict[str, Set[Subscriber]] = {}
+        self._stats = {"published": 0, "delivered_to": 0, "dropped": 0}
+        # Called with (session_id, True) on a session's first subscriber and
+        # (session_id, False) when its last one leaves (cross-process routing)
+        self.on_interest: Optional[Callable[[str, bool], None]] = None
+    
+    def subscribe(self, session_id: str, websocket: WebSocket, hold: bool = False) -> Subscriber:
+        """
+        Register an accepted WebSocket and start its writer.
+        
+        Args:
+            session_id: Session to receive messages for
+            websocket: Accepted connection
+            hold: Queue published messages but start the writer only on
+                release(), so catch-up frames can go in front of them
+        """
+        subscriber = Subscriber(session_id, websocket, self.max_queue)
+        if not hold:
+            self._start_writer(subscriber)
+        subscribers = self._subscribers.setdefault(session_id, set())
+        subscribers.add(subscriber)
+        if len(subscribers) == 1 and self.on_interest is not None:
+            self.on_interest(session_id, True)
+        return subscriber
+    
+    def _start_writer(self, subscriber: Subscriber) -> None:
+        subscriber._writer = asyncio.create_task(
+            subscriber.run_writer(self.send_timeout, self._drop),
+            name=f"ws-writer-{subscriber.session_id}"
+        )
+    
+    def release(self, subscriber: Subscriber, frames: List[Dict[str, Any]], after_seq: Optional[int] = None) -> None:
+        """
+        Start a held subscriber's writer, sending frames ahead of what was queued meanwhile.
+        
+        Args:
+            subscriber: Subscriber registered with hold=True
+            frames: Catch-up messages (replayed events or a session snapshot)
+            after_seq: Discard queued messages numbered up to this (already
+                reflected in a snapshot)
+        """
+        if subscriber.closed or subscriber._writer is not None:
+            return
+        if after_seq is not None:
+            subscriber.queue = deque(
+                frame for frame in subscriber.queue
+                if frame.message is None or frame.message.get("seq") is None or frame.message["seq"] > after_seq
+            )
+        subscriber.queue.extendleft(Frame(message) for message in reversed(frames))
+        if subscriber.queue:
+            subscriber._ready.set()
+        self._start_writer(subscriber)
+    
+    def _remove(self, subscriber: Subscriber) -> None:
+        subscriber.closed = True
+        subscribers = self._subscribers.get(subscriber.session_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.session_id]
+                if self.on_interest is not None:
+                    self.on_interest(subscriber.session_id, False)
+    
+    @staticmethod
+    async def _stop_writer(subscriber: Subscriber) -> None:
+        writer = subscriber._writer
+        if writer is not None and writer is not asyncio.current_task() and not writer.done():
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+    
+    async def unsubscribe(self, subscriber: Subscriber) -> None:
+        """Remove a subscriber and stop its writer (undelivered frames are discarded)"""
+        self._remove(subscriber)
+        await self._stop_writer(subscriber)
+    
+    def _drop(self, subscriber: Subscriber, reason: str) -> None:
+        """Disconnect a subscriber that cannot keep up (its endpoint sees the close and cleans up)"""
+        if subscriber.closed:
+            return
+        self._stats["dropped"] += 1
+        WS_SUBSCRIBERS_DROPPED.inc(reason=reason)
+        logger.warning(
+            f"[{subscriber.session_id}] Dropping WebSocket subscriber ({reason}, "
+            f"{len(subscriber.queue)} frames queued)"
+        )
+        self._remove(subscriber)
+        asyncio.create_task(self._close(subscriber))
+    
+    async def _close(self, subscriber: Subscriber) -> None:
+        await self._stop_writer(subscriber)
+        try:
+            await subscriber.websocket.close(code=CLOSE_SLOW_CONSUMER)
+        except Exception:
+            pass
+    
+    def send(self, subscriber: Subscriber, message: Optional[Dict[str, Any]] = None, text: Optional[str] = None) -> None:
+        """Queue a frame for a single subscriber (e.g. the initial state on connect)"""
+        if subscriber.closed:
+            return
+        if not subscriber.offer(Frame(message, text), self.policy):
+            self._drop(subscriber, "queue_full")
+    
+    def publish(self, session_id: str, message: Dict[str, Any]) -> int:
+        """
+        Queue a message for every subscriber of a session (never blocks).
+        
+        Sequenced messages are also recorded in the session's event log,
+        subscribers or not, so reconnecting clients can catch up.
+        
+        Returns:
+            Number of subscribers the message was queued for
+        """
+        event_log.record(session_id, message)
+        subscribers = self._subscribers.get(session_id)
+        if not subscribers:
+            return 0
+        self._stats["published"] += 1
+        frame = Frame(message)
+        queued = 0
+        for subscriber in list(subscribers):
+            if subscriber.offer(frame, self.policy):
+                queued += 1
+            else:
+                self._drop(subscriber, "queue_full")
+        self._stats["delivered_to"] += queued
+        return queued
+    
+    def sessions(self) -> List[str]:
+        """Sessions with at least one local subscriber"""
+        return list(self._subscribers)
+    
+    def subscriber_count(self, session_id: str) -> int:
+        return len(self._subscribers.get(session_id, ()))
+    
+    @property
+    def connection_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "max_queue": self.max_queue,
+            "sessions": len(self._subscribers),
+            "connections": self.connection_count,
+            "queued_frames": sum(len(s.queue) for subs in self._subscribers.values() for s in subs),
+            **self._stats,
+        }
+
+# Singleton instance
+ws_hub = WebSocketHub(
+    max_queue=settings.ws_send_queue_size,
+    policy=settings.ws_slow_consumer_policy,
+    send_timeout=settings.ws_send_timeout
+)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the session pipeline
+
+Starts the mock Z.AI server (benchmarks/mock_zai.py) in a subprocess, serves
+the real FastAPI app with uvicorn in this process pointed at it, and drives
+complete sessions through the public API at a fixed concurrency:
+
+    POST /api/chat/init -> WebSocket (clarification) -> POST /api/chat/clarify
+    -> WebSocket (rounds, synthesis) -> state COMPLETE
+
+The client runs on its own event loop in a separate thread so the app's loop
+can be watched for lag on its own. The report covers throughput (sessions/sec),
+p50/p95/p99 latency end to end and per phase, event-loop lag, and the
+upstream requests the mock served. No tokens are spent.
+
+With --cassette-mode record the upstream completions of a run are saved to
+--cassette; --cassette-mode replay then serves them back without starting the
+mock, so the run measures only the app's own overhead (add
+--cassette-time-scale 1 to reproduce the recorded upstream timing). Replays
+match requests by payload, so use the same --sessions and --max-rounds.
+
+Runs can be saved with --output and compared against a saved baseline with
+--baseline; the exit code is 1 when throughput or p95 end-to-end latency
+regressed by more than --max-regression.
+
+Usage (from backend/):
+    python -m benchmarks.load_test --sessions 200 --concurrency 50
+    python -m benchmarks.load_test --ttft lognormal:800:0.6 --rate-limit-rate 0.05 --output run.json
+    python -m benchmarks.load_test --baseline run.json --max-regression 0.1
+    python -m benchmarks.load_test --cassette-mode record --cassette debate.jsonl
+    python -m benchmarks.load_test --cassette-mode replay --cassette debate.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.mock_zai import add_arguments as add_mock_arguments  # noqa: E402
+
+# Client-side phases, in session order
+PHASES = (
+    "init_request",      # POST /api/chat/init round trip
+    "clarification",     # init accepted -> clarification questions received
+    "clarify_request",   # POST /api/chat/clarify round trip
+    "first_delta",       # clarify accepted -> first streamed token of the debate
+    "debate",            # clarify accepted -> synthesis received
+    "finalize",          # synthesis received -> state COMPLETE
+    "end_to_end",        # init sent -> state COMPLETE
+)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear-interpolated percentile (q in 0..100) of unsorted values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+# =============== SERVERS ===============
+
+def start_mock(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    """Launch the mock Z.AI server and wait until it answers"""
+    command = [
+        sys.executable, "-m", "benchmarks.mock_zai",
+        "--port", str(port),
+        "--ttft", args.ttft,
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--completion-tokens", str(args.completion_tokens),
+        "--completion-jitter", str(args.completion_jitter),
+        "--tokens-per-chunk", str(args.tokens_per_chunk),
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--retry-after", str(args.retry_after),
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    if not args.prefix_cache:
+        command.append("--no-prefix-cache")
+    for item in args.model_ttft:
+        command += ["--model-ttft", item]
+    for item in args.model_error_rate:
+        command += ["--model-error-rate", item]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Mock Z.AI server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/models", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock Z.AI server did not start within 15s")
+
+def configure_app_environment(mock_port: int, storage_path: str, args: argparse.Namespace) -> None:
+    """Point the app at the mock (must run before app modules are imported)"""
+    os.environ.update({
+        "ZAI_BASE_URL": f"http://127.0.0.1:{mock_port}",
+        "ZAI_API_KEY": "benchmark",
+        "SESSION_STORAGE_PATH": storage_path,
+        "ENABLE_SESSION_RECOVERY": "false",
+        "TRACE_EXPORT_PATH": "",
+    })
+    if args.cassette_mode != "off":
+        os.environ["ZAI_CASSETTE_MODE"] = args.cassette_mode
+        os.environ["ZAI_CASSETTE_PATH"] = str(Path(args.cassette).resolve())
+        os.environ["ZAI_CASSETTE_TIME_SCALE"] = str(args.cassette_time_scale)
+    if args.max_rounds is not None:
+        os.environ["MAX_ROUNDS"] = str(args.max_rounds)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+async def monitor_loop_lag(samples: List[float], interval: float) -> None:
+    """Record how late the loop wakes a sleeping task (ms): a proxy for blocking work"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected) * 1000)
+
+# =============== CLIENT ===============
+
+class SessionFailed(Exception):
+    pass
+
+async def run_one_session(
+    client: httpx.AsyncClient,
+    ws_base: str,
+    index: int,
+    timeout: float,
+    counters: Dict[str, int]
+) -> Dict[str, float]:
+    """Drive one session to COMPLETE, returning its phase latencies (ms)"""
+    import websockets
+
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+
+    def elapsed_ms(since: float) -> float:
+        return (time.perf_counter() - since) * 1000
+
+    async def post_admitted(path: str, body: Dict[str, Any]) -> httpx.Response:
+        # Back off on queue-full/unavailable like a well-behaved client
+        while True:
+            response = await client.post(path, json=body)
+            if response.status_code not in (429, 503):
+                response.raise_for_status()
+                return response
+            counters["rejected"] += 1
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+
+    sent = time.perf_counter()
+    response = await post_admitted("/api/chat/init", {"message": f"Benchmark question #{index}: compare two designs"})
+    timings["init_request"] = elapsed_ms(sent)
+    session_id = response.json()["session_id"]
+    init_accepted = time.perf_counter()
+
+    async with websockets.connect(f"{ws_base}/api/ws/{session_id}", max_size=None) as ws:
+        async def next_message() -> Dict[str, Any]:
+            while True:
+                raw = await ws.recv()
+                if raw == "pong":
+                    continue
+                message = json.loads(raw)
+                if message["type"] == "error":
+                    raise SessionFailed(message.get("content") or "session error")
+                if message["type"] == "state_change" and message.get("state") == "ERROR":
+                    raise SessionFailed("session entered ERROR")
+                return message
+
+        async def drive() -> None:
+            # Clarification questions (replayed on connect if already generated)
+            while True:
+                message = await next_message()
+                if message["type"] == "agent_output" and message.get("agent") == "CLARIFICATION":
+                    break
+            timings["clarification"] = elapsed_ms(init_accepted)
+
+            sent = time.perf_counter()
+            await post_admitted("/api/chat/clarify", {"session_id": session_id, "answers": "Optimise for throughput."})
+            timings["clarify_request"] = elapsed_ms(sent)
+            clarify_accepted = time.perf_counter()
+
+            synthesis_at = None
+            while True:
+                message = await next_message()
+                kind = message["type"]
+                if kind == "agent_delta" and "first_delta" not in timings:
+                    timings["first_delta"] = elapsed_ms(clarify_accepted)
+                elif kind == "synthesis" and synthesis_at is None:
+                    synthesis_at = time.perf_counter()
+                    timings["debate"] = elapsed_ms(clarify_accepted)
+                elif kind == "state_change" and message.get("state") == "COMPLETE":
+                    if synthesis_at is not None:
+                        timings["finalize"] = elapsed_ms(synthesis_at)
+                    return
+
+        await asyncio.wait_for(drive(), timeout)
+
+    timings["end_to_end"] = elapsed_ms(started)
+    return timings
+
+async def drive_sessions(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run args.sessions sessions with at most args.concurrency in flight"""
+    ws_base = base_url.replace("http://", "ws://", 1)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    phases: Dict[str, List[float]] = {phase: [] for phase in PHASES}
+    counters = {"completed": 0, "failed": 0, "rejected": 0}
+    errors: Dict[str, int] = {}
+
+    async def worker(index: int) -> None:
+        async with semaphore:
+            try:
+                timings = await run_one_session(client, ws_base, index, args.session_timeout, counters)
+            except Exception as e:
+                counters["failed"] += 1
+                reason = f"{type(e).__name__}: {str(e)[:120]}"
+                errors[reason] = errors.get(reason, 0) + 1
+                return
+            counters["completed"] += 1
+            for phase, value in timings.items():
+                phases[phase].append(value)
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(i) for i in range(args.sessions)])
+        wall_s = time.perf_counter() - started
+
+    return {"wall_s": wall_s, "phases": phases, "counters": counters, "errors": errors}
+
+def run_client_thread(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the client on its own event loop (keeps client work off the app's loop)"""
+    outcome: Dict[str, Any] = {}
+
+    def target():
+        try:
+            outcome["result"] = asyncio.run(drive_sessions(base_url, args))
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, name="load-test-client")
+    thread.start()
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+# =============== REPORT ===============
+
+def build_report(run: Dict[str, Any], lag_ms: List[float], mock_stats: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    counters = run["counters"]
+    return {
+        "config": {
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "max_rounds": args.max_rounds,
+            "ttft": args.ttft,
+            "model_ttft": args.model_ttft,
+            "tokens_per_second": args.tokens_per_second,
+            "completion_tokens": args.completion_tokens,
+            "error_rate": args.error_rate,
+            "model_error_rate": args.model_error_rate,
+            "rate_limit_rate": args.rate_limit_rate,
+            "cassette_mode": args.cassette_mode,
+            "env": args.env,
+        },
+        "wall_s": round(run["wall_s"], 2),
+        "completed": counters["completed"],
+        "failed": counters["failed"],
+        "rejected": counters["rejected"],
+        "sessions_per_second": round(counters["completed"] / run["wall_s"], 3) if run["wall_s"] else 0.0,
+        "latency_ms": {phase: summarize(values) for phase, values in run["phases"].items()},
+        "event_loop_lag_ms": summarize(lag_ms),
+        "upstream": mock_stats,
+        "errors": run["errors"],
+    }
+
+def print_report(report: Dict[str, Any]) -> None:
+    print()
+    print("=" * 72)
+    print(
+        f"Sessions: {report['completed']} completed, {report['failed']} failed, "
+        f"{report['rejected']} admission rejections"
+    )
+    print(f"Wall time: {report['wall_s']}s    Throughput: {report['sessions_per_second']} sessions/s")
+    print("-" * 72)
+    print(f"{'latency (ms)':<18}{'count':>8}{'p50':>11}{'p95':>11}{'p99':>11}{'max':>11}")
+    rows = list(report["latency_ms"].items()) + [("event_loop_lag", report["event_loop_lag_ms"])]
+    for name, stats in rows:
+        print(f"{name:<18}{stats['count']:>8}{stats['p50']:>11.1f}{stats['p95']:>11.1f}{stats['p99']:>11.1f}{stats['max']:>11.1f}")
+    print("-" * 72)
+    upstream = report["upstream"]
+    if upstream:
+        print(
+            f"Upstream: {upstream.get('requests', 0)} requests ({upstream.get('streamed', 0)} streamed), "
+            f"{upstream.get('errors', 0)} injected 500s, {upstream.get('rate_limited', 0)} injected 429s"
+        )
+        if len(upstream.get("models") or {}) > 1:
+            print("  by model: " + ", ".join(f"{model} {count}" for model, count in sorted(upstream["models"].items())))
+    for reason, count in report["errors"].items():
+        print(f"  {count} x {reason}")
+    print("=" * 72)
+
+def compare_to_baseline(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Regressions beyond the allowed fraction (empty when the run is acceptable)"""
+    problems = []
+    base_rate = baseline.get("sessions_per_second", 0.0)
+    if base_rate and report["sessions_per_second"] < base_rate * (1 - max_regression):
+        problems.append(f"throughput {report['sessions_per_second']} sessions/s vs baseline {base_rate}")
+    base_p95 = baseline.get("latency_ms", {}).get("end_to_end", {}).get("p95", 0.0)
+    p95 = report["latency_ms"]["end_to_end"]["p95"]
+    if base_p95 and p95 > base_p95 * (1 + max_regression):
+        problems.append(f"end-to-end p95 {p95}ms vs baseline {base_p95}ms")
+    if report["failed"] > baseline.get("failed", 0):
+        problems.append(f"{report['failed']} failed sessions vs baseline {baseline.get('failed', 0)}")
+    return problems
+
+# =============== MAIN ===============
+
+async def serve_and_drive(app_port: int, args: argparse.Namespace) -> Dict[str, Any]:
+    import uvicorn
+    from app.main import app
+
+    # The app logs every upstream call at INFO; keep the report readable
+    logging.getLogger().setLevel(args.log_level.upper())
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=app_port, log_level=args.log_level))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+            raise RuntimeError("App server exited during startup")
+        await asyncio.sleep(0.05)
+
+    lag_ms: List[float] = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_ms, args.lag_interval))
+    try:
+        run = await asyncio.to_thread(run_client_thread, f"http://127.0.0.1:{app_port}", args)
+    finally:
+        lag_task.cancel()
+        server.should_exit = True
+        await server_task
+    return {"run": run, "lag_ms": lag_ms}
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test against a mock Z.AI server")
+    parser.add_argument("--sessions", type=int, default=50, help="total sessions to run")
+    parser.add_argument("--concurrency", type=int, default=10, help="sessions in flight at once")
+    parser.add_argument("--max-rounds", type=int, default=None, help="override MAX_ROUNDS for the app")
+    parser.add_argument("--session-timeout", type=float, default=300.0, help="seconds before a session counts as failed")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="event-loop lag sampling interval (seconds)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app setting (repeatable)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="allowed fractional regression vs baseline")
+    parser.add_argument("--keep-data", action="store_true", help="keep the temporary session storage")
+    parser.add_argument("--cassette-mode", choices=("off", "record", "replay"), default="off", help="record or replay upstream completions")
+    parser.add_argument("--cassette", default="benchmarks/cassette.jsonl", help="cassette file for --cassette-mode")
+    parser.add_argument("--cassette-time-scale", type=float, default=0.0, help="replay timing: 0 = instant, 1 = as recorded")
+    parser.add_argument("--log-level", default="warning", help="log level for the app and uvicorn")
+    add_mock_arguments(parser)
+    return parser.parse_args()
+
+def main() -> int:
+    args = parse_args()
+    mock_port, app_port = free_port(), free_port()
+    storage_path = tempfile.mkdtemp(prefix="perspective-bench-")
+
+    if args.cassette_mode == "record":
+        # Each recording starts from an empty cassette
+        Path(args.cassette).unlink(missing_ok=True)
+    # Replays never reach the upstream API
+    mock = start_mock(mock_port, args) if args.cassette_mode != "replay" else None
+    try:
+        configure_app_environment(mock_port, storage_path, args)
+        print(
+            f"Running {args.sessions} sessions at concurrency {args.concurrency} "
+            f"(mock on :{mock_port}, app on :{app_port}, storage {storage_path})"
+        )
+        outcome = asyncio.run(serve_and_drive(app_port, args))
+        mock_stats = {}
+        if mock is not None:
+            try:
+                mock_stats = httpx.get(f"http://127.0.0.1:{mock_port}/stats", timeout=5).json()
+            except httpx.HTTPError:
+                pass
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait(timeout=10)
+        if not args.keep_data:
+            shutil.rmtree(storage_path, ignore_errors=True)
+
+    report = build_report(outcome["run"], outcome["lag_ms"], mock_stats, args)
+    print_report(report)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Report written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        problems = compare_to_baseline(report, baseline, args.max_regression)
+        if problems:
+            print(f"REGRESSION (allowed {args.max_regression:.0%}):")
+            for problem in problems:
+                print(f"  - {problem}")
+            return 1
+        print(f"No regression against {args.baseline} (allowed {args.max_regression:.0%})")
+
+    return 0 if report["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
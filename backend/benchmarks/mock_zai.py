@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Mock Z.AI server for offline benchmarks
+
+An OpenAI-compatible stand-in for the Z.AI API serving GET /models and
+POST /chat/completions (plain JSON or SSE streaming), with configurable
+latency, output length and failure injection:
+
+    time to first token   latency distribution, e.g. "lognormal:800:0.5",
+                          optionally overridden per model (a slow model)
+    output throughput     tokens per second after the first token
+    completion tokens     mean output length (+/- jitter)
+    error_rate            share of requests answered with HTTP 500, optionally
+                          overridden per model (an outage)
+    rate_limit_rate       share of requests answered with HTTP 429 + Retry-After
+    prefix cache          a leading system message seen before (same model) is
+                          reported as prompt_tokens_details.cached_tokens
+
+Latency specs are "kind:mean_ms[:spread]" with kind one of fixed, uniform
+(spread = +/- fraction of the mean), lognormal (spread = sigma) or
+exponential. Nothing is billed and no API key is checked.
+
+Usage:
+    python -m benchmarks.mock_zai --port 9100 --ttft lognormal:600:0.4 --tokens-per-second 80
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "the", "debate", "considers", "trade-offs", "between", "latency", "and", "cost",
+    "while", "expansion", "explores", "options", "compression", "distills", "them",
+    "into", "a", "focused", "answer", "with", "clear", "reasoning",
+)
+
+@dataclass
+class LatencyDistribution:
+    """Random delay (milliseconds) drawn from a named distribution"""
+    kind: str = "fixed"
+    mean_ms: float = 0.0
+    spread: float = 0.0
+
+    KINDS = ("fixed", "uniform", "lognormal", "exponential")
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        """Parse "kind:mean_ms[:spread]" (a bare number means fixed)"""
+        parts = spec.split(":")
+        if len(parts) == 1:
+            return cls("fixed", float(parts[0]))
+        kind = parts[0]
+        if kind not in cls.KINDS:
+            raise ValueError(f"Unknown latency distribution '{kind}' (expected one of {', '.join(cls.KINDS)})")
+        spread = float(parts[2]) if len(parts) > 2 else (0.5 if kind == "lognormal" else 0.0)
+        return cls(kind, float(parts[1]), spread)
+
+    def sample_ms(self, rng: random.Random) -> float:
+        if self.mean_ms <= 0:
+            return 0.0
+        if self.kind == "uniform":
+            return max(0.0, rng.uniform(self.mean_ms * (1 - self.spread), self.mean_ms * (1 + self.spread)))
+        if self.kind == "lognormal":
+            # Choose mu so that the distribution's mean is mean_ms
+            mu = math.log(self.mean_ms) - self.spread ** 2 / 2
+            return rng.lognormvariate(mu, self.spread)
+        if self.kind == "exponential":
+            return rng.expovariate(1.0 / self.mean_ms)
+        return self.mean_ms
+
+    def __str__(self) -> str:
+        return f"{self.kind}:{self.mean_ms:g}:{self.spread:g}"
+
+@dataclass
+class MockConfig:
+    """Behaviour of the mock server"""
+    ttft: LatencyDistribution = field(default_factory=lambda: LatencyDistribution("lognormal", 500.0, 0.4))
+    model_ttft: Dict[str, LatencyDistribution] = field(default_factory=dict)
+    tokens_per_second: float = 80.0
+    completion_tokens: int = 120
+    completion_jitter: float = 0.25
+    tokens_per_chunk: int = 4
+    error_rate: float = 0.0
+    model_error_rate: Dict[str, float] = field(default_factory=dict)
+    rate_limit_rate: float = 0.0
+    retry_after_seconds: float = 1.0
+    prefix_cache: bool = True
+    seed: Optional[int] = None
+
+def _prompt_tokens(body: Dict[str, Any]) -> int:
+    """Rough prompt size (4 characters per token), like the real tokenizer on English text"""
+    chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+    return max(1, chars // 4)
+
+def _system_prefix(body: Dict[str, Any]) -> Optional[str]:
+    messages = body.get("messages") or []
+    if messages and messages[0].get("role") == "system":
+        return str(messages[0].get("content", ""))
+    return None
+
+def create_app(config: MockConfig) -> FastAPI:
+    """Build the mock server app for a configuration"""
+    app = FastAPI(title="Mock Z.AI API")
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0, "completion_tokens": 0, "cached_tokens": 0, "models": {}}
+    app.state.stats = stats
+    seen_prefixes = set()
+
+    def cached_tokens(body: Dict[str, Any]) -> int:
+        """Tokens of a system prefix this model has already been sent"""
+        prefix = _system_prefix(body)
+        if not config.prefix_cache or prefix is None:
+            return 0
+        key = (body.get("model"), hash(prefix))
+        if key not in seen_prefixes:
+            seen_prefixes.add(key)
+            return 0
+        return len(prefix) // 4
+
+    def completion_tokens(body: Dict[str, Any]) -> int:
+        jitter = config.completion_jitter
+        tokens = int(config.completion_tokens * rng.uniform(1 - jitter, 1 + jitter))
+        return max(1, min(tokens, int(body.get("max_tokens") or tokens)))
+
+    def text_for(tokens: int) -> str:
+        return " ".join(WORDS[i % len(WORDS)] for i in range(tokens))
+
+    def generation_seconds(tokens: int) -> float:
+        return tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+
+    def injected_failure(model: str) -> Optional[JSONResponse]:
+        roll = rng.random()
+        if roll < config.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"code": "1302", "message": "Rate limit reached"}},
+                status_code=429,
+                headers={"Retry-After": f"{config.retry_after_seconds:g}"}
+            )
+        if roll < config.rate_limit_rate + config.model_error_rate.get(model, config.error_rate):
+            stats["errors"] += 1
+            return JSONResponse({"error": {"code": "500", "message": "Injected failure"}}, status_code=500)
+        return None
+
+    @app.get("/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "glm-4.7", "object": "model"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+
+        model = body.get("model", "glm-4.7")
+        failure = injected_failure(model)
+        if failure is not None:
+            await asyncio.sleep(config.ttft.sample_ms(rng) / 1000 / 4)
+            return failure
+
+        stats["models"][model] = stats["models"].get(model, 0) + 1
+        tokens = completion_tokens(body)
+        stats["completion_tokens"] += tokens
+        cached = cached_tokens(body)
+        stats["cached_tokens"] += cached
+        usage = {
+            "prompt_tokens": _prompt_tokens(body),
+            "completion_tokens": tokens,
+            "total_tokens": _prompt_tokens(body) + tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+        ttft_s = config.model_ttft.get(model, config.ttft).sample_ms(rng) / 1000
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft_s + generation_seconds(tokens))
+            return {
+                "id": f"mock-{stats['requests']}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text_for(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        stats["streamed"] += 1
+
+        async def events() -> AsyncIterator[bytes]:
+            await asyncio.sleep(ttft_s)
+            words = text_for(tokens).split(" ")
+            step = max(1, config.tokens_per_chunk)
+            for start in range(0, len(words), step):
+                if start:
+                    await asyncio.sleep(generation_seconds(step))
+                content = " ".join(words[start:start + step]) + (" " if start + step < len(words) else "")
+                chunk = {
+                    "id": f"mock-{stats['requests']}",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+            final = {
+                "id": f"mock-{stats['requests']}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(final)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Mock server options (shared with the load test)"""
+    parser.add_argument("--ttft", default="lognormal:500:0.4", help="time-to-first-token distribution (kind:mean_ms[:spread])")
+    parser.add_argument("--model-ttft", action="append", default=[], metavar="MODEL=SPEC", help="time-to-first-token distribution for one model (repeatable)")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="output throughput after the first token")
+    parser.add_argument("--completion-tokens", type=int, default=120, help="mean completion length in tokens")
+    parser.add_argument("--completion-jitter", type=float, default=0.25, help="+/- fraction applied to completion length")
+    parser.add_argument("--tokens-per-chunk", type=int, default=4, help="tokens per SSE chunk when streaming")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with HTTP 500")
+    parser.add_argument("--model-error-rate", action="append", default=[], metavar="MODEL=RATE", help="HTTP 500 share for one model (repeatable)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests failing with HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--no-prefix-cache", dest="prefix_cache", action="store_false", help="never report cached prompt tokens")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible runs")
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        ttft=LatencyDistribution.parse(args.ttft),
+        model_ttft={
+            model: LatencyDistribution.parse(spec)
+            for model, spec in (item.split("=", 1) for item in args.model_ttft)
+        },
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        completion_jitter=args.completion_jitter,
+        tokens_per_chunk=args.tokens_per_chunk,
+        error_rate=args.error_rate,
+        model_error_rate={
+            model: float(rate)
+            for model, rate in (item.split("=", 1) for item in args.model_error_rate)
+        },
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after_seconds=args.retry_after,
+        prefix_cache=args.prefix_cache,
+        seed=args.seed,
+    )
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock Z.AI (OpenAI-compatible) server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
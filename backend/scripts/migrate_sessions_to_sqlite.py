@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Bulk Session Migration: JSON files -> SQLite
+
+Imports every session in a JSON session directory (snapshots plus any
+journal tails) into the SQLite session backend. Files are parsed and
+validated once, in parallel worker processes, and never modified; the
+database is written from the main process in batched transactions.
+Re-running the migration is safe: sessions are upserted.
+
+Usage:
+    python scripts/migrate_sessions_to_sqlite.py --source ./sessions
+    python scripts/migrate_sessions_to_sqlite.py --source ./sessions --db ./sessions/sessions.db --workers 8
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from uuid import UUID
+
+# Add app to path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.session_backends import FileSessionBackend
+from app.sqlite_backend import SQLiteSessionBackend
+
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+RESET = "\033[0m"
+
+def log(msg, color=RESET):
+    print(f"{color}{msg}{RESET}")
+
+def load_session(args: Tuple[str, str]) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Parse and validate one session in a worker process (read-only: a torn
+    journal tail is skipped, not truncated).
+
+    Returns:
+        (session_id, JSON-mode session dump or None, error message or None)
+    """
+    source, session_id = args
+    try:
+        session = FileSessionBackend(Path(source)).peek_sync(UUID(session_id))
+        if session is None:
+            return session_id, None, "snapshot missing"
+        return session_id, session.model_dump(mode="json"), None
+    except Exception as e:
+        return session_id, None, str(e)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import JSON session files into the SQLite session backend")
+    parser.add_argument("--source", default=os.environ.get("SESSION_STORAGE_PATH"),
+                        help="JSON session directory (default: $SESSION_STORAGE_PATH)")
+    parser.add_argument("--db", help="SQLite database path (default: <source>/sessions.db)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Parser processes")
+    parser.add_argument("--batch-size", type=int, default=200, help="Sessions per write transaction")
+    args = parser.parse_args()
+
+    if not args.source:
+        log("No source directory given (use --source or set SESSION_STORAGE_PATH)", RED)
+        return 1
+
+    source = Path(args.source)
+    db_path = Path(args.db) if args.db else source / "sessions.db"
+    session_ids = [str(sid) for sid in FileSessionBackend(source).session_ids()]
+    log(f"--- Migrating {len(session_ids)} sessions from {source} to {db_path} ---", YELLOW)
+
+    backend = SQLiteSessionBackend(db_path)
+    started = time.monotonic()
+    imported, failed, batch = 0, 0, []
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [(str(source), sid) for sid in session_ids]
+        for session_id, data, error in pool.map(load_session, jobs, chunksize=32):
+            if error:
+                failed += 1
+                log(f"  skipped {session_id}: {error}", RED)
+                continue
+            batch.append(data)
+            if len(batch) >= args.batch_size:
+                backend.write_documents_sync(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            backend.write_documents_sync(batch)
+            imported += len(batch)
+
+    elapsed = time.monotonic() - started
+    rate = imported / elapsed if elapsed else 0.0
+    log(f"Imported {imported} sessions ({failed} failed) in {elapsed:.1f}s ({rate:.0f} sessions/s)",
+        GREEN if not failed else YELLOW)
+    return 0 if not failed else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
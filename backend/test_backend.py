@@ -144,6 +144,105 @@ async def test_cost_tracking():
         print_error(f"Cost tracking test failed: {e}")
         return False
 
+async def test_ws_snapshot_during_slow_load():
+    """Test that messages published while a WebSocket snapshot loads still reach the client"""
+    print("\n" + "="*60)
+    print("TEST 5: WebSocket Snapshot During a Slow Session Load")
+    print("="*60)
+
+    from uuid import uuid4
+    from fastapi import WebSocketDisconnect
+    from app import main
+    from app.models import AgentType, WSMessage
+
+    class FakeWebSocket:
+        def __init__(self):
+            self.sent = []
+            self.closed = asyncio.Event()
+
+        async def accept(self):
+            pass
+
+        async def send_text(self, text):
+            self.sent.append(json.loads(text))
+
+        async def receive_text(self):
+            await self.closed.wait()
+            raise WebSocketDisconnect()
+
+    session_id = uuid4()
+    original_load = main.session_store.load
+
+    async def slow_load(sid):
+        # An agent output is published while the snapshot is still being read
+        await main.broadcast_to_session(sid, WSMessage(
+            type="agent_output", session_id=sid, round=1, agent=AgentType.EXPANSION, content="published during load"
+        ))
+        await asyncio.sleep(0.1)
+        return None
+
+    main.session_store.load = slow_load
+    websocket = FakeWebSocket()
+    try:
+        endpoint = asyncio.create_task(main.websocket_endpoint(websocket, str(session_id)))
+        await asyncio.sleep(0.3)
+        websocket.closed.set()
+        await endpoint
+    except Exception as e:
+        print_error(f"WebSocket snapshot test failed: {e}")
+        return False
+    finally:
+        main.session_store.load = original_load
+
+    types = [message["type"] for message in websocket.sent]
+    print(f"  Frames received: {types}")
+    if types[:1] == ["sync"] and any(m.get("content") == "published during load" for m in websocket.sent):
+        print_success("Message published during the load was delivered after the snapshot")
+        return True
+    print_error("Message published during the load was lost")
+    return False
+
+async def test_journal_save_after_eviction():
+    """Test that a journaled session saved again after cache eviction reloads without duplicated history"""
+    print("\n" + "="*60)
+    print("TEST 6: Journal Save After Cache Eviction")
+    print("="*60)
+
+    import tempfile
+    from app.models import AgentType, RoundOutput, SessionData
+    from app.session_backends import FileSessionBackend
+    from app.session_store import SessionStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SessionStore(FileSessionBackend(Path(tmp), mode="journal"))
+        store.max_entries = 1
+        try:
+            session = SessionData(original_user_prompt="journal eviction test")
+            await store.save(session, flush=True)
+            for content in ("A", "B"):
+                session.history.append(RoundOutput(round_number=1, agent=AgentType.EXPANSION, content=content))
+                await store.save(session, flush=True)
+
+            # A second session pushes the first out of the cache (dropping its journal cursor)
+            await store.save(SessionData(original_user_prompt="other session"), flush=True)
+            session.current_round = 1
+            await store.save(session, flush=True)
+
+            reloaded = await FileSessionBackend(Path(tmp), mode="journal").read(session.session_id)
+        except Exception as e:
+            print_error(f"Journal eviction test failed: {e}")
+            return False
+        finally:
+            await store.close()
+
+    contents = [output.content for output in reloaded.history] if reloaded else None
+    print(f"  Reloaded history: {contents}")
+    if contents == ["A", "B"] and reloaded.current_round == 1:
+        print_success("Reloaded session matches the saved one")
+        return True
+    print_error("Reloaded session does not match the saved one")
+    return False
+
 async def test_backend_running():
     """Test if backend is running"""
     print("\n" + "="*60)
@@ -187,6 +286,12 @@ async def main():
     # Test 4: Cost tracking
     results.append(await test_cost_tracking())
 
+    # Test 5: WebSocket snapshot race (in-process)
+    results.append(await test_ws_snapshot_during_slow_load())
+
+    # Test 6: Journal save after cache eviction (in-process)
+    results.append(await test_journal_save_after_eviction())
+
     # Summary
     print("\n" + "="*60)
     print("TEST SUMMARY")
@@ -9,6 +9,7 @@ export interface ChatMessage {
   round?: number;
   state?: string;
   timestamp?: number;
+  seq?: number;
 }
 
 export interface ProgressState {
@@ -67,31 +68,22 @@ export function useMultiPerspectiveChat(): ChatState {
   const [rounds, setRounds] = useState<RoundData[]>([]);
   const [currentRound, setCurrentRound] = useState(0);
   const wsRef = useRef<WebSocket | null>(null);
+  // Last sequence number received; reconnects resume from it with ?since=
+  const lastSeqRef = useRef<number | null>(null);
+  const reconnectTimerRef = useRef<ReturnType<typeof setTimeout> | null>(null);
 
   const connectWebSocket = useCallback((sid: string) => {
-    if (wsRef.current) wsRef.current.close();
-
-    const fetchSessionHistory = async (sid2: string) => {
-      try {
-        const httpBase = getHttpBase();
-        const res = await fetch(`${httpBase}/api/chat/${sid2}`);
-        if (res.ok) {
-          const session = await res.json();
-          const historyMessages: ChatMessage[] = (session.history || []).map((h: any) => ({
-            type: h.agent === "SYNTHESIS" ? "synthesis" : "agent_output",
-            content: h.content,
-            agent: h.agent,
-            round: h.round_number,
-          }));
-          setMessages(historyMessages);
-        }
-      } catch (err) {
-        console.error("Failed to fetch session history:", err);
-      }
-    };
+    if (reconnectTimerRef.current) clearTimeout(reconnectTimerRef.current);
+    if (wsRef.current) {
+      const previous = wsRef.current;
+      wsRef.current = null;
+      previous.close();
+    }
 
     const wsBase = getWsBase();
-    const wsUrl = `${wsBase}/api/ws/${sid}`;
+    const since = lastSeqRef.current;
+    const wsUrl = `${wsBase}/api/ws/${sid}` + (since !== null ? `?since=${since}` : "");
+    let finished = false;
 
     const ws = new WebSocket(wsUrl);
 
@@ -101,6 +93,21 @@ export function useMultiPerspectiveChat(): ChatState {
       try {
         const message = JSON.parse(event.data);
 
+        if (message.type === "sync") {
+          // First message on every connection: the stream continues after message.seq
+          lastSeqRef.current = message.seq ?? null;
+          if (message.content === "snapshot") {
+            // Missed events are no longer buffered; the session is re-sent from scratch
+            setMessages([]);
+            setRounds([]);
+          }
+          return;
+        }
+        if (typeof message.seq === "number") {
+          if (lastSeqRef.current !== null && message.seq <= lastSeqRef.current) return;
+          lastSeqRef.current = message.seq;
+        }
+
         if (message.type === "state_change") {
           setState(message.state);
 
@@ -118,8 +125,8 @@ export function useMultiPerspectiveChat(): ChatState {
             });
           } else if (message.state === "COMPLETE") {
             setProgress({ stage: "complete", percent: 100, description: "Complete" });
-            fetchSessionHistory(sid);
           }
+          if (message.state === "COMPLETE" || message.state === "ERROR") finished = true;
         } else if (message.type === "progress") {
           setProgress({
             stage: message.stage || "processing",
@@ -167,6 +174,7 @@ export function useMultiPerspectiveChat(): ChatState {
             });
           }
         } else if (message.type === "error") {
+          finished = true;
           setError(message.content || "Backend error");
           setState("ERROR");
         }
@@ -179,6 +187,15 @@ export function useMultiPerspectiveChat(): ChatState {
       setError("WebSocket connection error");
     };
 
+    ws.onclose = () => {
+      // Closed by us (new session / unmount) or nothing more to receive
+      if (wsRef.current !== ws || finished) return;
+      reconnectTimerRef.current = setTimeout(() => {
+        setError(null);
+        connectWebSocket(sid);
+      }, 1000);
+    };
+
     wsRef.current = ws;
   }, []);
 
@@ -195,6 +212,7 @@ export function useMultiPerspectiveChat(): ChatState {
         setRounds([]);
         setCurrentRound(0);
         setError(null);
+        lastSeqRef.current = null;
 
         const httpBase = getHttpBase();
         const response = await fetch(`${httpBase}/api/chat/init`, {
@@ -243,7 +261,10 @@ export function useMultiPerspectiveChat(): ChatState {
 
   useEffect(() => {
     return () => {
-      if (wsRef.current) wsRef.current.close();
+      if (reconnectTimerRef.current) clearTimeout(reconnectTimerRef.current);
+      const ws = wsRef.current;
+      wsRef.current = null;
+      if (ws) ws.close();
     };
   }, []);
 